@@ -1,33 +1,75 @@
+import base64
 import functools
 import json
 import logging
-from datetime import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from socket import gethostname
 from typing import (
+    IO,
     Any,
     Dict,
+    Iterator,
     List,
     Optional,
+    Set,
+    Tuple,
 )
 from uuid import uuid4
 
 import iso8601
 from aw_core.dirs import get_data_dir
-from aw_core.log import get_log_file_path
 from aw_core.models import Event
 from aw_query import query2
 from aw_transform import heartbeat_merge
 from aw_core import MANUAL_ACTIVITY_EVENT_TYPE
 
+from . import log_tail
 from .__about__ import __version__
-from .exceptions import NotFound
+from .columnar import iter_columnar, write_columnar
+from .event_counts import EventCounts, is_aligned
+from .exceptions import BadRequest, NotFound
+from .incremental import (
+    RESPLIT_INTERVAL,
+    Kind,
+    PartitionView,
+    merge_results,
+    result_kind,
+)
+from .journal import HeartbeatJournal
+from .log_tail import DEFAULT_LOG_LIMIT, MAX_LOG_LIMIT
+from .json_stream import iter_export
+from .query_cache import QueryCache, normalize_query, referenced_buckets
+from .retention import (
+    CHUNK,
+    Retention,
+    Tier,
+    downsample,
+    floor_time,
+    parse_policies,
+)
+from .rollups import DEFAULT_ROLLUP_KEYS, RESOLUTIONS, Rollups, parse_classes
 from .settings import Settings
+from .versions import BucketVersions
 from aw_server.firebase_datastore.firestore import FirestoreStorage
 from aw_server.sync import DataSynchronizer
 
 logger = logging.getLogger(__name__)
 
+# Number of locks that heartbeats are serialized on, buckets are spread over
+# them by hash so that heartbeats to different buckets rarely have to wait.
+HEARTBEAT_LOCK_STRIPES = 16
+
+# Number of events read from storage at a time when iterating over a bucket
+EVENTS_PAGE_SIZE = 1000
+
+# Number of events inserted at a time by streaming imports
+IMPORT_BATCH_SIZE = 5000
+
 
 def get_device_id() -> str:
     path = Path(get_data_dir("aw-server")) / "device_id"
@@ -41,10 +83,37 @@ def get_device_id() -> str:
         return uuid
 
 
+def _trim(event: Event, start: Optional[datetime], end: Optional[datetime]) -> Event:
+    """Returns the event trimmed to [start, end] like storages do"""
+    timestamp, event_end = event.timestamp, event.timestamp + event.duration
+    if start and timestamp < start:
+        timestamp = start
+    if end and event_end > end:
+        event_end = end
+    return Event(
+        id=event.id, timestamp=timestamp, duration=event_end - timestamp, data=event.data
+    )
+
+
+def _encode_cursor(event: Event) -> str:
+    key = json.dumps([event.timestamp.isoformat(), event.id])
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, Any]:
+    """Decode a cursor into the (timestamp, id) key of the last event of a page"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, event_id = json.loads(base64.urlsafe_b64decode(padded))
+        return iso8601.parse_date(timestamp), event_id
+    except (ValueError, TypeError, iso8601.ParseError):
+        raise BadRequest("InvalidCursor", f"Invalid cursor {cursor!r}")
+
+
 def check_bucket_exists(f):
     @functools.wraps(f)
     def g(self, bucket_id, *args, **kwargs):
-        if bucket_id not in self.db.buckets():
+        if bucket_id not in self._buckets:
             raise NotFound("NoSuchBucket", f"There's no bucket named {bucket_id}")
         return f(self, bucket_id, *args, **kwargs)
 
@@ -52,11 +121,78 @@ def check_bucket_exists(f):
 
 
 class ServerAPI:
-    def __init__(self, db, testing) -> None:
+    def __init__(
+        self,
+        db,
+        testing,
+        heartbeat_flush_interval: float = 0,
+        query_workers: int = 1,
+        rollup_keys: Optional[List[str]] = None,
+        retention: Optional[Dict[str, Any]] = None,
+        retention_interval: float = 0,
+    ) -> None:
         self.db = db
         self.settings = Settings(testing)
         self.testing = testing
         self.last_event = {}  # type: dict
+        # Authoritative registry of bucket metadata, kept in sync by the bucket
+        # mutators below so that requests don't have to list buckets in storage.
+        self._buckets = {}  # type: Dict[str, Dict[str, Any]]
+        # End time of the last event in each bucket, used for "last_updated"
+        self._last_updated = {}  # type: Dict[str, datetime]
+        # Versions of the buckets, bumped on every write, used to invalidate
+        # cached query results
+        self._versions = BucketVersions()
+        self._query_cache = QueryCache()
+        self._event_counts = EventCounts()
+        self._rollups = Rollups(
+            self._rollups_path(),
+            rollup_keys if rollup_keys is not None else DEFAULT_ROLLUP_KEYS,
+        )
+        self._rollups.set_classes(parse_classes(self.settings.get("classes")))
+        self._retention = Retention(
+            self._retention_path(), parse_policies(retention or {})
+        )
+        # Pool that the timeperiods of a query are evaluated on
+        self._query_executor = (
+            ThreadPoolExecutor(
+                max_workers=query_workers, thread_name_prefix="aw-server-query"
+            )
+            if query_workers > 1
+            else None
+        )  # type: Optional[ThreadPoolExecutor]
+        self.refresh_buckets()
+
+        # Write-behind of merged heartbeats (disabled if the interval is 0).
+        # Merged events are kept in _pending_heartbeats and only written to
+        # storage when the data changes, the bucket is read from, every
+        # heartbeat_flush_interval seconds or on close().
+        self.heartbeat_flush_interval = heartbeat_flush_interval
+        self._pending_heartbeats = {}  # type: Dict[str, Event]
+        self._pending_lock = threading.Lock()
+        self._heartbeat_journal = HeartbeatJournal(testing)
+        self._recover_heartbeats()
+        self._stop_flushing = threading.Event()
+        if heartbeat_flush_interval > 0:
+            threading.Thread(target=self._flush_heartbeats_loop, daemon=True).start()
+
+        self._heartbeat_locks = [
+            threading.Lock() for _ in range(HEARTBEAT_LOCK_STRIPES)
+        ]
+        self._heartbeat_lock_stats = {"acquired": 0, "contended": 0, "wait_time": 0.0}
+        self._heartbeat_lock_stats_lock = threading.Lock()
+
+        self._import_progress = {
+            "bucket": None,
+            "buckets": 0,
+            "events": 0,
+        }  # type: Dict[str, Any]
+
+        # Downsampling of old events (disabled if the interval is 0)
+        self.retention_interval = retention_interval
+        self._stop_retention = threading.Event()
+        if retention_interval > 0 and self._retention.policies:
+            threading.Thread(target=self._retention_loop, daemon=True).start()
         self.firebase_db = FirestoreStorage(testing=testing) # Firestore depolamasını başlat
         self.synchronizer = DataSynchronizer(local_db=self.db, firebase_db=self.firebase_db) # Senkronizasyon nesnesini başlat
 
@@ -70,24 +206,93 @@ class ServerAPI:
         }
         return payload
 
+    def refresh_buckets(self) -> None:
+        """Reload the bucket registry from storage.
+
+        Needs to be called if buckets were created or deleted behind the back of
+        the ServerAPI (such as by the Firebase synchronizer)."""
+        self._buckets = self.db.buckets()
+        self._last_updated = {}
+        self._versions.clear()
+        self._query_cache.clear()
+        self._event_counts.clear()
+        for bucket_id in self._buckets:
+            self._refresh_last_updated(bucket_id)
+        self._retention.retain_buckets(list(self._buckets))
+
+    def close(self) -> None:
+        """Flush pending heartbeats and stop background work, called on shutdown"""
+        self._stop_flushing.set()
+        self._stop_retention.set()
+        self.flush_heartbeats()
+        if self._query_executor is not None:
+            self._query_executor.shutdown()
+        self._rollups.close()
+        # Storages with background writers (like SqliteStorage) have to finish them
+        close_storage = getattr(self.db.storage_strategy, "close", None)
+        if close_storage is not None:
+            close_storage()
+
+    def _rollups_path(self) -> str:
+        sid = getattr(self.db.storage_strategy, "sid", "")
+        if sid == "memory":
+            # Nothing to keep the rollups of after the events are gone
+            return ":memory:"
+        filename = f"rollups-{sid}{'-testing' if self.testing else ''}.db"
+        return str(Path(get_data_dir("aw-server")) / filename)
+
+    def _retention_path(self) -> Optional[str]:
+        sid = getattr(self.db.storage_strategy, "sid", "")
+        if sid == "memory":
+            return None
+        filename = f"retention-{sid}{'-testing' if self.testing else ''}.json"
+        return str(Path(get_data_dir("aw-server")) / filename)
+
+    def _refresh_bucket(self, bucket_id: str) -> None:
+        self._buckets[bucket_id] = self.db[bucket_id].metadata()
+
+    def _refresh_last_updated(self, bucket_id: str) -> None:
+        self._last_updated.pop(bucket_id, None)
+        last_events = self.db[bucket_id].get(limit=1)
+        if len(last_events) > 0:
+            self._update_last_updated(bucket_id, last_events)
+
+    def _update_last_updated(self, bucket_id: str, events: List[Event]) -> None:
+        last_updated = max(e.timestamp + e.duration for e in events)
+        if (
+            bucket_id not in self._last_updated
+            or last_updated > self._last_updated[bucket_id]
+        ):
+            self._last_updated[bucket_id] = last_updated
+
+    def _record_write(self, bucket_id: str, events: Optional[List[Event]]) -> None:
+        """Bump the version of a bucket after writing events to it (None if unknown)"""
+        since = min(e.timestamp for e in events) if events else None
+        self._versions.bump(bucket_id, since)
+        self._retention.touch(bucket_id, since)
+
+    def get_etag(self, bucket_id: Optional[str] = None) -> Optional[str]:
+        """
+        Get an entity tag that changes whenever a bucket (or any bucket if None)
+        is written to, None if the bucket doesn't exist. Doesn't read from storage.
+        """
+        if bucket_id is not None and bucket_id not in self._buckets:
+            return None
+        return self._versions.etag(bucket_id)
+
     def get_buckets(self) -> Dict[str, Dict]:
         """Get dict {bucket_name: Bucket} of all buckets"""
         logger.debug("Received get request for buckets")
-        buckets = self.db.buckets()
+        buckets = {bid: dict(b) for bid, b in self._buckets.items()}
         for b in buckets:
-            # TODO: Move this code to aw-core?
-            last_events = self.db[b].get(limit=1)
-            if len(last_events) > 0:
-                last_event = last_events[0]
-                last_updated = last_event.timestamp + last_event.duration
-                buckets[b]["last_updated"] = last_updated.isoformat()
+            if b in self._last_updated:
+                buckets[b]["last_updated"] = self._last_updated[b].isoformat()
         return buckets
 
     @check_bucket_exists
     def get_bucket_metadata(self, bucket_id: str) -> Dict[str, Any]:
         """Get metadata about bucket."""
-        bucket = self.db[bucket_id]
-        return bucket.metadata()
+        return dict(self._buckets[bucket_id])
 
     @check_bucket_exists
     def export_bucket(self, bucket_id: str) -> Dict[str, Any]:
@@ -99,6 +304,74 @@ class ServerAPI:
             del event["id"]
         return bucket
 
+    @check_bucket_exists
+    def export_bucket_events(self, bucket_id: str) -> Iterator[Dict[str, Any]]:
+        """Iterate over the events of a bucket in export format (without IDs), newest first"""
+        for event in self.iter_events(bucket_id):
+            event_dict = event.to_json_dict()
+            event_dict.pop("id", None)
+            yield event_dict
+
+    @check_bucket_exists
+    def iter_events(
+        self,
+        bucket_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        limit: int = -1,
+        page_size: int = EVENTS_PAGE_SIZE,
+    ) -> Iterator[Event]:
+        """
+        Iterate over the events in a bucket, newest first, like get_events.
+
+        Events are read from storage in pages of page_size events, so memory
+        use doesn't grow with the number of events.
+        """
+        self._flush_heartbeat(bucket_id)
+        bucket = self.db[bucket_id]
+        # Storages round the endtime up to the next millisecond, so events just
+        # after the page boundary show up again on the next page.
+        precision = timedelta(milliseconds=1)
+        endtime = end
+        seen = {}  # type: Dict[Any, datetime]
+        while limit != 0:
+            events = bucket.get(page_size, start, endtime)
+            new_events = [e for e in events if e.id not in seen]
+            for event in new_events[:limit] if limit > 0 else new_events:
+                if endtime != end and event.timestamp + event.duration >= endtime:
+                    # Storages that trim events trim them to the end of the page
+                    full = bucket.get_by_id(event.id)
+                    event_end = event.timestamp + event.duration
+                    if full and full.timestamp + full.duration > event_end:
+                        event = _trim(full, start, end)
+                yield event
+            if limit > 0:
+                limit = max(limit - len(new_events), 0)
+            if len(events) < page_size:
+                return
+            if not new_events:
+                # A whole page of events with the same timestamp, use larger pages
+                page_size *= 2
+                continue
+            endtime = events[-1].timestamp
+            seen = {
+                eid: ts
+                for eid, ts in [*seen.items(), *((e.id, e.timestamp) for e in events)]
+                if ts <= endtime + precision
+            }
+
+    def export_columnar(self, bucket_ids: List[str], f: IO[bytes]) -> None:
+        """Export buckets to f in the compact columnar format (see aw_server.columnar)"""
+        for bucket_id in bucket_ids:
+            self._flush_heartbeat(bucket_id)
+        write_columnar(
+            f,
+            (
+                (self.get_bucket_metadata(bid), self.export_bucket_events(bid))
+                for bid in bucket_ids
+            ),
+        )
+
     def export_all(self) -> Dict[str, Any]:
         """Exports all buckets and their events to a format consistent across versions"""
         buckets = self.get_buckets()
@@ -112,17 +385,7 @@ class ServerAPI:
         logger.info(f"Importing bucket {bucket_id}")
 
         # TODO: Check that bucket doesn't already exist
-        self.db.create_bucket(
-            bucket_id,
-            type=bucket_data["type"],
-            client=bucket_data["client"],
-            hostname=bucket_data["hostname"],
-            created=(
-                bucket_data["created"]
-                if isinstance(bucket_data["created"], datetime)
-                else iso8601.parse_date(bucket_data["created"])
-            ),
-        )
+        self._create_imported_bucket(bucket_data)
 
         # scrub IDs from events
         # (otherwise causes weird bugs with no events seemingly imported when importing events exported from aw-server-rust, which contains IDs)
@@ -135,10 +398,102 @@ class ServerAPI:
             [Event(**e) if isinstance(e, dict) else e for e in bucket_data["events"]],
         )
 
+    def _create_imported_bucket(self, bucket_data: Dict[str, Any]) -> None:
+        bucket_id = bucket_data["id"]
+        self.db.create_bucket(
+            bucket_id,
+            type=bucket_data["type"],
+            client=bucket_data["client"],
+            hostname=bucket_data["hostname"],
+            created=(
+                bucket_data["created"]
+                if isinstance(bucket_data["created"], datetime)
+                else iso8601.parse_date(bucket_data["created"])
+            ),
+        )
+        self._refresh_bucket(bucket_id)
+
     def import_all(self, buckets: Dict[str, Any]):
         for bid, bucket in buckets.items():
             self.import_bucket(bucket)
 
+    def import_stream(
+        self, f: IO, resume: bool = False, export_format: str = "json"
+    ) -> Dict[str, int]:
+        """
+        Import all buckets in an export read from a file-like object.
+
+        export_format is either "json", read as text, or "columnar", read from
+        a seekable binary file.
+
+        The export is parsed incrementally and events are inserted in batches,
+        so memory use is independent of the size of the export.
+
+        If resume is set, existing buckets are assumed to be left over from an
+        interrupted import of the same export, and as many events as they
+        already contain are skipped. Otherwise importing an existing bucket fails.
+
+        Returns the number of imported events per bucket.
+        """
+        imported = {}  # type: Dict[str, int]
+        batch = []  # type: List[Event]
+        skip = 0
+
+        def insert_batch():
+            if batch:
+                self.create_events(bucket_id, batch[:])
+                imported[bucket_id] += len(batch)
+                self._import_progress["events"] += len(batch)
+                batch.clear()
+
+        self._import_progress = {"bucket": None, "buckets": 0, "events": 0}
+        if export_format == "columnar":
+            items = iter_columnar(f)
+        elif export_format == "json":
+            items = iter_export(f)
+        else:
+            raise BadRequest("InvalidFormat", f"Unknown export format {export_format}")
+        for item in items:
+            if item[0] == "bucket":
+                insert_batch()
+                bucket_data = item[1]
+                bucket_id = bucket_data["id"]
+                logger.info(f"Importing bucket {bucket_id}")
+                if bucket_id in self._buckets:
+                    if not resume:
+                        raise BadRequest(
+                            "BucketAlreadyExists",
+                            f"Cannot import bucket {bucket_id}, it already exists",
+                        )
+                    skip = self.get_eventcount(bucket_id)
+                    logger.info(f"Resuming import, skipping {skip} events")
+                else:
+                    self._create_imported_bucket(bucket_data)
+                    skip = 0
+                imported[bucket_id] = 0
+                self._import_progress["bucket"] = bucket_id
+                self._import_progress["buckets"] += 1
+            else:
+                if skip > 0:
+                    skip -= 1
+                    continue
+                event = item[2]
+                # scrub IDs from events, see import_bucket
+                event.pop("id", None)
+                batch.append(Event(**event))
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    insert_batch()
+                    logger.info(
+                        f"Imported {imported[bucket_id]} events into {bucket_id}"
+                    )
+        insert_batch()
+        self._import_progress["bucket"] = None
+        return imported
+
+    def get_import_progress(self) -> Dict[str, Any]:
+        """Get the progress of the latest import (current bucket, buckets and events imported)"""
+        return dict(self._import_progress)
+
     def create_bucket(
         self,
         bucket_id: str,
@@ -158,7 +513,7 @@ class ServerAPI:
         """
         if created is None:
             created = datetime.now()
-        if bucket_id in self.db.buckets():
+        if bucket_id in self._buckets:
             return False
         if hostname == "!local":
             info = self.get_info()
@@ -174,6 +529,10 @@ class ServerAPI:
             created=created,
             data=data,
         )
+        self._refresh_bucket(bucket_id)
+        self._record_write(bucket_id, None)
+        self._rollups.create(bucket_id)
+        self._event_counts.build(bucket_id, [])
         return True
 
     @check_bucket_exists
@@ -193,12 +552,24 @@ class ServerAPI:
             hostname=hostname,
             data=data,
         )
+        self._refresh_bucket(bucket_id)
+        self._record_write(bucket_id, None)
         return None
 
     @check_bucket_exists
     def delete_bucket(self, bucket_id: str) -> None:
         """Delete a bucket"""
         self.db.delete_bucket(bucket_id)
+        self._buckets.pop(bucket_id, None)
+        self._last_updated.pop(bucket_id, None)
+        self._versions.remove(bucket_id)
+        self._rollups.drop(bucket_id)
+        self._event_counts.drop(bucket_id)
+        self._retention.drop(bucket_id)
+        self.last_event.pop(bucket_id, None)
+        with self._pending_lock:
+            if self._pending_heartbeats.pop(bucket_id, None):
+                self._heartbeat_journal.save(self._pending_heartbeats)
         logger.debug(f"Deleted bucket '{bucket_id}'")
         return None
 
@@ -212,6 +583,7 @@ class ServerAPI:
         logger.debug(
             f"Received get request for event {event_id} in bucket '{bucket_id}'"
         )
+        self._flush_heartbeat(bucket_id)
         event = self.db[bucket_id].get_by_id(event_id)
         return event.to_json_dict() if event else None
 
@@ -227,17 +599,108 @@ class ServerAPI:
         logger.debug(f"Received get request for events in bucket '{bucket_id}'")
         if limit is None:  # Let limit = None also mean "no limit"
             limit = -1
+        self._flush_heartbeat(bucket_id)
         events = [
             event.to_json_dict() for event in self.db[bucket_id].get(limit, start, end)
         ]
         return events
 
+    @check_bucket_exists
+    def get_events_page(
+        self,
+        bucket_id: str,
+        limit: int,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        cursor: Optional[str] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Get a page of events from a bucket, newest first.
+
+        Returns up to limit events, and a cursor to pass to get the page of
+        events after them (None if there are none). Pages are keyed on the
+        (timestamp, id) of the last event, so getting a page is a seek no matter
+        how far back it is, and writes of newer events don't shift pages.
+        Events are trimmed to the range, even with storages that get_events
+        doesn't trim them with (the memory storages).
+        """
+        if limit <= 0:
+            raise BadRequest("InvalidLimit", "Limit must be positive")
+        before = _decode_cursor(cursor) if cursor is not None else None
+        # Rounded like Bucket.get does for get_events
+        if start:
+            start = start.replace(microsecond=start.microsecond // 1000 * 1000)
+        if end:
+            end = end.replace(microsecond=end.microsecond // 1000 * 1000)
+            end += timedelta(milliseconds=1)
+        self._flush_heartbeat(bucket_id)
+        events = self._events_before(bucket_id, limit + 1, before, start, end)
+        next_cursor = _encode_cursor(events[limit - 1]) if len(events) > limit else None
+        return [_trim(e, start, end).to_json_dict() for e in events[:limit]], next_cursor
+
+    def _events_before(
+        self,
+        bucket_id: str,
+        limit: int,
+        before: Optional[Tuple[datetime, Any]],
+        start: Optional[datetime],
+        end: Optional[datetime],
+    ) -> List[Event]:
+        """
+        Up to limit events in the range ordered before the (timestamp, id) key
+        before (if any), newest first and not trimmed to the range.
+        """
+        get_events_before = getattr(self.db.storage_strategy, "get_events_before", None)
+        if get_events_before is not None:
+            return get_events_before(bucket_id, limit, before, start, end)
+        # Other storages (like peewee) can only seek on the timestamp, events
+        # at the timestamp of the key but after it are read and skipped
+        storage = self.db.storage_strategy
+        endtime = end
+        if before is not None and (end is None or before[0] < end):
+            endtime = before[0]
+        size = limit
+        while True:
+            events = storage.get_events(bucket_id, size, start, endtime)
+            untrimmed = []
+            for event in events:
+                if (start and event.timestamp <= start) or (
+                    endtime and event.timestamp + event.duration >= endtime
+                ):
+                    # Might have been trimmed to the range
+                    event = storage.get_event(bucket_id, event.id) or event
+                untrimmed.append(event)
+            if len(events) == size:
+                # Not every event with the oldest timestamp might have been read
+                oldest = untrimmed[-1].timestamp
+                untrimmed = [e for e in untrimmed if e.timestamp > oldest]
+            page = sorted(
+                (
+                    e
+                    for e in untrimmed
+                    if before is None or (e.timestamp, e.id) < before
+                ),
+                key=lambda e: (e.timestamp, e.id),
+                reverse=True,
+            )
+            if len(page) >= limit or len(events) < size:
+                return page[:limit]
+            size *= 2
+
     @check_bucket_exists
     def create_events(self, bucket_id: str, events: List[Event]) -> Optional[Event]:
         """Create events for a bucket. Can handle both single events and multiple ones.
 
         Returns the inserted event when a single event was inserted, otherwise None."""
-        return self.db[bucket_id].insert(events)
+        self._flush_heartbeat(bucket_id)
+        inserted = self.db[bucket_id].insert(events)
+        if events:
+            events = events if isinstance(events, list) else [events]
+            self._update_last_updated(bucket_id, events)
+            self._record_write(bucket_id, events)
+            self._rollups.add(bucket_id, events)
+            self._event_counts.add(bucket_id, events)
+        return inserted
 
     @check_bucket_exists
     def get_eventcount(
@@ -246,14 +709,50 @@ class ServerAPI:
         start: Optional[datetime] = None,
         end: Optional[datetime] = None,
     ) -> int:
-        """Get eventcount from a bucket"""
+        """
+        Get eventcount from a bucket
+
+        Counts are cached and kept up to date as events are written. Counts over
+        ranges starting and ending at whole hours (like days) are answered from
+        cached counts per hour, and count the events starting in [start, end).
+        """
         logger.debug(f"Received get request for eventcount in bucket '{bucket_id}'")
+        count = self._event_counts.count(bucket_id, start, end)
+        if count is not None:
+            return count
+        if start is None and end is None:
+            version = self._versions.get(bucket_id)
+            self._flush_heartbeat(bucket_id)
+            count = self.db[bucket_id].get_eventcount()
+            # Events written in the meantime might be missing from the count
+            if self._versions.get(bucket_id) == version:
+                self._event_counts.set_total(bucket_id, count)
+            return count
+        if is_aligned(start) and is_aligned(end):
+            if not self._event_counts.is_built(bucket_id):
+                logger.info(f"Counting events per hour in bucket '{bucket_id}'")
+                # Keeps heartbeats from inserting events while the bucket is read
+                with self._heartbeat_lock(bucket_id):
+                    self._event_counts.build(
+                        bucket_id, (e.timestamp for e in self.iter_events(bucket_id))
+                    )
+            return self._event_counts.count(bucket_id, start, end)
+        self._flush_heartbeat(bucket_id)
         return self.db[bucket_id].get_eventcount(start, end)
 
     @check_bucket_exists
     def delete_event(self, bucket_id: str, event_id) -> bool:
         """Delete a single event from a bucket"""
-        return self.db[bucket_id].delete(event_id)
+        self._flush_heartbeat(bucket_id)
+        event = self.db[bucket_id].get_by_id(event_id)
+        deleted = self.db[bucket_id].delete(event_id)
+        # The deleted event might have been the last one
+        self._refresh_last_updated(bucket_id)
+        self._record_write(bucket_id, None)
+        if deleted and event is not None:
+            self._rollups.remove(bucket_id, [event])
+            self._event_counts.remove(bucket_id, [event])
+        return deleted
 
     @check_bucket_exists
     def heartbeat(self, bucket_id: str, heartbeat: Event, pulsetime: float) -> Event:
@@ -288,6 +787,12 @@ class ServerAPI:
             )
         )
 
+        # Heartbeats to the same bucket need to be processed one at a time, as
+        # merging them is a read-modify-write of the last event.
+        with self._heartbeat_lock(bucket_id):
+            return self._heartbeat(bucket_id, heartbeat, pulsetime)
+
+    def _heartbeat(self, bucket_id: str, heartbeat: Event, pulsetime: float) -> Event:
         # The endtime here is set such that in the event that the heartbeat is older than an
         # existing event we should try to merge it with the last event before the heartbeat instead.
         # FIXME: This (the endtime=heartbeat.timestamp) gets rid of the "heartbeat was older than last event"
@@ -297,16 +802,11 @@ class ServerAPI:
         #           That way we could double check that the event has been applied
         #           and if it hasn't we simply replace it with the updated counterpart.
 
-        last_event = None
-        if bucket_id not in self.last_event:
-            last_events = self.db[bucket_id].get(limit=1)
-            if len(last_events) > 0:
-                last_event = last_events[0]
-        else:
-            last_event = self.last_event[bucket_id]
-
+        last_event = self._get_last_event(bucket_id)
         if last_event:
             if last_event.data == heartbeat.data:
+                # heartbeat_merge modifies last_event, the rollups need the old duration
+                previous = Event(**last_event)
                 merged = heartbeat_merge(last_event, heartbeat, pulsetime)
                 if merged is not None:
                     # Heartbeat was merged into last_event
@@ -316,7 +816,13 @@ class ServerAPI:
                         )
                     )
                     self.last_event[bucket_id] = merged
-                    self.db[bucket_id].replace_last(merged)
+                    if self.heartbeat_flush_interval > 0:
+                        self._defer_replace_last(bucket_id, merged)
+                    else:
+                        self.db[bucket_id].replace_last(merged)
+                    self._update_last_updated(bucket_id, [merged])
+                    self._record_write(bucket_id, [merged])
+                    self._rollups.replace(bucket_id, previous, merged)
                     return merged
                 else:
                     logger.info(
@@ -337,30 +843,538 @@ class ServerAPI:
                 )
             )
 
+        # The pending merge has to reach storage before a new last event is inserted
+        self._flush_heartbeat(bucket_id)
         self.db[bucket_id].insert(heartbeat)
         self.last_event[bucket_id] = heartbeat
+        self._update_last_updated(bucket_id, [heartbeat])
+        self._record_write(bucket_id, [heartbeat])
+        self._rollups.add(bucket_id, [heartbeat])
+        self._event_counts.add(bucket_id, [heartbeat])
         return heartbeat
 
-    def query2(self, name, query, timeperiods, cache):
-        result = []
-        for timeperiod in timeperiods:
+    def _get_last_event(self, bucket_id: str) -> Optional[Event]:
+        if bucket_id in self.last_event:
+            return self.last_event[bucket_id]
+        last_events = self.db[bucket_id].get(limit=1)
+        return last_events[0] if len(last_events) > 0 else None
+
+    @check_bucket_exists
+    def heartbeats(
+        self, bucket_id: str, heartbeats: List[Event], pulsetime: float
+    ) -> Optional[Event]:
+        """
+        Process an ordered list of heartbeats, like a sequence of calls to heartbeat.
+
+        The heartbeats are merged in memory and only the resulting events are written,
+        with at most one replace of the last event and a single bulk insert.
+        Useful for watchers replaying heartbeats that were queued while the server was unreachable.
+
+        Returns the last event of the bucket after all heartbeats have been applied.
+        """
+        logger.debug(
+            f"Received {len(heartbeats)} heartbeats in bucket '{bucket_id}', pulsetime: {pulsetime}"
+        )
+        if not heartbeats:
+            return None
+
+        with self._heartbeat_lock(bucket_id):
+            # Write any pending merge first, the last event might be replaced below
+            self._flush_heartbeat(bucket_id)
+            last_event = self._get_last_event(bucket_id)
+            # Copied since heartbeat_merge modifies the event it merges into
+            previous_last_event = Event(**last_event) if last_event else None
+            last_event_merged = False
+            new_events = []  # type: List[Event]
+            for heartbeat in heartbeats:
+                current = new_events[-1] if new_events else last_event
+                merged = None
+                if current and current.data == heartbeat.data:
+                    merged = heartbeat_merge(current, heartbeat, pulsetime)
+                if merged is None:
+                    new_events.append(heartbeat)
+                elif new_events:
+                    new_events[-1] = merged
+                else:
+                    last_event = merged
+                    last_event_merged = True
+
+            if last_event_merged:
+                self.db[bucket_id].replace_last(last_event)
+            if new_events:
+                self.db[bucket_id].insert(new_events)
+                last_event = new_events[-1]
+            written = [last_event] if last_event_merged else []
+            self._record_write(bucket_id, written + new_events)
+            if last_event_merged:
+                self._rollups.replace(bucket_id, previous_last_event, last_event)
+            self._rollups.add(bucket_id, new_events)
+            self._event_counts.add(bucket_id, new_events)
+            self.last_event[bucket_id] = last_event
+            self._update_last_updated(bucket_id, [last_event])
+            return last_event
+
+    @contextmanager
+    def _heartbeat_lock(self, bucket_id: str):
+        lock = self._heartbeat_locks[hash(bucket_id) % len(self._heartbeat_locks)]
+        wait_time = 0.0
+        contended = not lock.acquire(blocking=False)
+        if contended:
+            wait_start = time.perf_counter()
+            lock.acquire()
+            wait_time = time.perf_counter() - wait_start
+        try:
+            with self._heartbeat_lock_stats_lock:
+                self._heartbeat_lock_stats["acquired"] += 1
+                if contended:
+                    self._heartbeat_lock_stats["contended"] += 1
+                    self._heartbeat_lock_stats["wait_time"] += wait_time
+            if wait_time > 1:
+                logger.warning(
+                    f"Heartbeat waited {wait_time:.2f}s for lock (bucket: {bucket_id})"
+                )
+            yield
+        finally:
+            lock.release()
+
+    def get_heartbeat_lock_stats(self) -> Dict[str, Any]:
+        """Get how many heartbeats had to wait for a lock and the total wait time in seconds"""
+        with self._heartbeat_lock_stats_lock:
+            return dict(self._heartbeat_lock_stats)
+
+    def _defer_replace_last(self, bucket_id: str, event: Event) -> None:
+        with self._pending_lock:
+            self._pending_heartbeats[bucket_id] = event
+            self._heartbeat_journal.save(self._pending_heartbeats)
+
+    def _flush_heartbeat(self, bucket_id: str) -> None:
+        """Write the pending merged heartbeat of a bucket (if any) to storage"""
+        if bucket_id not in self._pending_heartbeats:
+            return
+        with self._pending_lock:
+            event = self._pending_heartbeats.pop(bucket_id, None)
+            if event is not None:
+                self.db[bucket_id].replace_last(event)
+                self._heartbeat_journal.save(self._pending_heartbeats)
+
+    def flush_heartbeats(self) -> None:
+        """Write all pending merged heartbeats to storage"""
+        if not self._pending_heartbeats:
+            return
+        with self._pending_lock:
+            for bucket_id, event in self._pending_heartbeats.items():
+                self.db[bucket_id].replace_last(event)
+            self._pending_heartbeats = {}
+            self._heartbeat_journal.clear()
+
+    def _flush_heartbeats_loop(self) -> None:
+        while not self._stop_flushing.wait(self.heartbeat_flush_interval):
+            try:
+                self.flush_heartbeats()
+            except Exception:
+                logger.exception("Failed to flush pending heartbeats")
+
+    def _recover_heartbeats(self) -> None:
+        """Apply merged heartbeats left in the journal by an unclean shutdown"""
+        for bucket_id, event in self._heartbeat_journal.load().items():
+            if bucket_id not in self._buckets:
+                continue
+            last_events = self.db[bucket_id].get(limit=1)
+            # Only extend the event the heartbeats were merged into
+            if (
+                len(last_events) > 0
+                and last_events[0].timestamp == event.timestamp
+                and last_events[0].data == event.data
+                and last_events[0].duration < event.duration
+            ):
+                logger.info(f"Recovering pending heartbeat for bucket '{bucket_id}'")
+                self.db[bucket_id].replace_last(event)
+                self._update_last_updated(bucket_id, [event])
+                self._record_write(bucket_id, [event])
+                self._rollups.replace(bucket_id, last_events[0], event)
+        self._heartbeat_journal.clear()
+
+    def query2(self, name, query, timeperiods, cache, incremental=False):
+        """
+        Run a query for each of the timeperiods.
+
+        The timeperiods are evaluated in parallel on up to query_workers threads,
+        the results are returned in the same order as the timeperiods.
+
+        If cache is set and the query is named, results are cached per
+        timeperiod until one of the buckets referenced by the query is written
+        to in a way that affects the period. Results for closed periods stay
+        cached while only newer data is written.
+
+        If incremental is set as well, periods that are still open are split
+        and only the result for the latest events is recomputed, if the query
+        allows it (see aw_server.incremental).
+        """
+        self.flush_heartbeats()
+        query = "".join(query)
+        # Split into statements once instead of for every timeperiod
+        statements = [
+            statement.strip()
+            for statement in query2._split_query_statements(query)
+            if statement.strip()
+        ]
+        if cache and name:
+            normalized_query = normalize_query(query)
+            bucket_ids = referenced_buckets(query, set(self._buckets))
+            kind = result_kind(statements) if incremental else None
+
+        def run(timeperiod: str) -> Any:
             period = timeperiod.split("/")[
                 :2
             ]  # iso8601 timeperiods are separated by a slash
             starttime = iso8601.parse_date(period[0])
             endtime = iso8601.parse_date(period[1])
-            query = "".join(query)
-            result.append(query2.query(name, query, starttime, endtime, self.db))
+            if cache and name and kind and endtime > datetime.now(timezone.utc):
+                return self._incremental_query(
+                    name,
+                    normalized_query,
+                    statements,
+                    bucket_ids,
+                    kind,
+                    starttime,
+                    endtime,
+                )
+            if cache and name:
+                return self._cached_query(
+                    name, normalized_query, statements, bucket_ids, starttime, endtime
+                )
+            return self._run_query(name, statements, starttime, endtime)
+
+        if self._query_executor is None or len(timeperiods) < 2:
+            return [run(timeperiod) for timeperiod in timeperiods]
+        return list(self._query_executor.map(run, timeperiods))
+
+    def _run_query(
+        self,
+        name: str,
+        statements: List[str],
+        starttime: datetime,
+        endtime: datetime,
+        db=None,
+    ) -> Any:
+        """Like aw_query.query2.query, but for a query already split into statements"""
+        if db is None:
+            db = self.db
+        # The parse tree refers to the values of variables at the time of
+        # parsing, so statements have to be parsed as they are interpreted.
+        namespace = query2.create_namespace()
+        namespace["NAME"] = name
+        namespace["STARTTIME"] = starttime.isoformat()
+        namespace["ENDTIME"] = endtime.isoformat()
+        for statement in statements:
+            var, val = query2.parse(statement, namespace)
+            query2.interpret(var, val, namespace, db)
+        return query2.get_return(namespace)
+
+    def _cached_query(
+        self,
+        name: str,
+        query: str,
+        statements: List[str],
+        bucket_ids: Set[str],
+        starttime: datetime,
+        endtime: datetime,
+    ) -> Any:
+        key = (name, query, starttime, endtime)
+        # Taken before running the query, so that writes made while it runs
+        # invalidate the result
+        versions = {bid: self._versions.get(bid) for bid in bucket_ids}
+        cached = self._query_cache.get(key)
+        if cached is not None:
+            cached_versions, cached_result = cached
+            # Storages round the endtime up to the next millisecond and include
+            # events starting at it
+            horizon = endtime + timedelta(milliseconds=2)
+            if self._cache_valid(cached_versions, bucket_ids, horizon):
+                if cached_versions != versions:
+                    self._query_cache.update_versions(key, versions)
+                return cached_result
+        result = self._run_query(name, statements, starttime, endtime)
+        self._query_cache.put(key, versions, result)
         return result
 
-    # TODO: Right now the log format on disk has to be JSON, this is hard to read by humans...
-    def get_log(self):
-        """Get the server log in json format"""
-        payload = []
-        with open(get_log_file_path()) as log_file:
-            for line in log_file.readlines()[::-1]:
-                payload.append(json.loads(line))
-        return payload, 200
+    def _cache_valid(
+        self, versions: Dict[str, int], bucket_ids: Set[str], time: datetime
+    ) -> bool:
+        """Check that no events before time were written to the buckets since versions"""
+        return set(versions) == bucket_ids and all(
+            self._versions.unchanged_before(bid, version, time)
+            for bid, version in versions.items()
+        )
+
+    def _incremental_query(
+        self,
+        name: str,
+        query: str,
+        statements: List[str],
+        bucket_ids: Set[str],
+        kind: Kind,
+        starttime: datetime,
+        endtime: datetime,
+    ) -> Any:
+        split = self._find_split(bucket_ids)
+        if split is None or split <= starttime:
+            return self._cached_query(
+                name, query, statements, bucket_ids, starttime, endtime
+            )
+        key = ("incremental", name, query, starttime, endtime)
+        versions = {bid: self._versions.get(bid) for bid in bucket_ids}
+        cached = self._query_cache.get(key)
+        if cached is not None:
+            cached_versions, (cached_split, before) = cached
+            if split - cached_split < RESPLIT_INTERVAL and (
+                self._cache_valid(cached_versions, bucket_ids, cached_split)
+            ):
+                if cached_versions != versions:
+                    self._query_cache.update_versions(key, versions)
+                split = cached_split
+            else:
+                cached = None
+        if cached is None:
+            before = self._run_query(
+                name,
+                statements,
+                starttime,
+                endtime,
+                PartitionView(self.db, split, before=True),
+            )
+            self._query_cache.put(key, versions, (split, before))
+        after = self._run_query(
+            name,
+            statements,
+            starttime,
+            endtime,
+            PartitionView(self.db, split, before=False),
+        )
+        return merge_results(kind, before, after)
+
+    def _find_split(self, bucket_ids: Set[str]) -> Optional[datetime]:
+        """
+        Find where to split the events of the buckets for incremental queries.
+
+        The split is at or before the start of the last event of each bucket,
+        as that event is extended by heartbeats, and no event may span it.
+        """
+        splits = []
+        for bucket_id in bucket_ids:
+            last_events = self.db[bucket_id].get(limit=1)
+            if len(last_events) > 0:
+                splits.append(last_events[0].timestamp)
+        if not splits:
+            return None
+        split = min(splits)
+        moved = True
+        while moved:
+            moved = False
+            for bucket_id in bucket_ids:
+                bucket = self.db[bucket_id]
+                for event in bucket.get(-1, split, split):
+                    # Storages may have trimmed the event to the split
+                    if event.id is not None:
+                        event = bucket.get_by_id(event.id) or event
+                    if event.timestamp < split < event.timestamp + event.duration:
+                        split = event.timestamp
+                        moved = True
+        return split
+
+    def get_rollups(
+        self,
+        resolution: str,
+        key: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        bucket_ids: Optional[List[str]] = None,
+        hostname: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Get the time spent on each value of a data key per hour or day.
+
+        Durations are summed over the given buckets (all buckets by default),
+        optionally only those of a host. Returns an event for every period and
+        value, with the data key and value as data.
+        """
+        if resolution not in RESOLUTIONS:
+            raise BadRequest(
+                "InvalidResolution",
+                f"Resolution must be one of {', '.join(RESOLUTIONS)}",
+            )
+        if key not in self._rollups.keys:
+            raise BadRequest(
+                "InvalidKey",
+                f"There are no rollups for {key}, only for {', '.join(self._rollups.keys)}",
+            )
+        if bucket_ids is None:
+            bucket_ids = list(self._buckets)
+        for bucket_id in bucket_ids:
+            if bucket_id not in self._buckets:
+                raise NotFound("NoSuchBucket", f"There's no bucket named {bucket_id}")
+        if hostname is not None:
+            bucket_ids = [
+                bid for bid in bucket_ids if self._buckets[bid]["hostname"] == hostname
+            ]
+        for bucket_id in bucket_ids:
+            if not self._rollups.is_built(bucket_id):
+                self._rebuild_rollups(bucket_id)
+        return [
+            e.to_json_dict()
+            for e in self._rollups.get(bucket_ids, resolution, key, start, end)
+        ]
+
+    def rebuild_rollups(self, bucket_ids: Optional[List[str]] = None) -> None:
+        """Recompute the rollups of the buckets (all by default) from their events"""
+        for bucket_id in bucket_ids if bucket_ids is not None else list(self._buckets):
+            self._rebuild_rollups(bucket_id)
+
+    @check_bucket_exists
+    def _rebuild_rollups(self, bucket_id: str) -> None:
+        logger.info(f"Rebuilding rollups for bucket '{bucket_id}'")
+        # Keeps heartbeats from changing the last event while the bucket is read
+        with self._heartbeat_lock(bucket_id):
+            self._rollups.rebuild(bucket_id, self.iter_events(bucket_id))
+
+    def apply_retention(self, now: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Downsample old events according to the retention policies of the bucket
+        types (see aw_server.retention).
+
+        Returns the number of events removed from each bucket that has a policy.
+        """
+        if now is None:
+            now = datetime.now(timezone.utc)
+        removed = {}  # type: Dict[str, int]
+        for bucket_id, metadata in list(self._buckets.items()):
+            tiers = self._retention.policy(metadata["type"])
+            if not tiers:
+                continue
+            if any(
+                self._retention.watermark(bucket_id, tier.resolution) is None
+                for tier in tiers
+            ):
+                # There's nothing to downsample before the oldest event
+                oldest = min(
+                    (e.timestamp for e in self.iter_events(bucket_id)), default=now
+                )
+                for tier in tiers:
+                    if self._retention.watermark(bucket_id, tier.resolution) is None:
+                        self._retention.set_watermark(
+                            bucket_id,
+                            tier.resolution,
+                            floor_time(oldest, tier.resolution),
+                        )
+            removed[bucket_id] = 0
+            # Events old enough for a coarser tier are downsampled by it directly
+            for tier, coarser in zip(tiers, tiers[1:] + [None]):
+                since = (
+                    floor_time(now - coarser.age, coarser.resolution)
+                    if coarser
+                    else None
+                )
+                removed[bucket_id] += self._apply_tier(bucket_id, tier, now, since)
+        return removed
+
+    def _retention_loop(self) -> None:
+        while not self._stop_retention.wait(self.retention_interval):
+            try:
+                removed = self.apply_retention()
+                if any(removed.values()):
+                    logger.info(f"Downsampled old events, removed {removed}")
+            except Exception:
+                logger.exception("Failed to downsample old events")
+
+    @check_bucket_exists
+    def _apply_tier(
+        self, bucket_id: str, tier: Tier, now: datetime, since: Optional[datetime]
+    ) -> int:
+        cutoff = floor_time(now - tier.age, tier.resolution)
+        start = self._retention.watermark(bucket_id, tier.resolution)
+        if start is not None and since is not None:
+            start = max(start, since)
+        removed = 0
+        while start is not None and start < cutoff:
+            if self._stop_retention.is_set():
+                break
+            end = min(floor_time(start, CHUNK) + CHUNK, cutoff)
+            removed += self._downsample(bucket_id, start, end, tier.resolution)
+            self._retention.set_watermark(bucket_id, tier.resolution, end)
+            start = end
+        return removed
+
+    def _downsample(
+        self, bucket_id: str, start: datetime, end: datetime, resolution: timedelta
+    ) -> int:
+        """Downsample the events starting in [start, end), returns the number of events removed"""
+        # Keeps heartbeats from changing the last event while it might be rewritten
+        with self._heartbeat_lock(bucket_id):
+            self._flush_heartbeat(bucket_id)
+            bucket = self.db[bucket_id]
+            events = []
+            for event in bucket.get(-1, start, end):
+                if event.timestamp <= start or event.timestamp + event.duration >= end:
+                    # Storages may have trimmed the event to the range
+                    event = bucket.get_by_id(event.id) or event
+                if start <= event.timestamp < end:
+                    events.append(event)
+            merged, remainders = downsample(events, start, end, resolution)
+            written = merged + remainders
+
+            def fields(e: Event):
+                return (e.timestamp, e.duration, json.dumps(e.data, sort_keys=True))
+
+            if sorted(map(fields, events)) == sorted(map(fields, written)):
+                return 0
+            # Insert before deleting, so that an interruption can't lose time
+            bucket.insert(written)
+            for event in events:
+                bucket.delete(event.id)
+            # Not _record_write, the written events don't have to be downsampled again
+            self._versions.bump(bucket_id, start)
+            self._rollups.remove(bucket_id, events)
+            self._rollups.add(bucket_id, written)
+            self._event_counts.remove(bucket_id, events)
+            self._event_counts.add(bucket_id, written)
+            last_event = self.last_event.get(bucket_id)
+            if last_event is not None and last_event.timestamp < end:
+                self.last_event.pop(bucket_id)
+            self._refresh_last_updated(bucket_id)
+            return len(events) - len(written)
+
+    def get_log(
+        self,
+        limit: int = DEFAULT_LOG_LIMIT,
+        cursor: Optional[str] = None,
+        level: Optional[str] = None,
+        since: Optional[datetime] = None,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Get the server log, newest record first.
+
+        Returns up to limit records of at least level (like "warning"), logged
+        at or after since, and a cursor for the older records (None if there are none).
+        """
+        if not 0 < limit <= MAX_LOG_LIMIT:
+            raise BadRequest(
+                "InvalidLimit", f"Limit must be between 1 and {MAX_LOG_LIMIT}"
+            )
+        levelno = None
+        if level is not None:
+            levelno = logging.getLevelName(level.upper())
+            if not isinstance(levelno, int):
+                raise BadRequest("InvalidLevel", f"Unknown log level {level}")
+        try:
+            return log_tail.tail(
+                log_tail.log_files("aw-server", self.testing),
+                limit,
+                cursor,
+                levelno,
+                since,
+            )
+        except log_tail.InvalidCursor as e:
+            raise BadRequest("InvalidCursor", str(e))
 
     def get_setting(self, key):
         """Get a setting"""
@@ -369,6 +1383,8 @@ class ServerAPI:
     def set_setting(self, key, value):
         """Set a setting"""
         self.settings[key] = value
+        if key == "classes":
+            self._rollups.set_classes(parse_classes(value))
         return value
 
     def log_manual_activity(self, event_data: Any, bucket_id: Optional[str] = None,
@@ -395,7 +1411,7 @@ class ServerAPI:
             bucket_id = f"manual_{hostname}"
 
         # Ensure bucket exists
-        if bucket_id not in self.db.buckets():
+        if bucket_id not in self._buckets:
             self.create_bucket(
                 bucket_id,
                 event_type=MANUAL_ACTIVITY_EVENT_TYPE,
@@ -422,7 +1438,7 @@ class ServerAPI:
             hostname = info["hostname"]
         if bucket_id is None:
             bucket_id = f"microsurvey_{hostname}"
-        if bucket_id not in self.db.buckets():
+        if bucket_id not in self._buckets:
             self.create_bucket(bucket_id, event_type=MICROSURVEY_EVENT_TYPE, client=client, hostname=hostname)
         if isinstance(event_data, dict):
             events = [Event(**event_data)]
@@ -436,12 +1452,14 @@ class ServerAPI:
         """Initiates a data synchronization with Firebase."""
         if sync_type == "full":
             await self.synchronizer.full_sync()
+            self.refresh_buckets()
             return {"status": "success", "message": "Tam senkronizasyon başlatıldı."}
         elif sync_type == "upload" and bucket_id:
             await self.synchronizer.sync_events_to_firebase(bucket_id)
             return {"status": "success", "message": f"Kova {bucket_id} Firebase'e yüklendi."}
         elif sync_type == "download":
             await self.synchronizer.sync_from_firebase()
+            self.refresh_buckets()
             return {"status": "success", "message": "Firebase'den veriler indirildi."}
         else:
             return {"status": "error", "message": "Geçersiz senkronizasyon türü veya eksik kova ID'si."}
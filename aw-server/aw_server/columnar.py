@@ -0,0 +1,163 @@
+"""
+Compact columnar format for bucket exports.
+
+An alternative to the JSON export format that is much smaller for typical
+watcher data, where the same app names and window titles repeat over and over.
+
+The export is a zip archive containing a manifest.json with the metadata of
+every bucket, and for each bucket (in a directory named by its index):
+
+ - timestamp: event timestamps as int64 microseconds since the epoch,
+   delta-encoded against the previous event
+ - duration: event durations in seconds as float64
+ - values.json: list of every distinct value found in the event data
+ - data/<n>: for the n:th data key in the manifest, a uint32 per event with
+   the index+1 of its value in values.json, or 0 if the event lacks the key
+
+Numeric columns are little-endian.
+"""
+
+import json
+import sys
+import zipfile
+from array import array
+from datetime import datetime, timedelta, timezone
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+)
+
+FORMAT_NAME = "aw-columnar"
+FORMAT_VERSION = 1
+
+# Columnar exports are zip files, which is used to tell them apart from JSON
+ZIP_MAGIC = b"PK\x03\x04"
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _array_to_bytes(a: array) -> bytes:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+def _array_from_bytes(typecode: str, b: bytes) -> array:
+    a = array(typecode)
+    a.frombytes(b)
+    if sys.byteorder == "big":
+        a.byteswap()
+    return a
+
+
+def _parse_timestamp(timestamp: Any) -> datetime:
+    if isinstance(timestamp, datetime):
+        return timestamp
+    return datetime.fromisoformat(timestamp)
+
+
+def write_columnar(
+    f: IO[bytes], buckets: Iterable[Tuple[Dict[str, Any], Iterable[Dict[str, Any]]]]
+) -> None:
+    """Write (bucket metadata, events in export format) pairs as a columnar export"""
+    manifest = []
+    with zipfile.ZipFile(f, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        for i, (metadata, events) in enumerate(buckets):
+            timestamps = array("q")
+            durations = array("d")
+            keys = {}  # type: Dict[str, int]
+            columns = []  # type: List[array]
+            values = {}  # type: Dict[str, int]
+            previous = 0
+            for n, event in enumerate(events):
+                timestamp = (
+                    _parse_timestamp(event["timestamp"]) - _EPOCH
+                ) // _MICROSECOND
+                timestamps.append(timestamp - previous)
+                previous = timestamp
+                durations.append(float(event.get("duration", 0)))
+                for key, value in event.get("data", {}).items():
+                    if key not in keys:
+                        keys[key] = len(columns)
+                        columns.append(array("I", [0]) * n)
+                    value_str = json.dumps(value, sort_keys=True)
+                    if value_str not in values:
+                        values[value_str] = len(values)
+                    columns[keys[key]].append(values[value_str] + 1)
+                # Events without a key get 0 in its column
+                for column in columns:
+                    if len(column) == n:
+                        column.append(0)
+
+            path = str(i)
+            z.writestr(f"{path}/timestamp", _array_to_bytes(timestamps))
+            z.writestr(f"{path}/duration", _array_to_bytes(durations))
+            z.writestr(f"{path}/values.json", "[" + ", ".join(values) + "]")
+            for n, column in enumerate(columns):
+                z.writestr(f"{path}/data/{n}", _array_to_bytes(column))
+            manifest.append(
+                {
+                    "metadata": metadata,
+                    "path": path,
+                    "events": len(timestamps),
+                    "keys": list(keys),
+                }
+            )
+        z.writestr(
+            "manifest.json",
+            json.dumps(
+                {"format": FORMAT_NAME, "version": FORMAT_VERSION, "buckets": manifest}
+            ),
+        )
+
+
+def iter_columnar(f: IO[bytes]) -> Iterator[Tuple]:
+    """
+    Read a columnar export from a seekable file.
+
+    Yields the same items as json_stream.iter_export: ("bucket", bucket_metadata)
+    for every bucket, followed by ("event", bucket_id, event) for each of its events.
+    """
+    with zipfile.ZipFile(f) as z:
+        manifest = json.loads(z.read("manifest.json"))
+        if manifest.get("format") != FORMAT_NAME:
+            raise ValueError("Not a columnar export")
+        if manifest.get("version") != FORMAT_VERSION:
+            raise ValueError(
+                f"Unsupported columnar export version {manifest.get('version')}"
+            )
+        for bucket in manifest["buckets"]:
+            metadata = bucket["metadata"]
+            path = bucket["path"]
+            yield ("bucket", metadata)
+
+            timestamps = _array_from_bytes("q", z.read(f"{path}/timestamp"))
+            durations = _array_from_bytes("d", z.read(f"{path}/duration"))
+            values = [None] + json.loads(z.read(f"{path}/values.json"))
+            columns = [
+                (key, _array_from_bytes("I", z.read(f"{path}/data/{n}")))
+                for n, key in enumerate(bucket["keys"])
+            ]
+            timestamp = 0
+            for n in range(bucket["events"]):
+                timestamp += timestamps[n]
+                yield (
+                    "event",
+                    metadata["id"],
+                    {
+                        "timestamp": (_EPOCH + timestamp * _MICROSECOND).isoformat(),
+                        "duration": durations[n],
+                        "data": {
+                            key: values[column[n]]
+                            for key, column in columns
+                            if column[n]
+                        },
+                    },
+                )
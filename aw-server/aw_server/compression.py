@@ -0,0 +1,89 @@
+"""
+Compression of responses, negotiated with Accept-Encoding.
+
+Responses of a compressible type are compressed with brotli (if installed,
+pip install brotli) or gzip. Streamed responses, like exports, are compressed
+a chunk at a time as they are generated, and each chunk is flushed so that
+clients can start reading before the response is complete.
+"""
+
+import zlib
+from typing import Callable, Iterable, Iterator
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None  # type: ignore
+
+# Responses smaller than this aren't worth compressing
+MIN_SIZE = 1024
+
+COMPRESSIBLE_TYPES = (
+    "application/json",
+    "application/javascript",
+    "image/svg+xml",
+    "text/",
+)
+
+# Moderate levels, responses are generated on every request and mostly sent
+# over fast connections, so compression time matters more than size
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def _compressor(encoding: str) -> Callable[[bytes, bool], bytes]:
+    """Returns a function compressing a chunk, which finishes the stream if last is set"""
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+        def compress_br(chunk: bytes, last: bool) -> bytes:
+            data = compressor.process(chunk)
+            return data + (compressor.finish() if last else compressor.flush())
+
+        return compress_br
+
+    # wbits=31 gives the gzip format
+    compressobj = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    def compress_gzip(chunk: bytes, last: bool) -> bytes:
+        data = compressobj.compress(chunk)
+        return data + compressobj.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    return compress_gzip
+
+
+def _compress_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    compress = _compressor(encoding)
+    for chunk in chunks:
+        if chunk:
+            yield compress(chunk, False)
+    yield compress(b"", True)
+
+
+def compress_response(response: Response) -> Response:
+    """Compress the response if the client accepts an encoding and it's worth it"""
+    response.vary.add("Accept-Encoding")
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or "Content-Encoding" in response.headers
+        or not (response.mimetype or "").startswith(COMPRESSIBLE_TYPES)
+    ):
+        return response
+    encoding = request.accept_encodings.best_match(
+        ["br", "gzip"] if brotli is not None else ["gzip"]
+    )
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_chunks(response.iter_encoded(), encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(_compressor(encoding)(data, True))
+    response.headers["Content-Encoding"] = encoding
+    return response
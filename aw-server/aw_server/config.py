@@ -6,16 +6,49 @@ host = "localhost"
 port = "5600"
 storage = "peewee"
 cors_origins = ""
+# Seconds that merged heartbeats may be kept in memory before being written
+# to storage, 0 writes every heartbeat immediately
+heartbeat_flush_interval = 0
+# Number of timeperiods of a query that are evaluated in parallel
+query_workers = 4
+# Data keys to keep hourly and daily rollups of ("$category" for categories)
+rollup_keys = ["app", "status", "$category"]
+# Seconds between runs of the downsampling of old events, 0 disables it
+retention_interval = 3600
+# "development" runs the Werkzeug development server, "production" an embedded
+# production WSGI server (needs cheroot to be installed) with a pool of
+# server_threads threads, at most server_queue_size connections waiting for a
+# thread and keep-alive connections closed after keepalive_timeout idle seconds
+server_mode = "development"
+server_threads = 16
+server_queue_size = 100
+keepalive_timeout = 10
 
 [server.custom_static]
 
+# Downsampling of old events per bucket type, as tiers of [age in days,
+# resolution in seconds]. For example, currentwindow = [[90, 60], [365, 3600]]
+# keeps window events for 90 days, then at 1 minute resolution for a year
+# and hourly after that. Types with dots need quotes, like "os.hid.input".
+[server.retention]
+
 [server-testing]
 host = "localhost"
 port = "5666"
 storage = "peewee"
 cors_origins = ""
+heartbeat_flush_interval = 0
+query_workers = 4
+rollup_keys = ["app", "status", "$category"]
+retention_interval = 3600
+server_mode = "development"
+server_threads = 16
+server_queue_size = 100
+keepalive_timeout = 10
 
 [server-testing.custom_static]
+
+[server-testing.retention]
 """.strip()
 
 config = load_config_toml("aw-server", default_config)
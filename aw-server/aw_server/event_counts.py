@@ -0,0 +1,165 @@
+import math
+import threading
+from datetime import datetime
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+)
+
+from aw_core.models import Event
+
+# Events are counted per period of this many seconds by their timestamp, so
+# counts over ranges aligned to it (like days, in any timezone with a whole hour
+# UTC offset) can be answered without going to storage
+COUNT_PERIOD = 3600
+
+
+def _period(timestamp: datetime) -> int:
+    return math.floor(timestamp.timestamp() / COUNT_PERIOD)
+
+
+def is_aligned(timestamp: Optional[datetime]) -> bool:
+    """Whether a bound of a range is at the start of a period (or unbounded)"""
+    return timestamp is None or timestamp.timestamp() % COUNT_PERIOD == 0
+
+
+class _PeriodCounts:
+    """
+    Event counts per period of a bucket, kept in a Fenwick tree so that both
+    updating a count and summing the counts of a range take O(log n).
+    """
+
+    def __init__(self, periods: Iterable[int]) -> None:
+        counts = {}  # type: Dict[int, int]
+        for period in periods:
+            counts[period] = counts.get(period, 0) + 1
+        self.first = min(counts, default=0)
+        self.counts = [0] * (max(counts) - self.first + 1 if counts else 0)
+        for period, count in counts.items():
+            self.counts[period - self.first] = count
+        self._build()
+
+    def _build(self) -> None:
+        # The tree is 1-indexed: tree[i] holds the sum of the counts (i - lowbit(i), i]
+        self.tree = [0] + self.counts
+        for i in range(1, len(self.tree)):
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def add(self, period: int, delta: int) -> None:
+        if not self.counts:
+            self.first = period
+            self.counts = [0]
+            self._build()
+        elif period < self.first:
+            # Grow to the front, like when older events are imported
+            grow = max(self.first - period, len(self.counts))
+            self.counts = [0] * grow + self.counts
+            self.first -= grow
+            self._build()
+        elif period >= self.first + len(self.counts):
+            grow = max(period - self.first - len(self.counts) + 1, len(self.counts))
+            self.counts += [0] * grow
+            self._build()
+        i = period - self.first
+        self.counts[i] += delta
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, period: int) -> int:
+        """Sum of the counts of the periods before period"""
+        i = min(max(period - self.first, 0), len(self.counts))
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def count(self, start: int, end: int) -> int:
+        return max(self._prefix(end) - self._prefix(start), 0)
+
+
+class EventCounts:
+    """
+    Cached event counts of the buckets, kept up to date as events are written.
+
+    The total count of a bucket is cached once it has been read from storage.
+    The counts per period are built (from all events of the bucket) the first
+    time a count over a range is requested.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._totals = {}  # type: Dict[str, int]
+        self._periods = {}  # type: Dict[str, _PeriodCounts]
+
+    def total(self, bucket_id: str) -> Optional[int]:
+        with self._lock:
+            return self._totals.get(bucket_id)
+
+    def set_total(self, bucket_id: str, count: int) -> None:
+        with self._lock:
+            self._totals[bucket_id] = count
+
+    def is_built(self, bucket_id: str) -> bool:
+        with self._lock:
+            return bucket_id in self._periods
+
+    def build(self, bucket_id: str, timestamps: Iterable[datetime]) -> None:
+        """Count the events of a bucket per period, from the timestamps of all events"""
+        periods = [_period(timestamp) for timestamp in timestamps]
+        with self._lock:
+            self._periods[bucket_id] = _PeriodCounts(periods)
+            self._totals[bucket_id] = len(periods)
+
+    def count(
+        self,
+        bucket_id: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> Optional[int]:
+        """
+        Get the number of events starting in [start, end) of a bucket.
+
+        Returns None if the count isn't cached, or start or end aren't aligned
+        to COUNT_PERIOD.
+        """
+        if start is None and end is None:
+            return self.total(bucket_id)
+        if not (is_aligned(start) and is_aligned(end)):
+            return None
+        with self._lock:
+            if bucket_id not in self._periods:
+                return None
+            counts = self._periods[bucket_id]
+            start_period = _period(start) if start is not None else counts.first
+            end_period = (
+                _period(end) if end is not None else counts.first + len(counts.counts)
+            )
+            return counts.count(start_period, end_period)
+
+    def add(self, bucket_id: str, events: List[Event], delta: int = 1) -> None:
+        with self._lock:
+            if bucket_id in self._totals:
+                self._totals[bucket_id] += delta * len(events)
+            if bucket_id in self._periods:
+                for event in events:
+                    self._periods[bucket_id].add(_period(event.timestamp), delta)
+
+    def remove(self, bucket_id: str, events: List[Event]) -> None:
+        self.add(bucket_id, events, -1)
+
+    def drop(self, bucket_id: str) -> None:
+        with self._lock:
+            self._totals.pop(bucket_id, None)
+            self._periods.pop(bucket_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._totals.clear()
+            self._periods.clear()
@@ -0,0 +1,152 @@
+"""
+Fast JSON serialization of API responses and exports.
+
+Serializes with orjson if it's installed (pip install orjson), which encodes
+datetimes natively, and with the json module otherwise. Datetimes (and dates)
+are encoded as ISO 8601 strings and timedeltas as float seconds. Both give the
+same output as json.dumps with ensure_ascii, compact separators (or an indent
+of 2) and optionally sorted keys. The exception are floats that are NaN or
+infinite, which orjson encodes as null and json as (invalid) NaN and Infinity.
+
+Output that orjson would encode differently from json, like floats that json
+writes in exponent notation, integers over 64 bits and dicts with keys that
+aren't strings, is encoded with json instead.
+"""
+
+import json
+import re
+from datetime import date, timedelta
+from typing import Any, Optional
+
+import flask.json.provider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+# Floats in exponent notation, which orjson writes differently from repr(),
+# which json uses, if preceded by a digit (searching for the digit is slower)
+_EXPONENT = re.compile(rb"e[-0-9]")
+
+# Small floats that orjson writes in decimal notation and repr() in exponent
+# notation. Both can also match in strings, which only costs an unneeded fallback.
+_SMALL_FLOAT = b"0.0000"
+
+# Bytes that can be left after encoding with raw_unicode_escape, see _ensure_ascii
+_PRINTABLE_ASCII = bytes(range(0x7F))
+_ASTRAL = re.compile(rb"\\U([0-9a-f]{8})")
+
+
+def _escape_astral(match: "re.Match") -> bytes:
+    start = match.start()
+    while start and match.string[start - 1] == ord("\\"):
+        start -= 1
+    if (match.start() - start) % 2:
+        # An escaped backslash followed by U
+        return match.group()
+    c = int(match.group(1), 16) - 0x10000
+    return b"\\u%04x\\u%04x" % (0xD800 | (c >> 10), 0xDC00 | (c & 0x3FF))
+
+
+def _ensure_ascii(data: bytes) -> bytes:
+    """Escape the characters that aren't ASCII like json with ensure_ascii does"""
+    # Writes the characters from U+0100 to U+FFFF as \uXXXX like json does,
+    # which is much faster than escaping them one by one
+    data = data.decode().encode("raw_unicode_escape")
+    # Up to U+00FF are left as they are
+    for c in set(data.translate(None, _PRINTABLE_ASCII)):
+        data = data.replace(bytes([c]), b"\\u%04x" % c)
+    # From U+10000 are written as \UXXXXXXXX, and as surrogate pairs by json
+    if b"\\U" in data:
+        data = _ASTRAL.sub(_escape_astral, data)
+    return data
+
+
+def default(obj: Any) -> Any:
+    """Encode the types that JSON has no type for"""
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, timedelta):
+        return obj.total_seconds()
+    # UUIDs, decimals, dataclasses and objects with __html__, like Flask does
+    return flask.json.provider.DefaultJSONProvider.default(obj)
+
+
+def _float_mismatch(data: bytes) -> bool:
+    if _SMALL_FLOAT in data:
+        return True
+    for match in _EXPONENT.finditer(data):
+        if data[match.start() - 1 : match.start()].isdigit():
+            return True
+    return False
+
+
+def dumpb(
+    obj: Any,
+    sort_keys: bool = False,
+    indent: Optional[int] = None,
+    ensure_ascii: bool = True,
+) -> bytes:
+    """Serialize obj to JSON as UTF-8, indent can be None (compact) or 2"""
+    if orjson is not None and indent in (None, 2):
+        option = orjson.OPT_SORT_KEYS if sort_keys else 0
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+        try:
+            data = orjson.dumps(obj, default=default, option=option)
+        except (orjson.JSONEncodeError, TypeError):
+            data = None
+        if data is not None and not _float_mismatch(data):
+            if ensure_ascii and (not data.isascii() or b"\x7f" in data):
+                data = _ensure_ascii(data)
+            return data
+    return json.dumps(
+        obj,
+        default=default,
+        sort_keys=sort_keys,
+        indent=indent,
+        separators=(",", ":") if indent is None else None,
+        ensure_ascii=ensure_ascii,
+    ).encode()
+
+
+def dumps(
+    obj: Any,
+    sort_keys: bool = False,
+    indent: Optional[int] = None,
+    ensure_ascii: bool = True,
+) -> str:
+    """Serialize obj to a JSON string, see dumpb"""
+    return dumpb(obj, sort_keys, indent, ensure_ascii).decode()
+
+
+class FastJSONProvider(flask.json.provider.DefaultJSONProvider):
+    """JSON provider of the Flask app that serializes with dumpb"""
+
+    default = staticmethod(default)  # type: ignore
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        indent = kwargs.get("indent")
+        separators = kwargs.get("separators")
+        if set(kwargs) - {"sort_keys", "ensure_ascii", "indent", "separators"} or (
+            (indent, separators) not in [(None, (",", ":")), (2, None)]
+        ):
+            # Other formats, like the default separators with spaces
+            return super().dumps(obj, **kwargs)
+        return dumps(
+            obj,
+            kwargs.get("sort_keys", self.sort_keys),
+            indent,
+            kwargs.get("ensure_ascii", self.ensure_ascii),
+        )
+
+    def response(self, *args: Any, **kwargs: Any) -> flask.Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        pretty = (self.compact is None and self._app.debug) or self.compact is False
+        # Avoids encoding the serialized string again, unlike the default implementation
+        return self._app.response_class(
+            dumpb(obj, self.sort_keys, 2 if pretty else None, self.ensure_ascii)
+            + b"\n",
+            mimetype=self.mimetype,
+        )
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from aw_core.models import Event
 from aw_datastore.storages.abstract import Storage, EventDB
@@ -35,6 +35,30 @@ class FirestoreEventDB(EventDB):
             events.append(Event(**data))
         return events
 
+    def get_before(self, limit: int, before: Optional[Tuple[datetime, Any]], start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Event]:
+        """
+        Get up to limit events ordered before the (timestamp, id) key before
+        (if any), newest first. A keyset page: the query starts right after the
+        key in the (timestamp, id) index instead of skipping the newer events.
+        """
+        query = self.collection_ref.order_by(u'timestamp', direction=u'DESCENDING').order_by(u'id', direction=u'DESCENDING')
+        if start:
+            query = query.where(u'timestamp', u'>=', start)
+        if end:
+            query = query.where(u'timestamp', u'<', end)
+        if before is not None:
+            # Timestamps are stored as ISO 8601 strings, see insert
+            query = query.start_after({u'timestamp': before[0].isoformat(), u'id': before[1]})
+        query = query.limit(limit)
+
+        events = []
+        for doc in query.stream():
+            data = doc.to_dict()
+            if 'timestamp' in data and hasattr(data['timestamp'], 'replace'):
+                data['timestamp'] = data['timestamp'].replace(tzinfo=None) # remove timezone info
+            events.append(Event(**data))
+        return events
+
     def get_by_id(self, event_id: int) -> Optional[Event]:
         doc_ref = self.collection_ref.document(str(event_id))
         doc = doc_ref.get()
@@ -201,5 +225,9 @@ class FirestoreStorage(Storage):
     def delete_bucket(self, bucket_id: str) -> None:
         self.buckets_collection_ref.document(bucket_id).delete()
 
+    def get_events_before(self, bucket_id: str, limit: int, before: Optional[Tuple[datetime, Any]], starttime: Optional[datetime] = None, endtime: Optional[datetime] = None) -> List[Event]:
+        # Used for keyset pagination by ServerAPI.get_events_page
+        return self[bucket_id].get_before(limit, before, starttime, endtime)
+
     def __getitem__(self, bucket_id: str) -> FirestoreEventDB:
         return FirestoreEventDB(self.user_id, bucket_id, self.anonymize_data) 
\ No newline at end of file
@@ -0,0 +1,238 @@
+"""
+Incremental evaluation of queries over timeperiods that are still open.
+
+The events of a period are split at a point in time into the events starting
+before it and the events starting after it. The query is evaluated on each part
+separately and the two results are merged. As long as no events before the
+split are written to, the result for that part stays the same, so only the part
+after the split (the last few minutes) has to be re-evaluated.
+
+This is only correct for queries that compute their result from the events
+independently of each other, so the functions a query may use are limited.
+The RETURN value has to be built by transforms with results that can be
+merged, such as sum_durations and merge_events_by_keys.
+Transforms that look at neighbouring events, like flood, can't fill the gap
+between the last event before the split and the first one after it.
+"""
+
+import json
+import re
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.models import Event
+from aw_transform import sort_by_duration
+
+# The result for the events before the split is recomputed with a later split
+# once the events after the split span more than this
+RESPLIT_INTERVAL = timedelta(minutes=15)
+
+# Functions that return the events of their event arguments in a fixed order
+ORDERED_EVENT_FUNCTIONS = {
+    "query_bucket": "desc",
+    "flood": "asc",
+    "filter_period_intersect": "asc",
+    "period_union": "asc",
+    "sort_by_timestamp": "asc",
+}
+
+# Functions that filter or modify each event of their first argument
+EVENT_FUNCTIONS = {
+    "filter_keyvals",
+    "filter_keyvals_regex",
+    "exclude_keyvals",
+    "categorize",
+    "tag",
+    "split_url_events",
+    "simplify_window_titles",
+}
+
+CONSTANT_FUNCTIONS = {"find_bucket"}
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+_CALL = re.compile(r"^([A-Za-z_][A-Za-z0-9_]*)\s*\((.*)\)$", re.S)
+
+# How a value can be merged from the values for the two parts of a period:
+#  ("const",): the same for both parts
+#  ("events", order): concatenated events, ordered "asc" or "desc" by time
+#  ("sum",): durations that are added
+#  ("merged", order): events merged by their data, from events in order
+#  ("sorted", order): like merged but sorted by duration
+#  ("dict", {key: kind}): merged per key
+Kind = Tuple[Any, ...]
+
+
+def _split_top_level(s: str, separator: str) -> List[str]:
+    """Split on separator where it isn't inside a string or brackets"""
+    parts = []
+    depth = 0
+    quote = None  # type: Optional[str]
+    start = 0
+    i = 0
+    while i < len(s):
+        char = s[i]
+        if quote:
+            if char == "\\":
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "([{":
+            depth += 1
+        elif char in ")]}":
+            depth -= 1
+        elif char == separator and depth == 0:
+            parts.append(s[start:i])
+            start = i + 1
+        i += 1
+    parts.append(s[start:])
+    return parts
+
+
+def _kind(expr: str, variables: Dict[str, Optional[Kind]]) -> Optional[Kind]:
+    expr = expr.strip()
+    if not expr:
+        return None
+    if expr[0] in "\"'" or expr[0].isdigit() or expr in ("true", "false"):
+        return ("const",)
+    if expr[0] == "[":
+        items = [item for item in _split_top_level(expr[1:-1], ",") if item.strip()]
+        if all(_kind(item, variables) == ("const",) for item in items):
+            return ("const",)
+        return None
+    if expr[0] == "{":
+        kinds = {}
+        for item in _split_top_level(expr[1:-1], ","):
+            if not item.strip():
+                continue
+            key, value = (_split_top_level(item, ":") + [""])[:2]
+            value_kind = _kind(value, variables)
+            if value_kind is None:
+                return None
+            kinds[key.strip()[1:-1]] = value_kind
+        if all(kind == ("const",) for kind in kinds.values()):
+            return ("const",)
+        return ("dict", kinds)
+    if _IDENTIFIER.match(expr):
+        return variables.get(expr)
+    match = _CALL.match(expr)
+    if not match:
+        return None
+    function = match.group(1)
+    args = [_kind(arg, variables) for arg in _split_top_level(match.group(2), ",")]
+    if None in args:
+        return None
+    constant_args = [arg == ("const",) for arg in args]
+    event_args = [arg[0] == "events" for arg in args]
+    if function in CONSTANT_FUNCTIONS and all(constant_args):
+        return ("const",)
+    if function == "query_bucket" and all(constant_args):
+        return ("events", "desc")
+    if function in ORDERED_EVENT_FUNCTIONS and any(event_args):
+        if all(c or e for c, e in zip(constant_args, event_args)):
+            return ("events", ORDERED_EVENT_FUNCTIONS[function])
+    if function in EVENT_FUNCTIONS and event_args[0] and all(constant_args[1:]):
+        return args[0]
+    if function == "sum_durations" and len(args) == 1 and args[0][0] == "events":
+        return ("sum",)
+    if function == "merge_events_by_keys" and len(args) == 2:
+        if args[0][0] == "events" and args[1] == ("const",):
+            return ("merged", args[0][1])
+    if function == "sort_by_duration" and len(args) == 1 and args[0][0] == "merged":
+        return ("sorted", args[0][1])
+    return None
+
+
+def result_kind(statements: List[str]) -> Optional[Kind]:
+    """
+    Find out how the RETURN value of a query split into statements can be merged.
+
+    Returns None if the query can't be evaluated incrementally.
+    """
+    variables = {
+        "NAME": ("const",),
+        "STARTTIME": ("const",),
+        "ENDTIME": ("const",),
+    }  # type: Dict[str, Optional[Kind]]
+    for statement in statements:
+        separator = statement.find("=")
+        var = statement[:separator].strip()
+        if separator < 0 or not _IDENTIFIER.match(var):
+            return None
+        variables[var] = _kind(statement[separator + 1 :], variables)
+    return variables.get("RETURN")
+
+
+def _merge_events(events: List[Event]) -> List[Event]:
+    merged = {}  # type: Dict[str, Event]
+    for event in events:
+        key = json.dumps(event.data, sort_keys=True)
+        if key not in merged:
+            merged[key] = Event(
+                timestamp=event.timestamp, duration=event.duration, data=event.data
+            )
+        else:
+            merged[key].duration += event.duration
+    return list(merged.values())
+
+
+def merge_results(kind: Kind, before: Any, after: Any) -> Any:
+    """Merge the results for the events before and after the split"""
+    if kind[0] == "const":
+        return after
+    if kind[0] == "sum":
+        return before + after
+    if kind[0] == "dict":
+        return {
+            key: merge_results(kind[1][key], before[key], after[key]) for key in after
+        }
+    first, second = (before, after) if kind[1] == "asc" else (after, before)
+    if kind[0] == "events":
+        return first + second
+    merged = _merge_events(first + second)
+    return sort_by_duration(merged) if kind[0] == "sorted" else merged
+
+
+class _PartitionBucket:
+    def __init__(self, bucket, split: datetime, before: bool) -> None:
+        self.bucket = bucket
+        self.split = split
+        self.before = before
+
+    def metadata(self) -> dict:
+        return self.bucket.metadata()
+
+    def get(
+        self,
+        limit: int = -1,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        events = [
+            e
+            for e in self.bucket.get(-1, starttime, endtime)
+            if (e.timestamp < self.split) == self.before
+        ]
+        return events if limit < 0 else events[:limit]
+
+
+class PartitionView:
+    """Datastore that only shows the events starting before (or from) the split"""
+
+    def __init__(self, db, split: datetime, before: bool) -> None:
+        self.db = db
+        self.split = split
+        self.before = before
+
+    def buckets(self) -> Dict[str, dict]:
+        return self.db.buckets()
+
+    def __getitem__(self, bucket_id: str) -> _PartitionBucket:
+        return _PartitionBucket(self.db[bucket_id], self.split, self.before)
@@ -0,0 +1,50 @@
+import json
+import logging
+from pathlib import Path
+from typing import Dict
+
+from aw_core.dirs import get_data_dir
+from aw_core.models import Event
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatJournal:
+    """
+    Journal of merged heartbeats that have not yet been written to storage.
+
+    Used by the write-behind mode of ServerAPI.heartbeat so that the pending
+    events can be recovered if the server is killed before it could flush them.
+    """
+
+    def __init__(self, testing: bool):
+        filename = (
+            "heartbeat-journal.json"
+            if not testing
+            else "heartbeat-journal-testing.json"
+        )
+        self.journal_file = Path(get_data_dir("aw-server")) / filename
+
+    def load(self) -> Dict[str, Event]:
+        if not self.journal_file.exists():
+            return {}
+        try:
+            with open(self.journal_file) as f:
+                data = json.load(f)
+            return {bucket_id: Event(**e) for bucket_id, e in data.items()}
+        except (OSError, ValueError, TypeError) as e:
+            logger.warning(f"Could not read heartbeat journal, ignoring it: {e}")
+            return {}
+
+    def save(self, events: Dict[str, Event]) -> None:
+        if not events:
+            self.clear()
+            return
+        with open(self.journal_file, "w") as f:
+            json.dump(
+                {bucket_id: e.to_json_dict() for bucket_id, e in events.items()}, f
+            )
+
+    def clear(self) -> None:
+        if self.journal_file.exists():
+            self.journal_file.unlink()
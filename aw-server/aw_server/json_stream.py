@@ -0,0 +1,145 @@
+"""
+Incremental parsing of bucket exports (as produced by /api/0/export).
+
+Exports of multi-year databases can be several gigabytes, so instead of
+loading the whole document with json.loads the export is read in chunks and
+yielded as a flat sequence of buckets and events.
+"""
+
+import json
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+
+CHUNK_SIZE = 64 * 1024
+
+# Metadata needed to create a bucket before its events can be imported
+REQUIRED_BUCKET_KEYS = ("type", "client", "hostname", "created")
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    """Reads JSON values one at a time from a text stream."""
+
+    def __init__(self, f: IO[str]) -> None:
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what has already been consumed to keep the buffer small
+        self.buf = self.buf[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON input")
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char not in chars:
+            raise ValueError(
+                f"Expected one of '{chars}' at position {self.pos} but found '{char}'"
+            )
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number at the end of the buffer might continue in the next chunk
+                if end < len(self.buf) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def items(self) -> Iterator[str]:
+        """Iterates over the keys of an object, the caller has to consume each value"""
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError("Expected an object key")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def array(self) -> Iterator[Any]:
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def iter_export(
+    f: IO[str],
+) -> Iterator[Union[Tuple[str, Dict[str, Any]], Tuple[str, str, Dict[str, Any]]]]:
+    """
+    Parses an export incrementally.
+
+    Yields ("bucket", bucket_metadata) for every bucket, followed by
+    ("event", bucket_id, event) for each of its events.
+    Bucket metadata is yielded as soon as it is known, so events can be
+    imported without keeping the bucket in memory (as long as the events come
+    after the rest of the bucket metadata, which is the case for exports by
+    aw-server).
+    """
+    reader = _Reader(f)
+    for key in reader.items():
+        if key != "buckets":
+            reader.value()
+            continue
+        for bucket_id in reader.items():
+            metadata = {"id": bucket_id}  # type: Dict[str, Any]
+            buffered_events = []  # type: List[Dict[str, Any]]
+            yielded = False
+            for bucket_key in reader.items():
+                if bucket_key != "events":
+                    metadata[bucket_key] = reader.value()
+                    continue
+                if not yielded and all(k in metadata for k in REQUIRED_BUCKET_KEYS):
+                    yield ("bucket", metadata)
+                    yielded = True
+                for event in reader.array():
+                    if yielded:
+                        yield ("event", metadata["id"], event)
+                    else:
+                        buffered_events.append(event)
+            if not yielded:
+                yield ("bucket", metadata)
+            for event in buffered_events:
+                yield ("event", metadata["id"], event)
@@ -0,0 +1,207 @@
+"""
+Reading the server log from the end, one page of records at a time.
+
+The log files are read backwards in blocks, so the newest records can be
+returned without reading (or parsing) the rest of a log that may be hundreds
+of MB. Records are returned newest first, continuing into the rotated files
+(aw-server_<time>.log.1, .2, ...) and the logs of earlier runs.
+
+Both the human readable format written by aw_core and JSON lines are
+understood. A record in the human readable format can span several lines,
+like when it includes a traceback.
+"""
+
+import json
+import logging
+import os
+import re
+from datetime import datetime
+from typing import (
+    Any,
+    BinaryIO,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.log import _get_latest_log_files
+
+# Number of bytes read at a time, backwards from the end of a file
+LOG_BLOCK_SIZE = 64 * 1024
+
+DEFAULT_LOG_LIMIT = 100
+MAX_LOG_LIMIT = 10000
+
+# Header of a record in the format of aw_core.log._create_human_formatter
+_HEADER = re.compile(
+    rb"^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)(?:,\d+)? \[(\w+)\s*\]: (.*?)(?:  \((.+):(\d+)\))?$"
+)
+_JSON_HEADER = re.compile(
+    rb'"(?:asctime|time|timestamp)": *"([^"]+)".*?"levelname": *"(\w+)"'
+)
+_ROTATED = re.compile(r"^(.*?)(?:\.(\d+))?$")
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def log_files(name: str, testing: bool) -> List[str]:
+    """Paths of the log files of a service, newest first"""
+
+    def key(path: str) -> Tuple[str, int]:
+        base, index = _ROTATED.match(path).groups()  # type: ignore
+        return base, -int(index or 0)
+
+    # Sorting by name alone would put the rotated files (.1, .2, ...) of a
+    # log before it, they are older though
+    return sorted(_get_latest_log_files(name, testing=testing), key=key, reverse=True)
+
+
+def _reverse_lines(f: BinaryIO, end: int) -> Iterator[Tuple[int, bytes]]:
+    """Yield the lines before the offset end, last first, with their offsets"""
+    rest = b""
+    pos = end
+    while pos > 0:
+        size = min(LOG_BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + rest).split(b"\n")
+        # The first line might continue in the previous block
+        rest = lines[0]
+        offset = pos + len(rest) + 1
+        offsets = []
+        for line in lines[1:]:
+            offsets.append(offset)
+            offset += len(line) + 1
+        yield from zip(reversed(offsets), reversed(lines[1:]))
+    yield 0, rest
+
+
+def _header(line: bytes) -> Optional[Tuple[str, str]]:
+    """Time and level of the first line of a record, None for continuation lines"""
+    match = _HEADER.match(line.rstrip(b"\r"))
+    if match is None and line.startswith(b"{"):
+        match = _JSON_HEADER.search(line)
+    if match is None:
+        return None
+    return match.group(1).decode(), match.group(2).decode().upper()
+
+
+def _parse(lines: List[bytes]) -> Dict[str, Any]:
+    first = lines[0].rstrip(b"\r")
+    if first.startswith(b"{"):
+        try:
+            return json.loads(first)
+        except ValueError:
+            pass
+    match = _HEADER.match(first)
+    if match is None:
+        return {"message": b"\n".join(lines).decode(errors="replace")}
+    asctime, levelname, message, name, lineno = match.groups()
+    record = {
+        "asctime": asctime.decode(),
+        "levelname": levelname.decode(),
+        "message": b"\n".join(
+            [message] + [line.rstrip(b"\r") for line in lines[1:]]
+        ).decode(errors="replace"),
+    }  # type: Dict[str, Any]
+    if name is not None:
+        record["name"] = name.decode(errors="replace")
+        record["lineno"] = int(lineno)
+    return record
+
+
+def _records(
+    f: BinaryIO, end: int
+) -> Iterator[Tuple[int, Optional[Tuple[str, str]], List[bytes]]]:
+    """Yield the records before the offset end, last first, with their offsets and headers"""
+    continuation = []  # type: List[bytes]
+    for offset, line in _reverse_lines(f, end):
+        header = _header(line)
+        if header is None:
+            if line.strip() or continuation:
+                continuation.insert(0, line)
+            continue
+        yield offset, header, [line] + continuation
+        continuation = []
+    if any(line.strip() for line in continuation):
+        # Lines without a header at the start of the file
+        yield 0, None, continuation
+
+
+def tail(
+    paths: List[str],
+    limit: int = DEFAULT_LOG_LIMIT,
+    cursor: Optional[str] = None,
+    level: Optional[int] = None,
+    since: Optional[datetime] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    Get up to limit records from the log files (newest first), newest record first.
+
+    Only records of at least level and logged at or after since are returned
+    (since is compared with the local time of the records, like in the log).
+    Returns the records and a cursor to pass to get the records before them,
+    or None if there are none.
+    """
+    end = None  # type: Optional[int]
+    if cursor is not None:
+        try:
+            inode, offset = (int(part) for part in cursor.split(":"))
+        except ValueError:
+            raise InvalidCursor(f"Invalid cursor {cursor!r}")
+        # The files are matched by inode since rotating renames them
+        for i, path in enumerate(paths):
+            try:
+                if os.stat(path).st_ino == inode:
+                    paths, end = paths[i:], offset
+                    break
+            except FileNotFoundError:
+                continue
+        else:
+            raise InvalidCursor("The log file of the cursor no longer exists")
+    since_str = None
+    if since is not None:
+        if since.tzinfo is not None:
+            since = since.astimezone()
+        since_str = since.strftime("%Y-%m-%d %H:%M:%S")
+
+    records = []  # type: List[Dict[str, Any]]
+    for path in paths:
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # Removed by rotation in the meantime
+            continue
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            file_end = end if end is not None else os.fstat(f.fileno()).st_size
+            end = None
+            for offset, header, lines in _records(f, file_end):
+                if len(records) == limit:
+                    return (
+                        records,
+                        f"{inode}:{offset + sum(len(line) + 1 for line in lines)}",
+                    )
+                if header is not None:
+                    time, levelname = header
+                    if (
+                        since_str is not None
+                        and time[:19].replace("T", " ") < since_str
+                    ):
+                        # All the records before this one are older
+                        return records, None
+                    levelno = logging.getLevelName(levelname)
+                    if (
+                        level is not None
+                        and isinstance(levelno, int)
+                        and levelno < level
+                    ):
+                        continue
+                elif level is not None:
+                    continue
+                records.append(_parse(lines))
+    return records, None
@@ -4,14 +4,15 @@ import os
 from google.cloud import logging as cloud_logging
 
 from aw_core.log import setup_logging
-from aw_datastore import get_storage_methods
-from aw_datastore.storages.memory import MemoryStorage
+from aw_datastore import Datastore, get_storage_methods
 from aw_datastore.storages.peewee import PeeweeStorage
 from aw_server.firebase_datastore.firestore import FirestoreStorage # Firestore depolama sınıfını içe aktar
 
 from . import __version__
+from .api import ServerAPI
 from .config import config
-from .server import _start
+from .server import SERVER_MODES, _start
+from .storages import EventLogStorage, IndexedMemoryStorage, SqliteStorage
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +62,18 @@ def main():
     if settings.custom_static:
         logger.info(f"Using custom_static: {settings.custom_static}")
 
+    if settings.rebuild_rollups:
+        rebuild_rollups(settings, storage_method)
+        return
+
+    if settings.compact:
+        compact(settings, storage_method)
+        return
+
+    if settings.apply_retention:
+        apply_retention(settings, storage_method)
+        return
+
     logger.info("Starting up...")
     try:
         _start(
@@ -70,6 +83,15 @@ def main():
             storage_method=storage_method,
             cors_origins=settings.cors_origins,
             custom_static=settings.custom_static,
+            heartbeat_flush_interval=settings.heartbeat_flush_interval,
+            query_workers=settings.query_workers,
+            rollup_keys=settings.rollup_keys,
+            retention=settings.retention,
+            retention_interval=settings.retention_interval,
+            server_mode=settings.server_mode,
+            server_threads=settings.server_threads,
+            server_queue_size=settings.server_queue_size,
+            keepalive_timeout=settings.keepalive_timeout,
             user_id=user_id, # user_id parametresi _start fonksiyonuna iletildi
         )
     except Exception as e:
@@ -117,6 +139,51 @@ def parse_settings():
         dest="custom_static",
         help="The custom static directories. Format: watcher_name=path,watcher_name2=path2,...",
     )
+    parser.add_argument(
+        "--heartbeat-flush-interval",
+        dest="heartbeat_flush_interval",
+        type=float,
+        help="Keep merged heartbeats in memory and write them to storage at most every N seconds (0 to disable)",
+    )
+    parser.add_argument(
+        "--query-workers",
+        dest="query_workers",
+        type=int,
+        help="Number of timeperiods of a query to evaluate in parallel",
+    )
+    parser.add_argument(
+        "--rebuild-rollups",
+        action="store_true",
+        help="Rebuild the hourly and daily rollups from all events and exit",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Compact the storage (if supported, like by eventlog) and exit. The server must not be running.",
+    )
+    parser.add_argument(
+        "--server-mode",
+        dest="server_mode",
+        choices=SERVER_MODES,
+        help="Run the Werkzeug development server or an embedded production WSGI server (requires cheroot)",
+    )
+    parser.add_argument(
+        "--server-threads",
+        dest="server_threads",
+        type=int,
+        help="Number of threads handling requests in the production server mode",
+    )
+    parser.add_argument(
+        "--retention-interval",
+        dest="retention_interval",
+        type=float,
+        help="Downsample old events according to the retention policies every N seconds (0 to disable)",
+    )
+    parser.add_argument(
+        "--apply-retention",
+        action="store_true",
+        help="Downsample old events according to the retention policies and exit",
+    )
     args = parser.parse_args()
     if args.version:
         print(__version__)
@@ -130,6 +197,20 @@ def parse_settings():
     settings.storage = config[configsection]["storage"]
     settings.cors_origins = config[configsection]["cors_origins"]
     settings.custom_static = dict(config[configsection]["custom_static"])
+    settings.heartbeat_flush_interval = float(
+        config[configsection]["heartbeat_flush_interval"]
+    )
+    settings.query_workers = int(config[configsection]["query_workers"])
+    settings.rollup_keys = list(config[configsection]["rollup_keys"])
+    settings.retention_interval = float(config[configsection]["retention_interval"])
+    settings.server_mode = config[configsection]["server_mode"]
+    settings.server_threads = int(config[configsection]["server_threads"])
+    settings.server_queue_size = int(config[configsection]["server_queue_size"])
+    settings.keepalive_timeout = float(config[configsection]["keepalive_timeout"])
+    settings.retention = {
+        bucket_type: [list(tier) for tier in tiers]
+        for bucket_type, tiers in config[configsection]["retention"].items()
+    }
 
     """ If a argument is not none, override the config value """
     for key, value in vars(args).items():
@@ -140,11 +221,17 @@ def parse_settings():
                 vars(settings)[key] = value
 
     settings.cors_origins = [o for o in settings.cors_origins.split(",") if o]
+    if settings.server_mode not in SERVER_MODES:
+        parser.error(
+            f"invalid server_mode in config: {settings.server_mode} (choose from {', '.join(SERVER_MODES)})"
+        )
 
     # Use a custom storage_methods dict to add FirestoreStorage
     storage_methods = {
         "peewee": PeeweeStorage,
-        "memory": MemoryStorage,
+        "memory": IndexedMemoryStorage,
+        "sqlite": SqliteStorage,
+        "eventlog": EventLogStorage,
         "firestore": lambda testing: FirestoreStorage(user_id=user_id, testing=testing, anonymize_data=anonymize_data), # Firestore depolama yöntemini ekle ve user_id ile başlat
     }
     storage_method = storage_methods[settings.storage]
@@ -152,6 +239,48 @@ def parse_settings():
     return settings, storage_method
 
 
+def rebuild_rollups(settings, storage_method) -> None:
+    """Rebuild the rollups of all buckets, for backfills and after changing rollup_keys"""
+    db = Datastore(storage_method, testing=settings.testing)
+    api = ServerAPI(db, testing=settings.testing, rollup_keys=settings.rollup_keys)
+    try:
+        api.rebuild_rollups()
+        logger.info("Rebuilt rollups")
+    finally:
+        api.close()
+
+
+def apply_retention(settings, storage_method) -> None:
+    """Downsample old events once, like the server does every retention_interval"""
+    db = Datastore(storage_method, testing=settings.testing)
+    api = ServerAPI(
+        db,
+        testing=settings.testing,
+        rollup_keys=settings.rollup_keys,
+        retention=settings.retention,
+    )
+    try:
+        removed = api.apply_retention()
+        logger.info(f"Downsampled old events, removed {sum(removed.values())} events")
+    finally:
+        api.close()
+
+
+def compact(settings, storage_method) -> None:
+    """Reclaim the space of deleted and replaced events in storages that support it"""
+    storage = storage_method(testing=settings.testing)
+    try:
+        if not hasattr(storage, "compact"):
+            logger.error(f"The {settings.storage} storage can't be compacted")
+            sys.exit(1)
+        freed = storage.compact()
+        logger.info(f"Compacted storage, freed {freed} bytes")
+    finally:
+        close = getattr(storage, "close", None)
+        if close is not None:
+            close()
+
+
 def parse_str_to_dict(str_value):
     """Parses a dict from a string in format: key=value,key2=value2,..."""
     output = dict()
@@ -0,0 +1,90 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from typing import (
+    Any,
+    Dict,
+    Hashable,
+    Optional,
+    Set,
+    Tuple,
+)
+
+# Approximate upper bound on the memory used by cached query results, in bytes
+QUERY_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+_STRING_LITERAL = re.compile(r'"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'')
+
+
+def normalize_query(query: str) -> str:
+    """Normalize a query so that differences in indentation and blank lines don't matter"""
+    return "\n".join(line.strip() for line in query.splitlines() if line.strip())
+
+
+def referenced_buckets(query: str, bucket_ids: Set[str]) -> Set[str]:
+    """
+    Get the buckets a query might read from.
+
+    Buckets are referenced by name in string literals, either exactly (query_bucket)
+    or as a substring (find_bucket), so every bucket containing a literal counts.
+    """
+    literals = [a or b for a, b in _STRING_LITERAL.findall(query)]
+    return {
+        bucket_id
+        for bucket_id in bucket_ids
+        if any(literal and literal in bucket_id for literal in literals)
+    }
+
+
+class QueryCache:
+    """
+    LRU cache of query results, bounded by the approximate size of the results.
+
+    Each result is stored with the versions of the buckets it was computed from
+    (see BucketVersions), which the caller checks to tell if it is still valid.
+    """
+
+    def __init__(self, max_size: int = QUERY_CACHE_MAX_SIZE) -> None:
+        self.max_size = max_size
+        self.size = 0
+        self._lock = threading.Lock()
+        self._entries = (
+            OrderedDict()
+        )  # type: OrderedDict[Hashable, Tuple[Dict[str, int], Any, int]]
+
+    def get(self, key: Hashable) -> Optional[Tuple[Dict[str, int], Any]]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            versions, result, _ = self._entries[key]
+            return versions, result
+
+    def put(self, key: Hashable, versions: Dict[str, int], result: Any) -> None:
+        size = len(json.dumps(result, default=str))
+        with self._lock:
+            self._remove(key)
+            if size > self.max_size:
+                return
+            self._entries[key] = (versions, result, size)
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def update_versions(self, key: Hashable, versions: Dict[str, int]) -> None:
+        """Mark a cached result as valid for newer versions of its buckets"""
+        with self._lock:
+            if key in self._entries:
+                _, result, size = self._entries[key]
+                self._entries[key] = (versions, result, size)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
@@ -1,8 +1,10 @@
-import json
+import codecs
+import shutil
+import tempfile
 import traceback
 from functools import wraps
-from threading import Lock
-from typing import Dict
+from typing import Any, Dict, Iterable, Iterator
+from urllib.parse import urlencode
 
 import iso8601
 from aw_core import schema
@@ -10,19 +12,23 @@ from aw_core.models import Event
 from aw_query.exceptions import QueryException
 from flask import (
     Blueprint,
+    Response,
     current_app,
     jsonify,
-    make_response,
     request,
+    send_file,
 )
 from flask_restx import Api, Resource, fields
+from werkzeug.http import quote_etag
 import requests # Yeni eklenen import
 import yaml # Yeni eklenen import
 from ..praisonai_integration.agent_service import AgentsGenerator # Yeni eklenen import
 
-from . import logger
-from .api import ServerAPI
+from . import fast_json, logger
+from .api import EVENTS_PAGE_SIZE, ServerAPI
+from .columnar import ZIP_MAGIC
 from .exceptions import BadRequest, Unauthorized
+from .log_tail import DEFAULT_LOG_LIMIT
 
 
 def host_header_check(f):
@@ -116,6 +122,36 @@ def copy_doc(api_method):
     return decorator
 
 
+def conditional(f):
+    """Decorator for Resource methods whose response only changes when the bucket
+    in the URL (or any bucket, if there's none) is written to.
+
+    Responses are tagged with an ETag derived from the write versions of the
+    buckets, requests with a matching If-None-Match get a 304 Not Modified
+    without reading from storage."""
+
+    @wraps(f)
+    def decorator(self, *args, **kwargs):
+        etag = current_app.api.get_etag(kwargs.get("bucket_id"))
+        if etag is None:
+            # The bucket doesn't exist
+            return f(self, *args, **kwargs)
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag, weak=True)
+            return response
+        rv = f(self, *args, **kwargs)
+        if isinstance(rv, Response):
+            rv.set_etag(etag, weak=True)
+            return rv
+        data, code = rv if isinstance(rv, tuple) else (rv, 200)
+        if code != 200:
+            return data, code
+        return data, code, {"ETag": quote_etag(etag, weak=True)}
+
+    return decorator
+
+
 # SERVER INFO
 
 
@@ -134,6 +170,7 @@ class InfoResource(Resource):
 class BucketsResource(Resource):
     # TODO: Add response marshalling/validation
     @copy_doc(ServerAPI.get_buckets)
+    @conditional
     def get(self) -> Dict[str, Dict]:
         return current_app.api.get_buckets()
 
@@ -142,6 +179,7 @@ class BucketsResource(Resource):
 class BucketResource(Resource):
     @api.doc(model=bucket)
     @copy_doc(ServerAPI.get_bucket_metadata)
+    @conditional
     def get(self, bucket_id):
         return current_app.api.get_bucket_metadata(bucket_id)
 
@@ -198,17 +236,46 @@ class EventsResource(Resource):
     @api.param("limit", "the maximum number of requests to get")
     @api.param("start", "Start date of events")
     @api.param("end", "End date of events")
+    @api.param(
+        "cursor", "Cursor of the page to get, from the Link or X-Next-Cursor header"
+    )
     @copy_doc(ServerAPI.get_events)
+    @conditional
     def get(self, bucket_id):
         args = request.args
         limit = int(args["limit"]) if "limit" in args else -1
         start = iso8601.parse_date(args["start"]) if "start" in args else None
         end = iso8601.parse_date(args["end"]) if "end" in args else None
 
-        events = current_app.api.get_events(
+        if limit > 0 or "cursor" in args:
+            # Paginated, see ServerAPI.get_events_page
+            events, cursor = current_app.api.get_events_page(
+                bucket_id,
+                limit if limit > 0 else EVENTS_PAGE_SIZE,
+                start,
+                end,
+                args.get("cursor"),
+            )
+            response = Response(_events_chunks(events), mimetype="application/json")
+            # The cursor to get the next (older) page of events with
+            if cursor is not None:
+                next_args = request.args.copy()
+                next_args["cursor"] = cursor
+                response.headers["X-Next-Cursor"] = cursor
+                query_string = urlencode(list(next_args.items(multi=True)))
+                response.headers["Link"] = (
+                    f'<{request.base_url}?{query_string}>; rel="next"'
+                )
+            return response
+
+        # Streamed from storage a page at a time, see ServerAPI.iter_events
+        events = current_app.api.iter_events(
             bucket_id, limit=limit, start=start, end=end
         )
-        return events, 200
+        return Response(
+            _events_chunks(e.to_json_dict() for e in events),
+            mimetype="application/json",
+        )
 
     # TODO: How to tell expect that it could be a list of events? Until then we can't use validate.
     @api.expect(event)
@@ -238,6 +305,7 @@ class EventCountResource(Resource):
     @api.param("start", "Start date of eventcount")
     @api.param("end", "End date of eventcount")
     @copy_doc(ServerAPI.get_eventcount)
+    @conditional
     def get(self, bucket_id):
         args = request.args
         start = iso8601.parse_date(args["start"]) if "start" in args else None
@@ -251,6 +319,7 @@ class EventCountResource(Resource):
 class EventResource(Resource):
     @api.doc(model=event)
     @copy_doc(ServerAPI.get_event)
+    @conditional
     def get(self, bucket_id: str, event_id: int):
         logger.debug(
             f"Received get request for event with id '{event_id}' in bucket '{bucket_id}'"
@@ -274,10 +343,6 @@ class EventResource(Resource):
 
 @api.route("/0/buckets/<string:bucket_id>/heartbeat")
 class HeartbeatResource(Resource):
-    def __init__(self, *args, **kwargs):
-        self.lock = Lock()
-        super().__init__(*args, **kwargs)
-
     @api.expect(event, validate=True)
     @api.param(
         "pulsetime", "Largest timewindow allowed between heartbeats for them to merge"
@@ -291,21 +356,33 @@ class HeartbeatResource(Resource):
         else:
             raise BadRequest("MissingParameter", "Missing required parameter pulsetime")
 
-        # This lock is meant to ensure that only one heartbeat is processed at a time,
-        # as the heartbeat function is not thread-safe.
-        # This should maybe be moved into the api.py file instead (but would be very messy).
-        aquired = self.lock.acquire(timeout=1)
-        if not aquired:
-            logger.warning(
-                "Heartbeat lock could not be aquired within a reasonable time, this likely indicates a bug."
-            )
-        try:
-            event = current_app.api.heartbeat(bucket_id, heartbeat, pulsetime)
-        finally:
-            self.lock.release()
+        event = current_app.api.heartbeat(bucket_id, heartbeat, pulsetime)
         return event.to_json_dict(), 200
 
 
+@api.route("/0/buckets/<string:bucket_id>/heartbeats")
+class HeartbeatsResource(Resource):
+    # TODO: How to tell expect that it is a list of events? Until then we can't use validate.
+    @api.expect(event)
+    @api.param(
+        "pulsetime", "Largest timewindow allowed between heartbeats for them to merge"
+    )
+    @copy_doc(ServerAPI.heartbeats)
+    def post(self, bucket_id):
+        data = request.get_json()
+        if not isinstance(data, list):
+            raise BadRequest("Invalid POST data", "Expected a list of heartbeats")
+        heartbeats = [Event(**e) for e in data]
+
+        if "pulsetime" in request.args:
+            pulsetime = float(request.args["pulsetime"])
+        else:
+            raise BadRequest("MissingParameter", "Missing required parameter pulsetime")
+
+        event = current_app.api.heartbeats(bucket_id, heartbeats, pulsetime)
+        return event.to_json_dict() if event else None, 200
+
+
 # QUERY
 
 
@@ -313,15 +390,20 @@ class HeartbeatResource(Resource):
 class QueryResource(Resource):
     # TODO Docs
     @api.expect(query, validate=True)
-    @api.param("name", "Name of the query (required if using cache)")
+    @api.param("name", "Name of the query, named queries have their results cached")
+    @api.param(
+        "incremental",
+        "Set to 1 to only recompute the latest events of open periods (requires name)",
+    )
     def post(self):
         name = ""
         if "name" in request.args:
             name = request.args["name"]
+        incremental = request.args.get("incremental") == "1"
         query = request.get_json()
         try:
             result = current_app.api.query2(
-                name, query["query"], query["timeperiods"], False
+                name, query["query"], query["timeperiods"], bool(name), incremental
             )
             return jsonify(result)
         except QueryException as qe:
@@ -329,57 +411,171 @@ class QueryResource(Resource):
             return {"type": type(qe).__name__, "message": str(qe)}, 400
 
 
+# ROLLUPS
+
+
+@api.route("/0/rollups")
+class RollupsResource(Resource):
+    @api.param("resolution", "hour or day (default)")
+    @api.param("key", "Data key to get the rollups of, such as app (default) or $category")
+    @api.param("start", "Start date of rollups")
+    @api.param("end", "End date of rollups")
+    @api.param("bucket", "Bucket to include, can be repeated (default all buckets)")
+    @api.param("hostname", "Only include buckets of this host")
+    @copy_doc(ServerAPI.get_rollups)
+    def get(self):
+        args = request.args
+        start = iso8601.parse_date(args["start"]) if "start" in args else None
+        end = iso8601.parse_date(args["end"]) if "end" in args else None
+        rollups = current_app.api.get_rollups(
+            args.get("resolution", "day"),
+            args.get("key", "app"),
+            start=start,
+            end=end,
+            bucket_ids=args.getlist("bucket") or None,
+            hostname=args.get("hostname"),
+        )
+        return rollups, 200
+
+
 # EXPORT AND IMPORT
 
+# Number of events serialized into each chunk of streamed exports and event lists
+EXPORT_CHUNK_SIZE = 1000
+
+# Columnar exports and imports are spooled to disk once they grow beyond this
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+EXPORT_FORMATS = ("json", "columnar")
+
+
+def _json_list_chunks(items: Iterable[Any]) -> Iterator[str]:
+    """Serializes items as the elements of a JSON list (without the brackets), a chunk at a time"""
+    chunk = []
+    separator = ""
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield separator + fast_json.dumps(chunk)[1:-1]
+            chunk, separator = [], ","
+    if chunk:
+        yield separator + fast_json.dumps(chunk)[1:-1]
+
+
+def _events_chunks(events: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """Generates a JSON list of events, a chunk of events at a time"""
+    yield "["
+    yield from _json_list_chunks(events)
+    yield "]\n"
+
+
+def _export_chunks(server_api: ServerAPI, bucket_ids: Iterable[str]) -> Iterator[str]:
+    """Generates an export of the buckets as JSON, a chunk of events at a time.
+    The output is the same as fast_json.dumps({"buckets": {...}}) of ServerAPI.export_all."""
+    yield '{"buckets":{'
+    for i, bucket_id in enumerate(bucket_ids):
+        metadata = fast_json.dumps(server_api.get_bucket_metadata(bucket_id))
+        # Leave the bucket object open so that the events can be appended
+        yield f'{"," if i else ""}{fast_json.dumps(bucket_id)}:{metadata[:-1]},"events":['
+        yield from _json_list_chunks(server_api.export_bucket_events(bucket_id))
+        yield "]}"
+    yield "}}"
+
+
+def _export_response(server_api: ServerAPI, bucket_ids: Iterable[str], filename: str):
+    export_format = request.args.get("format", "json")
+    if export_format not in EXPORT_FORMATS:
+        raise BadRequest(
+            "InvalidFormat",
+            f"Unknown export format {export_format}, must be one of {EXPORT_FORMATS}",
+        )
+    if export_format == "columnar":
+        # Zip archives can't be streamed as they are written, so spool it first
+        f = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        server_api.export_columnar(list(bucket_ids), f)
+        f.seek(0)
+        return send_file(
+            f,
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name=filename.replace(".json", ".zip"),
+        )
+    response = Response(
+        _export_chunks(server_api, bucket_ids), mimetype="application/json"
+    )
+    response.headers["Content-Disposition"] = "attachment; filename={}".format(filename)
+    return response
+
+
+def _import(f, resume: bool) -> Dict[str, int]:
+    """Imports an export in either format from a binary stream"""
+    head = f.read(len(ZIP_MAGIC))
+    if head == ZIP_MAGIC:
+        # Reading a zip archive requires seeking
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        spooled.write(head)
+        shutil.copyfileobj(f, spooled)
+        spooled.seek(0)
+        return current_app.api.import_stream(
+            spooled, resume=resume, export_format="columnar"
+        )
+    text = codecs.getreader("utf-8")(f)
+    # Put back what was read to detect the format
+    text.bytebuffer = head
+    return current_app.api.import_stream(text, resume=resume)
+
 
 @api.route("/0/export")
 class ExportAllResource(Resource):
     @api.doc(model=buckets_export)
+    @api.param("format", "Export format, json (default) or columnar")
     @copy_doc(ServerAPI.export_all)
+    @conditional
     def get(self):
-        buckets_export = current_app.api.export_all()
-        payload = {"buckets": buckets_export}
-        response = make_response(json.dumps(payload))
-        filename = "aw-buckets-export.json"
-        response.headers["Content-Disposition"] = "attachment; filename={}".format(
-            filename
+        server_api = current_app.api
+        return _export_response(
+            server_api, list(server_api.get_buckets()), "aw-buckets-export.json"
         )
-        return response
 
 
 # TODO: Perhaps we don't need this, could be done with a query argument to /0/export instead
 @api.route("/0/buckets/<string:bucket_id>/export")
 class BucketExportResource(Resource):
     @api.doc(model=buckets_export)
+    @api.param("format", "Export format, json (default) or columnar")
     @copy_doc(ServerAPI.export_bucket)
+    @conditional
     def get(self, bucket_id):
-        bucket_export = current_app.api.export_bucket(bucket_id)
-        payload = {"buckets": {bucket_export["id"]: bucket_export}}
-        response = make_response(json.dumps(payload))
-        filename = "aw-bucket-export_{}.json".format(bucket_export["id"])
-        response.headers["Content-Disposition"] = "attachment; filename={}".format(
-            filename
+        server_api = current_app.api
+        # Raises NotFound before the response starts streaming
+        server_api.get_bucket_metadata(bucket_id)
+        return _export_response(
+            server_api, [bucket_id], "aw-bucket-export_{}.json".format(bucket_id)
         )
-        return response
 
 
 @api.route("/0/import")
 class ImportAllResource(Resource):
     @api.expect(buckets_export)
-    @copy_doc(ServerAPI.import_all)
+    @api.param("resume", "Set to 1 to resume an interrupted import of the same export")
+    @copy_doc(ServerAPI.import_stream)
     def post(self):
+        resume = request.args.get("resume") == "1"
+        imported = {}
         # If import comes from a form in th web-ui
         if len(request.files) > 0:
             # web-ui form only allows one file, but technically it's possible to
             # upload multiple files at the same time
             for filename, f in request.files.items():
-                buckets = json.loads(f.stream.read())["buckets"]
-                current_app.api.import_all(buckets)
+                imported.update(_import(f.stream, resume))
         # Normal import from body
         else:
-            buckets = request.get_json()["buckets"]
-            current_app.api.import_all(buckets)
-        return None, 200
+            imported = _import(request.stream, resume)
+        return {"imported": imported}, 200
+
+    @copy_doc(ServerAPI.get_import_progress)
+    def get(self):
+        return current_app.api.get_import_progress(), 200
 
 
 # LOGGING
@@ -389,7 +585,17 @@ class ImportAllResource(Resource):
 class LogResource(Resource):
     @copy_doc(ServerAPI.get_log)
     def get(self):
-        return current_app.api.get_log(), 200
+        args = request.args
+        limit = int(args["limit"]) if "limit" in args else DEFAULT_LOG_LIMIT
+        since = iso8601.parse_date(args["since"]) if "since" in args else None
+        records, cursor = current_app.api.get_log(
+            limit, args.get("cursor"), args.get("level"), since
+        )
+        response = jsonify(records)
+        # The cursor to get the next (older) page of records with
+        if cursor is not None:
+            response.headers["X-Next-Cursor"] = cursor
+        return response
 
 
 # SETTINGS
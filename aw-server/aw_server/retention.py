@@ -0,0 +1,243 @@
+"""
+Tiered retention: lossy downsampling of old events.
+
+A retention policy is a list of tiers, each with an age and a resolution.
+Once events are older than the age of a tier, they are downsampled to its
+resolution. The events of every period of that length are replaced by one
+event per distinct data, with the summed duration of the events it replaces.
+So the time spent on every value (like an app or window title) per period is
+kept exactly, and the number of events per period is bounded by the number of
+values seen in it. The merged events of a period are laid out back to back from
+its start, in the order the values were first seen (overlapping at the end of
+the period if their durations add up to more than it, as overlapping events do).
+
+Policies are set per bucket type in the "retention" section of the config,
+for example::
+
+    [server.retention]
+    currentwindow = [[90, 60], [365, 3600]]
+
+keeps window events as they are for 90 days, at a 1 minute resolution until
+they are a year old and hourly after that. Ages are in days and resolutions in
+seconds. Bucket types containing dots have to be quoted, like "os.hid.input".
+
+How far each bucket has been downsampled at each resolution is remembered in a
+JSON file next to the event storage, so that runs only go over events that have
+become old enough since the last one. Writes of older events move it back.
+"""
+
+import json
+import logging
+import math
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Dict,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
+
+import iso8601
+from aw_core.models import Event
+
+logger = logging.getLogger(__name__)
+
+# Old events are downsampled one UTC day at a time, resolutions have to divide it
+CHUNK = timedelta(days=1)
+
+
+class Tier(NamedTuple):
+    age: timedelta
+    resolution: timedelta
+
+
+def parse_policies(config: Dict[str, Any]) -> Dict[str, List[Tier]]:
+    """
+    Parse the retention policies per bucket type from the config, as lists of
+    [age in days, resolution in seconds]. Raises ValueError if a policy is invalid.
+    """
+    policies = {}  # type: Dict[str, List[Tier]]
+    for bucket_type, tiers in config.items():
+        try:
+            policy = [
+                Tier(timedelta(days=age), timedelta(seconds=resolution))
+                for age, resolution in tiers
+            ]
+        except (TypeError, ValueError):
+            raise ValueError(
+                f"Invalid retention policy for {bucket_type}, expected a list of [days, seconds]"
+            )
+        for tier in policy:
+            if tier.age < timedelta(0) or tier.resolution <= timedelta(0):
+                raise ValueError(
+                    f"Invalid retention policy for {bucket_type}, ages and resolutions can't be negative"
+                )
+            if CHUNK % tier.resolution:
+                raise ValueError(
+                    f"Invalid retention policy for {bucket_type}, resolutions have to divide a day"
+                )
+        for finer, coarser in zip(policy, policy[1:]):
+            if coarser.age <= finer.age or coarser.resolution <= finer.resolution:
+                raise ValueError(
+                    f"Invalid retention policy for {bucket_type}, tiers have to be ordered by age and resolution"
+                )
+            if coarser.resolution % finer.resolution:
+                raise ValueError(
+                    f"Invalid retention policy for {bucket_type}, resolutions have to be multiples of finer ones"
+                )
+        policies[bucket_type] = policy
+    return policies
+
+
+def floor_time(time: datetime, resolution: timedelta) -> datetime:
+    """Round a time down to the start of its period of the resolution (in UTC)"""
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return epoch + resolution * math.floor((time - epoch) / resolution)
+
+
+def downsample(
+    events: List[Event], start: datetime, end: datetime, resolution: timedelta
+) -> Tuple[List[Event], List[Event]]:
+    """
+    Downsample the events starting in [start, end) to the resolution.
+
+    Returns the merged events and the remainders, the parts of events that
+    extend past end, which are left as they are.
+    """
+    # Duration per period and data, in the order the data was first seen in each period
+    durations = {}  # type: Dict[Tuple[datetime, str], timedelta]
+    first_seen = {}  # type: Dict[Tuple[datetime, str], datetime]
+    data = {}  # type: Dict[str, Dict[str, Any]]
+    remainders = []  # type: List[Event]
+    for event in events:
+        key = json.dumps(event.data, sort_keys=True)
+        data[key] = event.data
+        piece_start = event.timestamp
+        event_end = min(event.timestamp + event.duration, end)
+        while True:
+            period = floor_time(piece_start, resolution)
+            piece_end = min(period + resolution, event_end)
+            if (period, key) not in durations:
+                durations[(period, key)] = timedelta(0)
+                first_seen[(period, key)] = piece_start
+            durations[(period, key)] += max(piece_end - piece_start, timedelta(0))
+            first_seen[(period, key)] = min(first_seen[(period, key)], piece_start)
+            if piece_end >= event_end:
+                break
+            piece_start = piece_end
+        if event.timestamp + event.duration > end:
+            remainders.append(
+                Event(
+                    timestamp=end,
+                    duration=event.timestamp + event.duration - end,
+                    data=event.data,
+                )
+            )
+
+    merged = []  # type: List[Event]
+    offset = {}  # type: Dict[datetime, timedelta]
+    for period, key in sorted(durations, key=lambda k: (k[0], first_seen[k])):
+        duration = durations[(period, key)]
+        # Keep the event in the period, so that the time per period is kept
+        timestamp = period + max(
+            min(offset.get(period, timedelta(0)), resolution - duration),
+            timedelta(0),
+        )
+        offset[period] = offset.get(period, timedelta(0)) + duration
+        merged.append(Event(timestamp=timestamp, duration=duration, data=data[key]))
+    return merged, remainders
+
+
+class Retention:
+    """Retention policies and how far each bucket has been downsampled, see the module docstring"""
+
+    def __init__(self, path: Optional[str], policies: Dict[str, List[Tier]]) -> None:
+        self.policies = policies
+        self._path = path
+        self._lock = threading.Lock()
+        # Per bucket and resolution (in seconds): the time before which all
+        # events have been downsampled
+        self._watermarks = {}  # type: Dict[str, Dict[str, datetime]]
+        if path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        try:
+            with open(self._path) as f:  # type: ignore
+                state = json.load(f)
+            self._watermarks = {
+                bucket_id: {
+                    resolution: iso8601.parse_date(time)
+                    for resolution, time in watermarks.items()
+                }
+                for bucket_id, watermarks in state.items()
+            }
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError, iso8601.ParseError) as e:
+            logger.warning(f"Could not read retention state, starting over: {e}")
+
+    def _save(self) -> None:
+        if self._path is None:
+            return
+        with open(self._path, "w") as f:
+            json.dump(
+                {
+                    bucket_id: {
+                        resolution: time.isoformat()
+                        for resolution, time in watermarks.items()
+                    }
+                    for bucket_id, watermarks in self._watermarks.items()
+                },
+                f,
+            )
+
+    def policy(self, bucket_type: str) -> List[Tier]:
+        return self.policies.get(bucket_type, [])
+
+    def watermark(self, bucket_id: str, resolution: timedelta) -> Optional[datetime]:
+        """Time before which the events of a bucket are downsampled to the resolution, if known"""
+        with self._lock:
+            key = str(int(resolution.total_seconds()))
+            return self._watermarks.get(bucket_id, {}).get(key)
+
+    def set_watermark(
+        self, bucket_id: str, resolution: timedelta, time: datetime
+    ) -> None:
+        with self._lock:
+            key = str(int(resolution.total_seconds()))
+            self._watermarks.setdefault(bucket_id, {})[key] = time
+            self._save()
+
+    def touch(self, bucket_id: str, since: Optional[datetime]) -> None:
+        """Record a write of events starting at or after since, which might have to be downsampled again"""
+        if since is None or bucket_id not in self._watermarks:
+            return
+        with self._lock:
+            watermarks = self._watermarks.get(bucket_id, {})
+            moved = False
+            for resolution, time in watermarks.items():
+                if since < time:
+                    watermarks[resolution] = floor_time(
+                        since, timedelta(seconds=int(resolution))
+                    )
+                    moved = True
+            if moved:
+                self._save()
+
+    def drop(self, bucket_id: str) -> None:
+        with self._lock:
+            if self._watermarks.pop(bucket_id, None) is not None:
+                self._save()
+
+    def retain_buckets(self, bucket_ids: List[str]) -> None:
+        """Forget the watermarks of buckets that no longer exist"""
+        with self._lock:
+            removed = set(self._watermarks) - set(bucket_ids)
+            for bucket_id in removed:
+                del self._watermarks[bucket_id]
+            if removed:
+                self._save()
@@ -0,0 +1,252 @@
+"""
+Hourly and daily rollups of event durations.
+
+For every bucket, the time spent on each value of a few data keys (like the
+app of window events or the status of AFK events) is summed per hour and per
+day (in UTC) and stored in a SQLite database next to the event storage. The
+rollups are kept up to date as events are written, so "time per app per day"
+for a month can be read from a few hundred rows instead of all the events.
+
+The "$category" key holds the category of each event, according to the
+categorization rules in the server settings (the "classes" setting).
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.models import Event
+from aw_transform import categorize
+from aw_transform.classify import Rule
+
+logger = logging.getLogger(__name__)
+
+# Data keys that are rolled up unless configured otherwise
+DEFAULT_ROLLUP_KEYS = ["app", "status", "$category"]
+
+# Length of the periods of each resolution, in seconds
+RESOLUTIONS = {"hour": 3600, "day": 24 * 3600}
+
+CATEGORY_KEY = "$category"
+
+# Number of rows written at a time when rebuilding
+REBUILD_BATCH_SIZE = 10000
+
+# Durations below this are leftovers of floating point errors
+_EPSILON = 1e-6
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup (
+    bucket_id TEXT NOT NULL,
+    resolution TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    duration REAL NOT NULL,
+    PRIMARY KEY (bucket_id, resolution, key, start, value)
+);
+CREATE TABLE IF NOT EXISTS rollup_bucket (
+    bucket_id TEXT PRIMARY KEY
+);
+"""
+
+_UPSERT = """
+INSERT INTO rollup (bucket_id, resolution, start, key, value, duration)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (bucket_id, resolution, key, start, value)
+DO UPDATE SET duration = duration + excluded.duration
+"""
+
+
+def parse_classes(
+    classes: Optional[List[Dict[str, Any]]],
+) -> List[Tuple[List[str], Rule]]:
+    """Parse the categorization rules from the "classes" setting (as saved by the web UI)"""
+    parsed = []
+    for c in classes or []:
+        try:
+            if c["rule"].get("type") == "regex":
+                parsed.append((c["name"], Rule(c["rule"])))
+        except (KeyError, TypeError, AttributeError, re.error) as e:
+            logger.warning(f"Ignoring invalid category {c}: {e}")
+    return parsed
+
+
+class Rollups:
+    """Rollup tables for a datastore, see the module docstring"""
+
+    def __init__(self, path: str, keys: List[str]) -> None:
+        self.keys = keys
+        self.classes = []  # type: List[Tuple[List[str], Rule]]
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            # The rollups can be rebuilt from the events, no need to be durable
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._conn.commit()
+
+    def set_classes(self, classes: List[Tuple[List[str], Rule]]) -> None:
+        """Set the categorization rules, the rollups of $category have to be rebuilt"""
+        with self._lock:
+            self.classes = classes
+            if CATEGORY_KEY in self.keys:
+                with self._conn:
+                    self._conn.execute("DELETE FROM rollup_bucket")
+
+    def is_built(self, bucket_id: str) -> bool:
+        with self._lock:
+            return (
+                self._conn.execute(
+                    "SELECT 1 FROM rollup_bucket WHERE bucket_id = ?", (bucket_id,)
+                ).fetchone()
+                is not None
+            )
+
+    def rebuild(self, bucket_id: str, events: Iterable[Event]) -> None:
+        """Replace the rollups of a bucket with the sums of its events"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM rollup WHERE bucket_id = ?", (bucket_id,))
+            self._conn.execute(
+                "INSERT OR IGNORE INTO rollup_bucket VALUES (?)", (bucket_id,)
+            )
+            rows = []  # type: List[Tuple]
+            for event in events:
+                rows.extend(self._rows(bucket_id, event, event.timestamp, 1))
+                if len(rows) >= REBUILD_BATCH_SIZE:
+                    self._conn.executemany(_UPSERT, rows)
+                    rows = []
+            self._conn.executemany(_UPSERT, rows)
+
+    def create(self, bucket_id: str) -> None:
+        """Start keeping rollups for a new (empty) bucket"""
+        with self._lock, self._conn:
+            # Left over if the event storage was replaced, like in testing
+            self._conn.execute("DELETE FROM rollup WHERE bucket_id = ?", (bucket_id,))
+            self._conn.execute(
+                "INSERT OR IGNORE INTO rollup_bucket VALUES (?)", (bucket_id,)
+            )
+
+    def drop(self, bucket_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM rollup WHERE bucket_id = ?", (bucket_id,))
+            self._conn.execute(
+                "DELETE FROM rollup_bucket WHERE bucket_id = ?", (bucket_id,)
+            )
+
+    def add(self, bucket_id: str, events: List[Event]) -> None:
+        self._write(bucket_id, [(e, e.timestamp, 1) for e in events])
+
+    def remove(self, bucket_id: str, events: List[Event]) -> None:
+        self._write(bucket_id, [(e, e.timestamp, -1) for e in events])
+
+    def replace(self, bucket_id: str, old: Optional[Event], new: Event) -> None:
+        """Update the rollups for an event that was replaced, like by replace_last"""
+        if old is not None and old.timestamp == new.timestamp and old.data == new.data:
+            # Only the duration changed (a heartbeat was merged), so only the
+            # difference has to be added
+            old_end = old.timestamp + old.duration
+            new_end = new.timestamp + new.duration
+            if new_end >= old_end:
+                self._write(bucket_id, [(new, old_end, 1)])
+            else:
+                self._write(bucket_id, [(old, new_end, -1)])
+        else:
+            self._write(
+                bucket_id,
+                ([(old, old.timestamp, -1)] if old else []) + [(new, new.timestamp, 1)],
+            )
+
+    def _write(
+        self, bucket_id: str, changes: List[Tuple[Event, datetime, int]]
+    ) -> None:
+        rows = []  # type: List[Tuple]
+        for event, start, sign in changes:
+            rows.extend(self._rows(bucket_id, event, start, sign))
+        if not rows:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany(_UPSERT, rows)
+
+    def _rows(
+        self, bucket_id: str, event: Event, start: datetime, sign: int
+    ) -> List[Tuple]:
+        """Rows to upsert for the part of the event from start to its end"""
+        values = []
+        data = event.data
+        if CATEGORY_KEY in self.keys and self.classes:
+            data = categorize([Event(data=dict(event.data))], self.classes)[0].data
+        for key in self.keys:
+            if key in data:
+                values.append((key, json.dumps(data[key], sort_keys=True)))
+        if not values:
+            return []
+        start_ts = start.timestamp()
+        end_ts = (event.timestamp + event.duration).timestamp()
+        rows = []
+        for resolution, length in RESOLUTIONS.items():
+            t = start_ts
+            while t < end_ts:
+                period = int(t // length * length)
+                duration = min(end_ts, period + length) - t
+                for key, value in values:
+                    rows.append(
+                        (bucket_id, resolution, period, key, value, sign * duration)
+                    )
+                t = period + length
+        return rows
+
+    def get(
+        self,
+        bucket_ids: List[str],
+        resolution: str,
+        key: str,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+    ) -> List[Event]:
+        """
+        Get the rollups of key for the periods from start to end, summed over the buckets.
+
+        Returns an event for every period and value, with the time spent as duration.
+        """
+        query = (
+            "SELECT start, value, SUM(duration) FROM rollup WHERE resolution = ? AND key = ?"
+            f" AND bucket_id IN ({', '.join('?' * len(bucket_ids))})"
+        )
+        params = [resolution, key, *bucket_ids]  # type: List[Any]
+        if start is not None:
+            query += " AND start >= ?"
+            params.append(
+                start.timestamp() // RESOLUTIONS[resolution] * RESOLUTIONS[resolution]
+            )
+        if end is not None:
+            query += " AND start < ?"
+            params.append(end.timestamp())
+        query += " GROUP BY start, value ORDER BY start, SUM(duration) DESC"
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            Event(
+                timestamp=datetime.fromtimestamp(period, timezone.utc),
+                duration=timedelta(seconds=duration),
+                data={key: json.loads(value)},
+            )
+            for period, value, duration in rows
+            if duration > _EPSILON
+        ]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -1,11 +1,10 @@
 import logging
 import os
-from datetime import datetime, timedelta
-from typing import Dict, List
+import signal
+import sys
+from typing import Any, Dict, List, Optional
 import asyncio # asyncio'yu içe aktar
 
-import aw_datastore
-import flask.json.provider
 from aw_datastore import Datastore
 from flask import (
     Blueprint,
@@ -17,11 +16,18 @@ from flask_cors import CORS
 
 from . import rest
 from .api import ServerAPI
+from .compression import compress_response
 from .custom_static import get_custom_static_blueprint
+from .fast_json import FastJSONProvider
 from .log import FlaskLogHandler
+from .storages import IndexedMemoryStorage
 
 logger = logging.getLogger(__name__)
 
+SERVER_MODES = ["development", "production"]
+
+# Seconds that in-flight requests get to finish when the production server stops
+SHUTDOWN_TIMEOUT = 10
 app_folder = os.path.dirname(os.path.abspath(__file__))
 static_folder = os.path.join(app_folder, "static")
 
@@ -38,10 +44,15 @@ class AWFlask(Flask):
         custom_static=dict(),
         static_folder=static_folder,
         static_url_path="",
+        heartbeat_flush_interval: float = 0,
+        query_workers: int = 1,
+        rollup_keys: Optional[List[str]] = None,
+        retention: Optional[Dict[str, Any]] = None,
+        retention_interval: float = 0,
         user_id: str = "default_user_id", # user_id parametresi eklendi
     ):
         name = "aw-server"
-        self.json_provider_class = CustomJSONProvider
+        self.json_provider_class = FastJSONProvider
         # only prettyprint JSON if testing (due to perf)
         self.json_provider_class.compact = not testing
 
@@ -58,13 +69,22 @@ class AWFlask(Flask):
 
         # Initialize datastore and API
         if storage_method is None:
-            storage_method = aw_datastore.get_storage_methods()["memory"]
+            storage_method = IndexedMemoryStorage
         db = Datastore(storage_method, testing=testing)
-        self.api = ServerAPI(db=db, testing=testing)
+        self.api = ServerAPI(
+            db=db,
+            testing=testing,
+            heartbeat_flush_interval=heartbeat_flush_interval,
+            query_workers=query_workers,
+            rollup_keys=rollup_keys,
+            retention=retention,
+            retention_interval=retention_interval,
+        )
 
         self.register_blueprint(root)
         self.register_blueprint(rest.blueprint)
         self.register_blueprint(get_custom_static_blueprint(custom_static))
+        self.after_request(compress_response)
 
         # Firebase senkronizasyonunu arka planda başlat
         self.loop = asyncio.get_event_loop()
@@ -81,20 +101,6 @@ class AWFlask(Flask):
             await self.api.synchronizer.full_sync()
 
 
-class CustomJSONProvider(flask.json.provider.DefaultJSONProvider):
-    # encoding/decoding of datetime as iso8601 strings
-    # encoding of timedelta as second floats
-    def default(self, obj, *args, **kwargs):
-        try:
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            if isinstance(obj, timedelta):
-                return obj.total_seconds()
-        except TypeError:
-            pass
-        return super().default(obj)
-
-
 @root.route("/")
 def static_root():
     return current_app.send_static_file("index.html")
@@ -137,6 +143,15 @@ def _start(
     testing: bool = False,
     cors_origins: List[str] = [],
     custom_static: Dict[str, str] = dict(),
+    heartbeat_flush_interval: float = 0,
+    query_workers: int = 1,
+    rollup_keys: Optional[List[str]] = None,
+    retention: Optional[Dict[str, Any]] = None,
+    retention_interval: float = 0,
+    server_mode: str = "development",
+    server_threads: int = 16,
+    server_queue_size: int = 100,
+    keepalive_timeout: float = 10,
     user_id: str = "default_user_id", # user_id parametresi eklendi
 ):
     app = AWFlask(
@@ -145,17 +160,84 @@ def _start(
         storage_method=storage_method,
         cors_origins=cors_origins,
         custom_static=custom_static,
+        heartbeat_flush_interval=heartbeat_flush_interval,
+        query_workers=query_workers,
+        rollup_keys=rollup_keys,
+        retention=retention,
+        retention_interval=retention_interval,
         user_id=user_id, # user_id parametresi AWFlask'a iletildi
     )
     try:
-        app.run(
-            debug=testing,
-            host=host,
-            port=port,
-            request_handler=FlaskLogHandler,
-            use_reloader=False,
-            threaded=True,
-        )
+        if server_mode == "production":
+            _serve_production(
+                app, host, port, server_threads, server_queue_size, keepalive_timeout
+            )
+        else:
+            app.run(
+                debug=testing,
+                host=host,
+                port=port,
+                request_handler=FlaskLogHandler,
+                use_reloader=False,
+                threaded=True,
+            )
     except OSError as e:
         logger.exception(e)
         raise e
+    finally:
+        # Write any heartbeats still held in memory by the write-behind mode
+        app.api.close()
+
+
+def _production_server(
+    app: AWFlask,
+    host: str,
+    port: int,
+    threads: int,
+    queue_size: int,
+    keepalive_timeout: float,
+):
+    """
+    Create a cheroot WSGI server for the app.
+
+    Requests are handled by a fixed pool of threads. Accepted connections wait
+    for a free thread in a queue of at most queue_size connections, and
+    further ones wait in the listen backlog (of the same size). Idle keep-alive
+    connections are closed after keepalive_timeout seconds. When stopped, new
+    connections are refused and in-flight requests get SHUTDOWN_TIMEOUT seconds
+    to finish.
+    """
+    try:
+        from cheroot import wsgi
+    except ImportError:
+        raise ImportError(
+            "The production server mode requires cheroot (pip install cheroot)"
+        ) from None
+
+    return wsgi.Server(
+        (host, port),
+        app,
+        numthreads=threads,
+        server_name="aw-server",
+        request_queue_size=queue_size,
+        accepted_queue_size=queue_size,
+        timeout=keepalive_timeout,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+    )
+
+
+def _serve_production(
+    app: AWFlask,
+    host: str,
+    port: int,
+    threads: int,
+    queue_size: int,
+    keepalive_timeout: float,
+) -> None:
+    """Serve the app with the production server until interrupted or terminated"""
+    server = _production_server(app, host, port, threads, queue_size, keepalive_timeout)
+    # Stop like on Ctrl+C when terminated, like by a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f"Serving on http://{host}:{port} with {threads} threads")
+    # Stops the server cleanly on KeyboardInterrupt and SystemExit
+    server.safe_start()
@@ -0,0 +1,5 @@
+from .eventlog import EventLogStorage
+from .memory import IndexedMemoryStorage
+from .sqlite import SqliteStorage
+
+__all__ = ["EventLogStorage", "IndexedMemoryStorage", "SqliteStorage"]
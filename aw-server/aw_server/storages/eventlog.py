@@ -0,0 +1,536 @@
+"""
+Experimental storage keeping each bucket in an append-only, memory-mapped log.
+
+Every write appends a length-prefixed binary record to the log file of the
+bucket: a PUT with the whole event, or a DELETE with the id of an event.
+A PUT for an id that already exists replaces that event, so nothing but the
+last record (see replace_last) is ever modified in place. The files are
+memory-mapped, so records are read straight from the page cache without
+copying the file into buffers.
+
+The records are grouped into blocks of BLOCK_SIZE records, and for each block
+the smallest timestamp and the largest end of its events are kept in memory.
+This sparse index is used to skip blocks that can't contain events in the
+requested range. Since events mostly arrive in order it skips nearly all of them.
+
+Replaced and deleted events take up space until the log is compacted
+with `aw-server --storage eventlog --compact`.
+
+Record format (little-endian):
+
+    length: uint32 (of the record after the crc), crc: uint32 (crc32 of the same)
+    kind: uint8, id: int64, timestamp: int64 (us), duration: int64 (us)
+    data: JSON (PUT records only)
+"""
+
+import json
+import logging
+import math
+import mmap
+import os
+import struct
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import (
+    Any,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.dirs import get_data_dir, legacy_testing_suffix
+from aw_core.models import Event
+from aw_datastore.storages import AbstractStorage
+
+logger = logging.getLogger(__name__)
+
+# Number of records per block of the sparse index
+BLOCK_SIZE = 256
+
+# Size new log files start out with, they are doubled when full
+INITIAL_LOG_SIZE = 1024 * 1024
+
+PUT = 1
+DELETE = 2
+
+_PREFIX = struct.Struct("<II")
+_FIELDS = struct.Struct("<Bqqq")
+_HEADER_SIZE = _PREFIX.size + _FIELDS.size
+
+
+def _to_us(dt: datetime) -> int:
+    return round(dt.timestamp() * 1000000)
+
+
+def _record(
+    kind: int, event_id: int, timestamp: int, duration: int, data: bytes
+) -> bytes:
+    body = _FIELDS.pack(kind, event_id, timestamp, duration) + data
+    return _PREFIX.pack(len(body), zlib.crc32(body)) + body
+
+
+class _Block:
+    __slots__ = ("start", "end", "count", "min_ts", "max_ts", "max_end")
+
+    def __init__(self, start: int) -> None:
+        self.start = start
+        self.end = start
+        self.count = 0
+        self.min_ts = math.inf
+        self.max_ts = -math.inf
+        self.max_end = -math.inf
+
+
+class _Log:
+    """The log file of a bucket, with the index of its events"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.RLock()
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.truncate(INITIAL_LOG_SIZE)
+        self._file = open(path, "r+b")
+        self.mm = mmap.mmap(self._file.fileno(), 0)
+        # Offsets of the current record of each event, by id
+        self.live = {}  # type: Dict[int, int]
+        self.blocks = []  # type: List[_Block]
+        self.next_id = 0
+        # Offset of the last record and where the next is appended
+        self.tail = -1
+        self.end = 0
+        # Timestamp, id and offset of the newest event, if known
+        self._last = None  # type: Optional[Tuple[int, int, int]]
+        self._last_known = True
+        self._scan()
+
+    def _scan(self) -> None:
+        offset = 0
+        while offset + _HEADER_SIZE <= len(self.mm):
+            length, crc = _PREFIX.unpack_from(self.mm, offset)
+            body_end = offset + _PREFIX.size + length
+            if length == 0 or body_end > len(self.mm):
+                break
+            if zlib.crc32(self.mm[offset + _PREFIX.size : body_end]) != crc:
+                logger.warning(
+                    f"Ignoring incomplete record at the end of {self.path} (offset {offset})"
+                )
+                break
+            self._apply(offset, body_end)
+            offset = body_end
+
+    def _apply(self, offset: int, next_offset: int) -> None:
+        kind, event_id, timestamp, duration = _FIELDS.unpack_from(
+            self.mm, offset + _PREFIX.size
+        )
+        if kind == PUT:
+            self.live[event_id] = offset
+        else:
+            self.live.pop(event_id, None)
+        if self._last_known:
+            if kind == PUT and (
+                self._last is None or (timestamp, event_id) >= self._last[:2]
+            ):
+                self._last = (timestamp, event_id, offset)
+            elif self._last is not None and self._last[1] == event_id:
+                # The newest event was deleted or moved back in time
+                self._last_known = False
+        self.next_id = max(self.next_id, event_id + 1)
+        if not self.blocks or self.blocks[-1].count >= BLOCK_SIZE:
+            self.blocks.append(_Block(offset))
+        block = self.blocks[-1]
+        block.end = next_offset
+        block.count += 1
+        if kind == PUT:
+            block.min_ts = min(block.min_ts, timestamp)
+            block.max_ts = max(block.max_ts, timestamp)
+            block.max_end = max(block.max_end, timestamp + duration)
+        self.tail = offset
+        self.end = next_offset
+
+    def header(self, offset: int) -> Tuple[int, int, int, int]:
+        """Kind, id, timestamp and duration of the record at offset"""
+        return _FIELDS.unpack_from(self.mm, offset + _PREFIX.size)
+
+    def event(self, offset: int) -> Event:
+        (length,) = struct.unpack_from("<I", self.mm, offset)
+        _, event_id, timestamp, duration = self.header(offset)
+        data = self.mm[offset + _HEADER_SIZE : offset + _PREFIX.size + length]
+        return Event(
+            id=event_id,
+            timestamp=datetime.fromtimestamp(timestamp / 1000000, timezone.utc),
+            duration=timedelta(microseconds=duration),
+            data=json.loads(data),
+        )
+
+    def records(self, block: _Block) -> Iterator[int]:
+        """Offsets of the records in a block"""
+        offset = block.start
+        while offset < block.end:
+            yield offset
+            offset += _PREFIX.size + struct.unpack_from("<I", self.mm, offset)[0]
+
+    def append(self, record: bytes, at: Optional[int] = None) -> int:
+        """Write a record at the end of the log (or over the last record), returns its offset"""
+        offset = self.end if at is None else at
+        needed = offset + len(record) + _PREFIX.size
+        if needed > len(self.mm):
+            size = max(2 * len(self.mm), needed)
+            self.mm.close()
+            self._file.truncate(size)
+            self.mm = mmap.mmap(self._file.fileno(), 0)
+        self.mm[offset : offset + len(record)] = record
+        # A zero length marks the end of the log, over anything left behind
+        # by a longer record that was overwritten
+        self.mm[offset + len(record) : needed] = bytes(_PREFIX.size)
+        if at is not None:
+            # Overwriting the last record, which belongs to the last block
+            self.blocks[-1].count -= 1
+        self._apply(offset, offset + len(record))
+        return offset
+
+    def last(self) -> Optional[int]:
+        """Offset of the newest event (by timestamp, then id)"""
+        if self._last_known:
+            return self._last[2] if self._last is not None else None
+        best = None  # type: Optional[Tuple[int, int, int]]
+        for block in sorted(self.blocks, key=lambda b: b.max_ts, reverse=True):
+            if best is not None and block.max_ts < best[0]:
+                break
+            for offset in self.records(block):
+                kind, event_id, timestamp, _ = self.header(offset)
+                if kind == PUT and self.live.get(event_id) == offset:
+                    if best is None or (timestamp, event_id) > best[:2]:
+                        best = (timestamp, event_id, offset)
+        self._last, self._last_known = best, True
+        return best[2] if best is not None else None
+
+    def close(self) -> None:
+        self.mm.flush()
+        self.mm.close()
+        self._file.close()
+
+
+class EventLogStorage(AbstractStorage):
+    """Experimental append-only storage, see the module docstring"""
+
+    sid = "eventlog"
+
+    def __init__(self, testing: bool, filepath: Optional[str] = None) -> None:
+        self.testing = testing
+        if not filepath:
+            filepath = os.path.join(
+                get_data_dir("aw-server"), f"eventlog{legacy_testing_suffix(testing)}"
+            )
+        self.path = filepath
+        os.makedirs(self.path, exist_ok=True)
+        logger.info(f"Using event log directory: {self.path}")
+        self._lock = threading.Lock()
+        self._metadata_path = os.path.join(self.path, "buckets.json")
+        self._metadata = {"buckets": {}, "next_file": 0}  # type: Dict[str, Any]
+        if os.path.exists(self._metadata_path):
+            with open(self._metadata_path) as f:
+                self._metadata = json.load(f)
+        self._logs = {
+            bucket_id: _Log(os.path.join(self.path, bucket["file"]))
+            for bucket_id, bucket in self._metadata["buckets"].items()
+        }  # type: Dict[str, _Log]
+
+    def _save_metadata(self) -> None:
+        tmp_path = self._metadata_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._metadata, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._metadata_path)
+
+    def _log(self, bucket_id: str) -> _Log:
+        try:
+            return self._logs[bucket_id]
+        except KeyError:
+            raise ValueError(f"Bucket {bucket_id} did not exist")
+
+    def buckets(self) -> Dict[str, Dict[str, Any]]:
+        return {bucket_id: self.get_metadata(bucket_id) for bucket_id in self._logs}
+
+    def create_bucket(
+        self,
+        bucket_id: str,
+        type_id: str,
+        client: str,
+        hostname: str,
+        created: str,
+        name: Optional[str] = None,
+        data: Optional[dict] = None,
+    ) -> None:
+        with self._lock:
+            if bucket_id in self._logs:
+                raise ValueError(f"Bucket {bucket_id} already exists")
+            # Bucket ids can contain anything, so the files are numbered instead
+            filename = f"bucket-{self._metadata['next_file']}.log"
+            self._metadata["next_file"] += 1
+            self._metadata["buckets"][bucket_id] = {
+                "id": bucket_id,
+                "name": name,
+                "type": type_id,
+                "client": client,
+                "hostname": hostname,
+                "created": created,
+                "data": data or {},
+                "file": filename,
+            }
+            self._logs[bucket_id] = _Log(os.path.join(self.path, filename))
+            self._save_metadata()
+
+    def update_bucket(
+        self,
+        bucket_id: str,
+        type_id: Optional[str] = None,
+        client: Optional[str] = None,
+        hostname: Optional[str] = None,
+        name: Optional[str] = None,
+        data: Optional[dict] = None,
+    ) -> None:
+        with self._lock:
+            if bucket_id not in self._logs:
+                raise ValueError("Bucket did not exist, could not update")
+            bucket = self._metadata["buckets"][bucket_id]
+            for key, value in [
+                ("type", type_id),
+                ("client", client),
+                ("hostname", hostname),
+                ("name", name),
+                ("data", data),
+            ]:
+                if value is not None:
+                    bucket[key] = value
+            self._save_metadata()
+
+    def delete_bucket(self, bucket_id: str) -> None:
+        with self._lock:
+            if bucket_id not in self._logs:
+                raise ValueError("Bucket did not exist, could not delete")
+            log = self._logs.pop(bucket_id)
+            del self._metadata["buckets"][bucket_id]
+            self._save_metadata()
+            with log.lock:
+                log.close()
+                os.remove(log.path)
+
+    def get_metadata(self, bucket_id: str) -> Dict[str, Any]:
+        bucket = self._metadata["buckets"].get(bucket_id)
+        if bucket is None:
+            raise ValueError("Bucket did not exist, could not get metadata")
+        return {key: value for key, value in bucket.items() if key != "file"}
+
+    def insert_one(self, bucket_id: str, event: Event) -> Event:
+        log = self._log(bucket_id)
+        with log.lock:
+            if event.id is None:
+                event.id = log.next_id
+            log.append(self._put(event))
+        return event
+
+    def insert_many(self, bucket_id: str, events: List[Event]) -> None:
+        for event in events:
+            self.insert_one(bucket_id, event)
+
+    @staticmethod
+    def _put(event: Event) -> bytes:
+        return _record(
+            PUT,
+            event.id,
+            _to_us(event.timestamp),
+            round(event.duration.total_seconds() * 1000000),
+            json.dumps(event.data).encode(),
+        )
+
+    def delete(self, bucket_id: str, event_id: int) -> bool:
+        log = self._log(bucket_id)
+        with log.lock:
+            if event_id not in log.live:
+                return False
+            log.append(_record(DELETE, event_id, 0, 0, b""))
+            return True
+
+    def replace(self, bucket_id: str, event_id: int, event: Event) -> bool:
+        log = self._log(bucket_id)
+        with log.lock:
+            if event_id not in log.live:
+                return False
+            event.id = event_id
+            log.append(self._put(event))
+            return True
+
+    def replace_last(self, bucket_id: str, event: Event) -> None:
+        log = self._log(bucket_id)
+        with log.lock:
+            last = log.last()
+            if last is None:
+                return
+            event.id = log.header(last)[1]
+            # The last event is usually the last record (a heartbeat being
+            # merged), which can be overwritten instead of appending a new one
+            log.append(self._put(event), at=last if last == log.tail else None)
+
+    def get_event(self, bucket_id: str, event_id: int) -> Optional[Event]:
+        log = self._log(bucket_id)
+        with log.lock:
+            offset = log.live.get(event_id)
+            return log.event(offset) if offset is not None else None
+
+    def _offsets(
+        self,
+        log: _Log,
+        limit: int,
+        start: Optional[int],
+        end: Optional[int],
+        before: Optional[Tuple[int, int]] = None,
+    ) -> List[int]:
+        """
+        Offsets of the newest events in the range, newest first, only those
+        ordered before the (timestamp, id) key before if set
+        """
+        found = []  # type: List[Tuple[int, int, int]]
+        blocks = [
+            b
+            for b in log.blocks
+            if (start is None or b.max_end >= start)
+            and (end is None or b.min_ts <= end)
+            and (before is None or b.min_ts <= before[0])
+        ]
+        blocks.sort(key=lambda b: b.max_ts, reverse=True)
+        for i, block in enumerate(blocks):
+            for offset in log.records(block):
+                kind, event_id, timestamp, duration = log.header(offset)
+                if (
+                    kind == PUT
+                    and log.live.get(event_id) == offset
+                    and (start is None or timestamp + duration >= start)
+                    and (end is None or timestamp <= end)
+                    and (before is None or (timestamp, event_id) < before)
+                ):
+                    found.append((timestamp, event_id, offset))
+            if 0 < limit <= len(found) and i + 1 < len(blocks):
+                # Stop once the remaining blocks only have older events
+                found.sort(reverse=True)
+                del found[limit:]
+                if blocks[i + 1].max_ts < found[-1][0]:
+                    break
+        found.sort(reverse=True)
+        if limit >= 0:
+            del found[limit:]
+        return [offset for _, _, offset in found]
+
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        if limit == 0:
+            return []
+        log = self._log(bucket_id)
+        with log.lock:
+            offsets = self._offsets(
+                log,
+                limit,
+                _to_us(starttime) if starttime else None,
+                _to_us(endtime) if endtime else None,
+            )
+            events = [log.event(offset) for offset in offsets]
+
+        # Trim events that are out of range, like PeeweeStorage
+        for e in events:
+            if starttime and e.timestamp < starttime:
+                e_end = e.timestamp + e.duration
+                e.timestamp = starttime
+                e.duration = e_end - e.timestamp
+            if endtime and e.timestamp + e.duration > endtime:
+                e.duration = endtime - e.timestamp
+        return events
+
+    def get_events_before(
+        self,
+        bucket_id: str,
+        limit: int,
+        before: Optional[Tuple[datetime, int]],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        """
+        Like get_events, but only the events ordered before the (timestamp, id)
+        key before (if any), and without trimming them to the range.
+        """
+        if limit == 0:
+            return []
+        log = self._log(bucket_id)
+        with log.lock:
+            offsets = self._offsets(
+                log,
+                limit,
+                _to_us(starttime) if starttime else None,
+                _to_us(endtime) if endtime else None,
+                (_to_us(before[0]), before[1]) if before is not None else None,
+            )
+            return [log.event(offset) for offset in offsets]
+
+    def get_eventcount(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> int:
+        log = self._log(bucket_id)
+        with log.lock:
+            if starttime is None and endtime is None:
+                return len(log.live)
+            return len(
+                self._offsets(
+                    log,
+                    -1,
+                    _to_us(starttime) if starttime else None,
+                    _to_us(endtime) if endtime else None,
+                )
+            )
+
+    def compact(self, bucket_id: Optional[str] = None) -> int:
+        """
+        Rewrite the logs of the buckets (all by default) with only their current
+        events, ordered by time. Returns the number of bytes freed.
+
+        Only safe while no other process uses the storage.
+        """
+        freed = 0
+        for bid in [bucket_id] if bucket_id is not None else list(self._logs):
+            log = self._log(bid)
+            with log.lock:
+                size = log.end
+                offsets = self._offsets(log, -1, None, None)[::-1]
+                tmp_path = log.path + ".compact"
+                with open(tmp_path, "wb") as f:
+                    for offset in offsets:
+                        (length,) = struct.unpack_from("<I", log.mm, offset)
+                        f.write(log.mm[offset : offset + _PREFIX.size + length])
+                    f.truncate(max(f.tell() * 2, INITIAL_LOG_SIZE))
+                    f.flush()
+                    os.fsync(f.fileno())
+                log.close()
+                os.replace(tmp_path, log.path)
+                self._logs[bid] = compacted = _Log(log.path)
+                freed += size - compacted.end
+                logger.info(
+                    f"Compacted bucket '{bid}' from {size} to {compacted.end} bytes"
+                )
+        return freed
+
+    def close(self) -> None:
+        with self._lock:
+            for log in self._logs.values():
+                with log.lock:
+                    log.close()
+            self._logs.clear()
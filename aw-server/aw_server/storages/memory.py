@@ -0,0 +1,190 @@
+import copy
+import itertools
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime, timedelta
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.models import Event
+from aw_datastore.storages import MemoryStorage
+
+# Events are ordered by timestamp, and by insertion order for equal timestamps
+_Key = Tuple[datetime, int]
+
+
+class IndexedMemoryStorage(MemoryStorage):
+    """
+    In-memory storage with the events of each bucket kept sorted by timestamp.
+
+    Behaves like the memory storage of aw_datastore, but range queries use
+    bisection instead of scanning (and sorting) all events of the bucket.
+    Inserting an event newer than all others, like a heartbeat, is O(1) amortized.
+    """
+
+    def __init__(self, testing: bool) -> None:
+        super().__init__(testing)
+        # Per bucket: sort keys of the events in self.db (in the same order),
+        # the keys of the events by id, the next id and the longest duration
+        self._keys = {}  # type: Dict[str, List[_Key]]
+        self._ids = {}  # type: Dict[str, Dict[int, _Key]]
+        self._next_id = {}  # type: Dict[str, int]
+        self._max_duration = {}  # type: Dict[str, timedelta]
+        self._seq = itertools.count()
+
+    def create_bucket(self, bucket_id, *args, **kwargs) -> None:
+        super().create_bucket(bucket_id, *args, **kwargs)
+        self._keys[bucket_id] = []
+        self._ids[bucket_id] = {}
+        self._next_id[bucket_id] = 0
+        self._max_duration[bucket_id] = timedelta(0)
+
+    def delete_bucket(self, bucket_id: str) -> None:
+        super().delete_bucket(bucket_id)
+        for index in (self._keys, self._ids, self._next_id, self._max_duration):
+            index.pop(bucket_id, None)  # type: ignore
+
+    def _insert(self, bucket_id: str, event: Event, seq: int) -> None:
+        keys = self._keys[bucket_id]
+        key = (event.timestamp, seq)
+        if not keys or key > keys[-1]:
+            keys.append(key)
+            self.db[bucket_id].append(event)
+        else:
+            i = bisect_right(keys, key)
+            keys.insert(i, key)
+            self.db[bucket_id].insert(i, event)
+        self._ids[bucket_id][event.id] = key
+        if event.duration > self._max_duration[bucket_id]:
+            self._max_duration[bucket_id] = event.duration
+
+    def _index(self, bucket_id: str, event_id) -> Optional[int]:
+        key = self._ids[bucket_id].get(event_id)
+        if key is None:
+            return None
+        return bisect_left(self._keys[bucket_id], key)
+
+    def _pop(self, bucket_id: str, i: int) -> Event:
+        self._keys[bucket_id].pop(i)
+        event = self.db[bucket_id].pop(i)
+        del self._ids[bucket_id][event.id]
+        return event
+
+    def get_events(
+        self,
+        bucket: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        keys = self._keys[bucket]
+        end = bisect_right(keys, (endtime, float("inf"))) if endtime else len(keys)
+        return self._events_before(bucket, limit, starttime, end)
+
+    def get_events_before(
+        self,
+        bucket: str,
+        limit: int,
+        before: Optional[Tuple[datetime, int]],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        """
+        Like get_events, but only the events ordered before the (timestamp, id)
+        key before (if any). Events with the same timestamp are already ordered
+        by id, as ids are assigned in insertion order.
+        """
+        keys = self._keys[bucket]
+        end = bisect_right(keys, (endtime, float("inf"))) if endtime else len(keys)
+        if before is not None:
+            timestamp, event_id = before
+            i = bisect_left(keys, (timestamp, -1))
+            while (
+                i < end
+                and keys[i][0] == timestamp
+                and self.db[bucket][i].id < event_id
+            ):
+                i += 1
+            end = min(end, i)
+        return self._events_before(bucket, limit, starttime, end)
+
+    def _events_before(
+        self, bucket: str, limit: int, starttime: Optional[datetime], end: int
+    ) -> List[Event]:
+        """Events before index end that end after starttime, newest first"""
+        if limit == 0:
+            return []
+        keys = self._keys[bucket]
+        events = self.db[bucket]
+        # Events starting before this can't end after the starttime
+        start = (
+            bisect_left(keys, (starttime - self._max_duration[bucket], -1))
+            if starttime
+            else 0
+        )
+        result = []
+        for i in range(end - 1, start - 1, -1):
+            event = events[i]
+            if starttime and event.timestamp + event.duration < starttime:
+                continue
+            result.append(event)
+            if len(result) == limit:
+                break
+        return copy.deepcopy(result)
+
+    def get_eventcount(
+        self,
+        bucket: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> int:
+        keys = self._keys[bucket]
+        start = bisect_left(keys, (starttime, -1)) if starttime else 0
+        end = bisect_right(keys, (endtime, float("inf"))) if endtime else len(keys)
+        return max(end - start, 0)
+
+    def insert_one(self, bucket: str, event: Event) -> Event:
+        if event.id is not None:
+            self.replace(bucket, event.id, event)
+        else:
+            # We need to copy the event to avoid setting the ID on the passed event
+            event = copy.copy(event)
+            event.id = self._next_id[bucket]
+            self._next_id[bucket] += 1
+            self._insert(bucket, event, next(self._seq))
+        return event
+
+    def delete(self, bucket_id, event_id):
+        i = self._index(bucket_id, event_id)
+        if i is None:
+            return False
+        self._pop(bucket_id, i)
+        return True
+
+    def _get_event(self, bucket_id, event_id) -> Optional[Event]:
+        i = self._index(bucket_id, event_id)
+        return self.db[bucket_id][i] if i is not None else None
+
+    def replace(self, bucket_id, event_id, event):
+        i = self._index(bucket_id, event_id)
+        if i is None:
+            return False
+        # We need to copy the event to avoid setting the ID on the passed event
+        event = copy.copy(event)
+        event.id = event_id
+        _, seq = self._keys[bucket_id][i]
+        if event.timestamp == self.db[bucket_id][i].timestamp:
+            self.db[bucket_id][i] = event
+            if event.duration > self._max_duration[bucket_id]:
+                self._max_duration[bucket_id] = event.duration
+        else:
+            self._pop(bucket_id, i)
+            self._insert(bucket_id, event, seq)
+        return True
+
+    def replace_last(self, bucket_id, event):
+        if self.db[bucket_id]:
+            self.replace(bucket_id, self.db[bucket_id][-1].id, event)
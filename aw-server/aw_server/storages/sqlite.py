@@ -0,0 +1,458 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from aw_core.dirs import get_data_dir, legacy_testing_suffix
+from aw_core.models import Event
+from aw_datastore.storages import AbstractStorage
+
+logger = logging.getLogger(__name__)
+
+# Same file and schema as the sqlite storage of aw_datastore (and aw-server-rust)
+LATEST_VERSION = 1
+
+# Most writes that are committed together by the writer thread
+GROUP_COMMIT_MAX_BATCH = 1000
+
+# Number of prepared statements each connection keeps
+STATEMENT_CACHE_SIZE = 256
+
+# Timestamps are stored as microseconds since the epoch
+MAX_TIMESTAMP = 2**63 - 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    rowid INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT UNIQUE NOT NULL,
+    name TEXT,
+    type TEXT NOT NULL,
+    client TEXT NOT NULL,
+    hostname TEXT NOT NULL,
+    created TEXT NOT NULL,
+    datastr TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    bucketrow INTEGER NOT NULL,
+    starttime INTEGER NOT NULL,
+    endtime INTEGER NOT NULL,
+    datastr TEXT NOT NULL,
+    FOREIGN KEY (bucketrow) REFERENCES buckets(rowid)
+);
+CREATE INDEX IF NOT EXISTS event_index_starttime ON events(bucketrow, starttime);
+CREATE INDEX IF NOT EXISTS event_index_endtime ON events(bucketrow, endtime);
+"""
+
+_BUCKET_COLUMNS = "rowid, id, name, type, client, hostname, created, datastr"
+
+_INSERT_EVENT = (
+    "INSERT INTO events(bucketrow, starttime, endtime, datastr) VALUES (?, ?, ?, ?)"
+)
+_UPDATE_EVENT = (
+    "UPDATE events SET starttime = ?, endtime = ?, datastr = ?"
+    " WHERE id = ? AND bucketrow = ?"
+)
+_LAST_EVENT_ID = (
+    "SELECT id FROM events WHERE bucketrow = ?"
+    " ORDER BY starttime DESC, id DESC LIMIT 1"
+)
+_RANGE = "bucketrow = ? AND endtime >= ? AND starttime <= ?"
+
+
+def _to_us(dt: datetime) -> int:
+    return round(dt.timestamp() * 1000000)
+
+
+def _event_row(event: Event) -> Tuple[int, int, str]:
+    starttime = _to_us(event.timestamp)
+    endtime = starttime + round(event.duration.total_seconds() * 1000000)
+    return starttime, endtime, json.dumps(event.data)
+
+
+def _row_to_event(row) -> Event:
+    eid, starttime, endtime, datastr = row
+    return Event(
+        id=eid,
+        timestamp=datetime.fromtimestamp(starttime / 1000000, timezone.utc),
+        duration=(endtime - starttime) / 1000000,
+        data=json.loads(datastr),
+    )
+
+
+def _bucket_json(row) -> Dict[str, Any]:
+    return {
+        "id": row[1],
+        "name": row[2],
+        "type": row[3],
+        "client": row[4],
+        "hostname": row[5],
+        "created": row[6],
+        "data": json.loads(row[7] or "{}"),
+    }
+
+
+class SqliteStorage(AbstractStorage):
+    """
+    SQLite storage with group commit, selected with --storage sqlite.
+
+    Uses the same database file as the sqlite storage of aw_datastore, but is
+    safe to use from several threads: reads use a connection per thread, which
+    WAL journaling lets run concurrently with writes, and all writes go through
+    a single writer thread. Writes that are queued while the writer is busy are
+    committed together in one transaction, so concurrent writers share the cost
+    of a commit. A write only returns once it has been committed.
+    """
+
+    sid = "sqlite"
+
+    def __init__(self, testing: bool, filepath: Optional[str] = None) -> None:
+        self.testing = testing
+        if not filepath:
+            filename = (
+                f"{self.sid}{legacy_testing_suffix(testing)}.v{LATEST_VERSION}.db"
+            )
+            filepath = os.path.join(get_data_dir("aw-server"), filename)
+        self.filepath = filepath
+        logger.info(f"Using database file: {filepath}")
+
+        self._local = threading.local()
+        self._queue = queue.Queue()  # type: queue.Queue
+        writer_conn = self._connect()
+        writer_conn.executescript(_SCHEMA)
+        writer_conn.commit()
+        # Rowids of the buckets, to not look them up on every query
+        self._bucket_rows = {
+            row[0]: row[1]
+            for row in writer_conn.execute("SELECT id, rowid FROM buckets")
+        }  # type: Dict[str, int]
+        self._writer = threading.Thread(
+            target=self._write_loop,
+            args=(writer_conn,),
+            name="aw-server-sqlite-writer",
+            daemon=True,
+        )
+        self._writer.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.filepath,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            # Transactions are managed explicitly
+            isolation_level=None,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Durable at checkpoints, which is enough for activity data and much faster
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        """Connection for reads, one per thread"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _write_loop(self, conn: sqlite3.Connection) -> None:
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < GROUP_COMMIT_MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                # Closing, but the writes queued before have to be done first
+                batch.pop()
+                self._commit(conn, batch)
+                conn.close()
+                return
+            self._commit(conn, batch)
+
+    def _commit(
+        self,
+        conn: sqlite3.Connection,
+        batch: List[Tuple[Callable[[sqlite3.Connection], Any], Future]],
+    ) -> None:
+        results = []  # type: List[Tuple[Future, Any, Optional[BaseException]]]
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for write, future in batch:
+                # A failing write is rolled back without affecting the others
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((future, write(conn), None))
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            logger.exception("Failed to commit writes")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for future, result, exception in results:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+    def _write(self, write: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Run write on the writer thread and wait until it is committed"""
+        if not self._writer.is_alive():
+            raise RuntimeError("The storage has been closed")
+        future = Future()  # type: Future
+        self._queue.put((write, future))
+        return future.result()
+
+    def close(self) -> None:
+        """Commit the queued writes and stop the writer thread"""
+        if self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join()
+
+    def _bucket_row(self, bucket_id: str) -> int:
+        try:
+            return self._bucket_rows[bucket_id]
+        except KeyError:
+            raise ValueError(f"Bucket {bucket_id} did not exist")
+
+    def buckets(self) -> Dict[str, Dict[str, Any]]:
+        rows = self._conn.execute(f"SELECT {_BUCKET_COLUMNS} FROM buckets")
+        return {row[1]: _bucket_json(row) for row in rows}
+
+    def create_bucket(
+        self,
+        bucket_id: str,
+        type_id: str,
+        client: str,
+        hostname: str,
+        created: str,
+        name: Optional[str] = None,
+        data: Optional[dict] = None,
+    ) -> None:
+        row = (
+            bucket_id,
+            name,
+            type_id,
+            client,
+            hostname,
+            created,
+            json.dumps(data or {}),
+        )
+        self._bucket_rows[bucket_id] = self._write(
+            lambda conn: conn.execute(
+                "INSERT INTO buckets(id, name, type, client, hostname, created, datastr)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                row,
+            ).lastrowid
+        )
+
+    def update_bucket(
+        self,
+        bucket_id: str,
+        type_id: Optional[str] = None,
+        client: Optional[str] = None,
+        hostname: Optional[str] = None,
+        name: Optional[str] = None,
+        data: Optional[dict] = None,
+    ) -> None:
+        bucketrow = self._bucket_row(bucket_id)
+        updates = [
+            (column, value)
+            for column, value in [
+                ("type", type_id),
+                ("client", client),
+                ("hostname", hostname),
+                ("name", name),
+                ("datastr", json.dumps(data) if data is not None else None),
+            ]
+            if value is not None
+        ]
+        if not updates:
+            return
+        sql = "UPDATE buckets SET {} WHERE rowid = ?".format(
+            ", ".join(f"{column} = ?" for column, _ in updates)
+        )
+        self._write(
+            lambda conn: conn.execute(sql, [v for _, v in updates] + [bucketrow])
+        )
+
+    def delete_bucket(self, bucket_id: str) -> None:
+        if bucket_id not in self._bucket_rows:
+            raise ValueError("Bucket did not exist, could not delete")
+
+        bucketrow = self._bucket_rows[bucket_id]
+
+        def write(conn):
+            conn.execute("DELETE FROM events WHERE bucketrow = ?", (bucketrow,))
+            conn.execute("DELETE FROM buckets WHERE rowid = ?", (bucketrow,))
+
+        self._write(write)
+        del self._bucket_rows[bucket_id]
+
+    def get_metadata(self, bucket_id: str) -> Dict[str, Any]:
+        row = self._conn.execute(
+            f"SELECT {_BUCKET_COLUMNS} FROM buckets WHERE id = ?", (bucket_id,)
+        ).fetchone()
+        if row is None:
+            raise ValueError("Bucket did not exist, could not get metadata")
+        return _bucket_json(row)
+
+    def insert_one(self, bucket_id: str, event: Event) -> Event:
+        if event.id is not None:
+            self.replace(bucket_id, event.id, event)
+            return event
+        bucketrow = self._bucket_row(bucket_id)
+        row = _event_row(event)
+        event.id = self._write(
+            lambda conn: conn.execute(_INSERT_EVENT, (bucketrow, *row)).lastrowid
+        )
+        return event
+
+    def insert_many(self, bucket_id: str, events: List[Event]) -> None:
+        bucketrow = self._bucket_row(bucket_id)
+        updates = [
+            (*_event_row(e), e.id, bucketrow) for e in events if e.id is not None
+        ]
+        inserts = [(bucketrow, *_event_row(e)) for e in events if e.id is None]
+
+        def write(conn):
+            conn.executemany(_UPDATE_EVENT, updates)
+            conn.executemany(_INSERT_EVENT, inserts)
+
+        self._write(write)
+
+    def delete(self, bucket_id: str, event_id: int) -> bool:
+        bucketrow = self._bucket_row(bucket_id)
+        return self._write(
+            lambda conn: conn.execute(
+                "DELETE FROM events WHERE id = ? AND bucketrow = ?",
+                (event_id, bucketrow),
+            ).rowcount
+            == 1
+        )
+
+    def replace(self, bucket_id: str, event_id: int, event: Event) -> bool:
+        bucketrow = self._bucket_row(bucket_id)
+        row = _event_row(event)
+        return self._write(
+            lambda conn: conn.execute(
+                _UPDATE_EVENT, (*row, event_id, bucketrow)
+            ).rowcount
+            == 1
+        )
+
+    def replace_last(self, bucket_id: str, event: Event) -> None:
+        bucketrow = self._bucket_row(bucket_id)
+        row = _event_row(event)
+
+        def write(conn):
+            last = conn.execute(_LAST_EVENT_ID, (bucketrow,)).fetchone()
+            if last is not None:
+                conn.execute(_UPDATE_EVENT, (*row, last[0], bucketrow))
+                event.id = last[0]
+
+        self._write(write)
+
+    def get_event(self, bucket_id: str, event_id: int) -> Optional[Event]:
+        row = self._conn.execute(
+            "SELECT id, starttime, endtime, datastr FROM events"
+            " WHERE id = ? AND bucketrow = ?",
+            (event_id, self._bucket_row(bucket_id)),
+        ).fetchone()
+        return _row_to_event(row) if row is not None else None
+
+    def _range(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime],
+        endtime: Optional[datetime],
+    ) -> Tuple[int, int, int]:
+        return (
+            self._bucket_row(bucket_id),
+            _to_us(starttime) if starttime else 0,
+            _to_us(endtime) if endtime else MAX_TIMESTAMP,
+        )
+
+    def get_events(
+        self,
+        bucket_id: str,
+        limit: int,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        if limit == 0:
+            return []
+        rows = self._conn.execute(
+            "SELECT id, starttime, endtime, datastr FROM events"
+            f" WHERE {_RANGE} ORDER BY starttime DESC, id DESC LIMIT ?",
+            (*self._range(bucket_id, starttime, endtime), limit),
+        )
+        events = [_row_to_event(row) for row in rows]
+
+        # Trim events that are out of range, like PeeweeStorage
+        for e in events:
+            if starttime and e.timestamp < starttime:
+                e_end = e.timestamp + e.duration
+                e.timestamp = starttime
+                e.duration = e_end - e.timestamp
+            if endtime and e.timestamp + e.duration > endtime:
+                e.duration = endtime - e.timestamp
+        return events
+
+    def get_events_before(
+        self,
+        bucket_id: str,
+        limit: int,
+        before: Optional[Tuple[datetime, int]],
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> List[Event]:
+        """
+        Like get_events, but only the events ordered before the (timestamp, id)
+        key before (if any), and without trimming them to the range.
+        """
+        if limit == 0:
+            return []
+        query = f"SELECT id, starttime, endtime, datastr FROM events WHERE {_RANGE}"
+        params = self._range(bucket_id, starttime, endtime)  # type: Tuple
+        if before is not None:
+            # A seek on the starttime index
+            query += " AND (starttime < ? OR (starttime = ? AND id < ?))"
+            timestamp = _to_us(before[0])
+            params += (timestamp, timestamp, before[1])
+        rows = self._conn.execute(
+            query + " ORDER BY starttime DESC, id DESC LIMIT ?", (*params, limit)
+        )
+        return [_row_to_event(row) for row in rows]
+
+    def get_eventcount(
+        self,
+        bucket_id: str,
+        starttime: Optional[datetime] = None,
+        endtime: Optional[datetime] = None,
+    ) -> int:
+        return self._conn.execute(
+            f"SELECT count(*) FROM events WHERE {_RANGE}",
+            self._range(bucket_id, starttime, endtime),
+        ).fetchone()[0]
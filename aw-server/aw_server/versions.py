@@ -0,0 +1,103 @@
+import itertools
+import threading
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import (
+    Deque,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+# Number of writes remembered per bucket to tell which time range they touched
+WRITE_LOG_SIZE = 1000
+
+
+class BucketVersions:
+    """
+    Keeps a version for every bucket that changes whenever the bucket is written to.
+
+    Versions are unique across buckets (and recreations of a bucket), so a
+    version seen before always refers to the same state of the same bucket.
+    Together with a token that changes whenever versions are forgotten (like on
+    restarts), they identify states across the life of the server, see etag.
+    For the latest writes to each bucket the earliest event time they touched is
+    remembered, which lets caches of closed periods survive writes to newer data.
+    """
+
+    def __init__(self, log_size: int = WRITE_LOG_SIZE) -> None:
+        self._counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self._token = uuid.uuid4().hex[:8]
+        # Version of the last write or removal of any bucket
+        self._latest = 0
+        self._versions = {}  # type: Dict[str, int]
+        # (version, previous version, earliest time touched or None if unknown)
+        self._log = (
+            {}
+        )  # type: Dict[str, Deque[Tuple[int, Optional[int], Optional[datetime]]]]
+        self._log_size = log_size
+
+    def get(self, bucket_id: str) -> Optional[int]:
+        return self._versions.get(bucket_id)
+
+    def bump(self, bucket_id: str, since: Optional[datetime] = None) -> int:
+        """Record a write to events starting at or after since (None if unknown)"""
+        with self._lock:
+            version = self._latest = next(self._counter)
+            previous = self._versions.get(bucket_id)
+            self._versions[bucket_id] = version
+            if bucket_id not in self._log:
+                self._log[bucket_id] = deque(maxlen=self._log_size)
+            self._log[bucket_id].append((version, previous, since))
+            return version
+
+    def remove(self, bucket_id: str) -> None:
+        with self._lock:
+            self._latest = next(self._counter)
+            self._versions.pop(bucket_id, None)
+            self._log.pop(bucket_id, None)
+
+    def clear(self) -> None:
+        """Forget all versions, as if every bucket had been rewritten"""
+        with self._lock:
+            self._token = uuid.uuid4().hex[:8]
+            self._versions = {}
+            self._log = {}
+
+    def etag(self, bucket_id: Optional[str] = None) -> str:
+        """
+        Entity tag of the current state of a bucket, or of all buckets if None.
+
+        Buckets that haven't been written to since versions were last forgotten
+        have no version, which the token tells apart from earlier states.
+        """
+        with self._lock:
+            if bucket_id is None:
+                return f"{self._token}-{self._latest}"
+            return f"{self._token}-{self._versions.get(bucket_id, 0)}"
+
+    def unchanged_before(self, bucket_id: str, version: int, time: datetime) -> bool:
+        """
+        Check that no event starting before time has been written to the
+        bucket since it was at the given version.
+        """
+        with self._lock:
+            current = self._versions.get(bucket_id)
+            if current == version:
+                return True
+            if current is None:
+                return False
+            # All writes since version have to still be in the log, which is
+            # the case if the write right after it is
+            writes = itertools.dropwhile(
+                lambda write: write[1] != version, self._log[bucket_id]
+            )
+            first = next(writes, None)
+            if first is None:
+                return False
+            return all(
+                since is not None and since >= time
+                for _, _, since in itertools.chain([first], writes)
+            )
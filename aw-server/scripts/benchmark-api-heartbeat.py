@@ -1,13 +1,24 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
 from time import sleep
 import cProfile
 import pstats
 from datetime import timezone as tz
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from aw_core.models import Event
 
 import aw_datastore
 import aw_server
+from aw_server.storages import SqliteStorage
+
+STORAGES = {
+    "peewee": aw_datastore.storages.PeeweeStorage,
+    "sqlite": SqliteStorage,
+}
 
 
 def benchmark():
@@ -31,9 +42,64 @@ def benchmark():
             Event(timestamp=datetime.now(tz=tz.utc), data={"test": str(int(i))}),
             pulsetime=0.3,
         )
+    print(api.get_heartbeat_lock_stats())
 
 
-if __name__ == "__main__":
+def throughput(storage: str, heartbeats: int, threads: int) -> float:
+    """Send heartbeats as fast as possible from a number of threads (one bucket each)"""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ds = aw_datastore.Datastore(
+            STORAGES[storage], testing=True, filepath=os.path.join(tmpdir, "bench.db")
+        )
+        api = aw_server.api.ServerAPI(ds, testing=True)
+        start = datetime.now(tz=tz.utc) - timedelta(seconds=heartbeats)
+
+        def send(thread: int):
+            bucket_id = f"test-benchmark-{thread}"
+            api.create_bucket(bucket_id, "test", "test", "test")
+            for i in range(heartbeats // threads):
+                # Every other heartbeat is merged, the others are inserted
+                api.heartbeat(
+                    bucket_id,
+                    Event(
+                        timestamp=start + timedelta(seconds=i),
+                        data={"test": str(i // 2)},
+                    ),
+                    pulsetime=1,
+                )
+
+        workers = [threading.Thread(target=send, args=(t,)) for t in range(threads)]
+        t0 = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - t0
+        api.close()
+    return heartbeats / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark heartbeats, profiling them or comparing the throughput of storages"
+    )
+    parser.add_argument(
+        "--compare",
+        nargs="*",
+        choices=list(STORAGES),
+        help="Compare the heartbeat throughput of storages instead of profiling",
+    )
+    parser.add_argument("--heartbeats", type=int, default=2000)
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 8])
+    args = parser.parse_args()
+
+    if args.compare is not None:
+        for storage in args.compare or list(STORAGES):
+            for threads in args.threads:
+                rate = throughput(storage, args.heartbeats, threads)
+                print(f"{storage:8} {threads:3} threads: {rate:8.0f} heartbeats/s")
+        return
+
     f_bench = "benchmark.dat"
     cProfile.run("benchmark()", f_bench)
     p = pstats.Stats(f_bench)
@@ -41,3 +107,7 @@ if __name__ == "__main__":
     # p.sort_stats('tottime')
     p.sort_stats("cumulative")
     p.print_stats(20)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Compare the request throughput and latency of the server modes.
+
+Runs aw-server (in testing mode, with the memory storage) under the Werkzeug
+development server and under the production server, and sends a mix of
+heartbeats and reads from a number of concurrent clients. Every client keeps
+a connection open, if the server allows it.
+
+Requires cheroot to be installed for the production mode.
+"""
+
+import argparse
+import http.client
+import json
+import statistics
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import List, Tuple
+
+from werkzeug.serving import make_server
+
+from aw_server.log import FlaskLogHandler
+from aw_server.server import AWFlask, _production_server
+
+HOST = "127.0.0.1"
+PORT = 5667
+
+
+def start(mode: str, app: AWFlask, threads: int):
+    """Start a server in the mode in a thread, returns a function stopping it"""
+    if mode == "production":
+        server = _production_server(app, HOST, PORT, threads, 100, 10)
+        server.prepare()
+        thread = threading.Thread(target=server.serve, daemon=True)
+        thread.start()
+        return server.stop
+    else:
+        # Like app.run(threaded=True)
+        server = make_server(
+            HOST, PORT, app, threaded=True, request_handler=FlaskLogHandler
+        )
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server.shutdown
+
+
+def client(n: int, requests: int, latencies: List[float]) -> None:
+    bucket_id = f"benchmark-{n}"
+    conn = http.client.HTTPConnection(HOST, PORT)
+
+    def request(method: str, path: str, body=None) -> None:
+        t0 = time.perf_counter()
+        conn.request(
+            method,
+            path,
+            body=json.dumps(body) if body is not None else None,
+            headers={"Content-Type": "application/json"},
+        )
+        response = conn.getresponse()
+        response.read()
+        latencies.append(time.perf_counter() - t0)
+        assert response.status == 200, response.status
+
+    request(
+        "POST",
+        f"/api/0/buckets/{bucket_id}",
+        {"client": "benchmark", "type": "test", "hostname": "test"},
+    )
+    start = datetime.now(timezone.utc) - timedelta(seconds=requests)
+    for i in range(requests):
+        if i % 4 == 3:
+            request("GET", f"/api/0/buckets/{bucket_id}/events?limit=10")
+        elif i % 4 == 2:
+            request("GET", "/api/0/buckets/")
+        else:
+            heartbeat = {
+                "timestamp": (start + timedelta(seconds=i)).isoformat(),
+                "duration": 0,
+                "data": {"i": i // 8},
+            }
+            request(
+                "POST", f"/api/0/buckets/{bucket_id}/heartbeat?pulsetime=2", heartbeat
+            )
+    conn.close()
+
+
+def benchmark(mode: str, clients: int, requests: int, threads: int) -> Tuple:
+    app = AWFlask(HOST, testing=True, cors_origins=[])
+    stop = start(mode, app, threads)
+    latencies = []  # type: List[float]
+    try:
+        workers = [
+            threading.Thread(target=client, args=(n, requests, latencies))
+            for n in range(clients)
+        ]
+        t0 = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - t0
+    finally:
+        stop()
+        app.api.close()
+    latencies.sort()
+    return (
+        len(latencies) / elapsed,
+        statistics.median(latencies),
+        latencies[int(len(latencies) * 0.99)],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the request throughput of the server modes"
+    )
+    parser.add_argument("--modes", nargs="+", default=["development", "production"])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=500, help="per client")
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        for clients in args.clients:
+            rate, p50, p99 = benchmark(mode, clients, args.requests, args.threads)
+            print(
+                f"{mode:12} {clients:3} clients: {rate:7.0f} requests/s, "
+                f"p50 {p50 * 1000:6.1f} ms, p99 {p99 * 1000:6.1f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,22 @@
+import gzip
+import http.client
+import io
+import json
+import logging
 import random
-from datetime import datetime, timedelta
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 
 import pytest
+from aw_core.models import Event
+from aw_datastore import Datastore
+from aw_datastore.storages import MemoryStorage, PeeweeStorage
+from aw_server import fast_json, json_stream, log_tail
+from aw_server.api import ServerAPI
+from aw_server.server import _production_server
+from aw_server.storages import EventLogStorage, IndexedMemoryStorage, SqliteStorage
+from aw_server.storages import eventlog
 
 
 @pytest.fixture()
@@ -88,4 +103,836 @@ def test_get_events(flask_client, bucket, benchmark):
         assert len(r.json) == n_events
 
 
+def test_bucket_registry(flask_client):
+    bucket_id = "test-registry"
+    r = flask_client.get(f"/api/0/buckets/{bucket_id}")
+    assert r.status_code == 404
+
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket_id}",
+        json={"client": "test", "type": "test", "hostname": "test"},
+    )
+    assert r.status_code == 200
+    r = flask_client.get(f"/api/0/buckets/{bucket_id}")
+    assert r.status_code == 200
+    assert r.json["type"] == "test"
+    assert bucket_id in flask_client.get("/api/0/buckets/").json
+
+    r = flask_client.delete(f"/api/0/buckets/{bucket_id}")
+    assert r.status_code == 200
+    r = flask_client.get(f"/api/0/buckets/{bucket_id}/events")
+    assert r.status_code == 404
+
+
+def test_buckets_last_updated(flask_client, bucket):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    assert "last_updated" not in flask_client.get("/api/0/buckets/").json[bucket]
+    for i in range(2):
+        r = flask_client.post(
+            f"/api/0/buckets/{bucket}/heartbeat?pulsetime=5",
+            json={
+                "timestamp": (now + timedelta(seconds=i)).isoformat(),
+                "duration": 0,
+                "data": {"label": "test"},
+            },
+        )
+        assert r.status_code == 200
+    last_updated = flask_client.get("/api/0/buckets/").json[bucket]["last_updated"]
+    assert last_updated == (now + timedelta(seconds=1)).isoformat()
+
+
+def test_heartbeat_write_behind():
+    api = ServerAPI(
+        Datastore(MemoryStorage, testing=True),
+        testing=True,
+        heartbeat_flush_interval=3600,
+    )
+    bucket_id = "test-write-behind"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    for i in range(3):
+        api.heartbeat(
+            bucket_id, Event(timestamp=now + timedelta(seconds=i), data={"a": 1}), 5
+        )
+    # The merged event is only held in memory...
+    assert api.db[bucket_id].get(limit=1)[0].duration == timedelta(0)
+    # ...until the bucket is read from
+    events = api.get_events(bucket_id)
+    assert len(events) == 1
+    assert events[0]["duration"] == 2
+
+    api.heartbeat(
+        bucket_id, Event(timestamp=now + timedelta(seconds=3), data={"a": 1}), 5
+    )
+    api.close()
+    assert api.db[bucket_id].get(limit=1)[0].duration == timedelta(seconds=3)
+
+
+def test_heartbeat_concurrent():
+    api = ServerAPI(Datastore(MemoryStorage, testing=True), testing=True)
+    bucket_id = "test-concurrent"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+
+    def send(i):
+        api.heartbeat(
+            bucket_id, Event(timestamp=now + timedelta(seconds=i), data={"a": 1}), 60
+        )
+
+    send(0)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(send, range(1, 50)))
+    events = api.get_events(bucket_id)
+    assert len(events) == 1
+    assert api.get_heartbeat_lock_stats()["acquired"] == 50
+
+
+def test_heartbeats_batch(flask_client, bucket):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    heartbeats = [
+        {
+            "timestamp": (now + timedelta(seconds=i)).isoformat(),
+            "duration": 0,
+            "data": {"label": "a" if i < 5 else "b"},
+        }
+        for i in range(10)
+    ]
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeats?pulsetime=2", json=heartbeats[:3]
+    )
+    assert r.status_code == 200
+    r = flask_client.post(
+        f"/api/0/buckets/{bucket}/heartbeats?pulsetime=2", json=heartbeats[3:]
+    )
+    assert r.status_code == 200
+    assert r.json["data"] == {"label": "b"}
+    assert r.json["duration"] == 4
+
+    events = flask_client.get(f"/api/0/buckets/{bucket}/events").json
+    assert [e["duration"] for e in events] == [4, 4]
+
+
+def test_export(flask_client, bucket):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    events = [
+        {"timestamp": (now - timedelta(hours=i)).isoformat(), "data": {"i": i}}
+        for i in range(10)
+    ]
+    r = flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+    assert r.status_code == 200
+
+    r = flask_client.get("/api/0/export")
+    assert r.status_code == 200
+    export = json.loads(r.data)
+    assert export == {"buckets": flask_client.application.api.export_all()}
+    assert len(export["buckets"][bucket]["events"]) == 10
+    assert "id" not in export["buckets"][bucket]["events"][0]
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export")
+    assert r.status_code == 200
+    assert json.loads(r.data)["buckets"][bucket] == export["buckets"][bucket]
+
+
+def test_iter_events_pages():
+    api = ServerAPI(Datastore(MemoryStorage, testing=True), testing=True)
+    bucket_id = "test-iter-events"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    # Include several events with the same timestamp to straddle page boundaries
+    timestamps = [now - timedelta(seconds=i // 4) for i in range(20)]
+    api.create_events(
+        bucket_id,
+        [Event(timestamp=ts, data={"i": i}) for i, ts in enumerate(timestamps)],
+    )
+    events = list(api.iter_events(bucket_id, page_size=3))
+    assert sorted(e.data["i"] for e in events) == list(range(20))
+    assert [e.timestamp for e in events] == sorted(timestamps, reverse=True)
+
+
+def test_import(flask_client, bucket):
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    events = [
+        {"timestamp": (now - timedelta(hours=i)).isoformat(), "data": {"i": i}}
+        for i in range(10)
+    ]
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+    export = json.loads(flask_client.get(f"/api/0/buckets/{bucket}/export").data)
+
+    r = flask_client.post("/api/0/import", json=export)
+    assert r.status_code == 400
+
+    # Resuming the import of a complete bucket skips all its events
+    r = flask_client.post("/api/0/import?resume=1", json=export)
+    assert r.status_code == 200
+    assert r.json["imported"] == {bucket: 0}
+
+    flask_client.delete(f"/api/0/buckets/{bucket}")
+    r = flask_client.post("/api/0/import", json=export)
+    assert r.status_code == 200
+    assert r.json["imported"] == {bucket: 10}
+    assert flask_client.get("/api/0/import").json["events"] == 10
+    reexport = json.loads(flask_client.get(f"/api/0/buckets/{bucket}/export").data)
+    assert reexport["buckets"][bucket]["events"] == export["buckets"][bucket]["events"]
+
+
+def test_export_columnar(flask_client, bucket):
+    now = datetime.now(timezone.utc)
+    events = [
+        {
+            "timestamp": (now - timedelta(minutes=i)).isoformat(),
+            "duration": i / 3,
+            "data": (
+                {"app": f"app{i % 3}", "nested": {"x": [i % 2]}}
+                if i % 4
+                else {"title": None}
+            ),
+        }
+        for i in range(20)
+    ]
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+    export = json.loads(flask_client.get(f"/api/0/buckets/{bucket}/export").data)
+
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export?format=columnar")
+    assert r.status_code == 200
+    assert r.mimetype == "application/zip"
+    columnar = r.data
+    assert len(columnar) < len(json.dumps(export))
+    r = flask_client.get(f"/api/0/buckets/{bucket}/export?format=xml")
+    assert r.status_code == 400
+
+    flask_client.delete(f"/api/0/buckets/{bucket}")
+    r = flask_client.post(
+        "/api/0/import", data=columnar, content_type="application/zip"
+    )
+    assert r.status_code == 200
+    assert r.json["imported"] == {bucket: 20}
+    reexport = json.loads(flask_client.get(f"/api/0/buckets/{bucket}/export").data)
+    assert reexport["buckets"][bucket]["events"] == export["buckets"][bucket]["events"]
+
+
+def test_query2_cache(monkeypatch):
+    api = ServerAPI(Datastore(MemoryStorage, testing=True), testing=True)
+    api.create_bucket("test-cache", "test", "test", "test")
+    api.create_bucket("test-other", "test", "test", "test")
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0)
+    yesterday = today - timedelta(days=1)
+    api.create_events("test-cache", [Event(timestamp=yesterday, duration=60)])
+    timeperiods = [
+        f"{yesterday.isoformat()}/{today.isoformat()}",
+        f"{today.isoformat()}/{(today + timedelta(days=1)).isoformat()}",
+    ]
+    query = ['events = query_bucket("test-cache");\n', "  RETURN = events;"]
+
+    calls = []
+    run_query = api._run_query
+    monkeypatch.setattr(
+        api, "_run_query", lambda *args: calls.append(args[2]) or run_query(*args)
+    )
+
+    def run(name="test"):
+        calls.clear()
+        return api.query2(name, query, timeperiods, True)
+
+    assert len(run()[0]) == 1
+    assert len(calls) == 2
+    run()
+    assert calls == []
+    # Writes to unrelated buckets don't invalidate the cache
+    api.create_events("test-other", [Event(timestamp=yesterday)])
+    run()
+    assert calls == []
+    # Writes to today leave the result for yesterday cached
+    api.heartbeat("test-cache", Event(timestamp=today + timedelta(hours=1)), 60)
+    assert len(run()[1]) == 1
+    assert calls == [today]
+    api.create_events("test-cache", [Event(timestamp=yesterday + timedelta(hours=1))])
+    assert len(run()[0]) == 2
+    assert len(calls) == 2
+    # Unnamed queries aren't cached
+    run(name="")
+    assert len(calls) == 2
+
+
+def test_query2_parallel():
+    api = ServerAPI(
+        Datastore(MemoryStorage, testing=True), testing=True, query_workers=4
+    )
+    api.create_bucket("test-parallel", "test", "test", "test")
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    api.create_events(
+        "test-parallel",
+        [
+            Event(timestamp=start + timedelta(days=i), data={"day": i})
+            for i in range(10)
+        ],
+    )
+    timeperiods = [
+        f"{(start + timedelta(days=i)).isoformat()}/{(start + timedelta(days=i + 1)).isoformat()}"
+        for i in range(10)
+    ]
+    query = ['events = query_bucket("test-parallel");', "RETURN = events;"]
+    result = api.query2("", query, timeperiods, False)
+    assert [events[-1]["data"]["day"] for events in result] == list(range(10))
+    api.close()
+
+
+def test_query2_incremental(monkeypatch):
+    api = ServerAPI(Datastore(MemoryStorage, testing=True), testing=True)
+    api.create_bucket("test-window", "test", "test", "test")
+    api.create_bucket("test-afk", "test", "test", "test")
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0)
+    timeperiods = [f"{today.isoformat()}/{(today + timedelta(days=1)).isoformat()}"]
+    query = [
+        'events = query_bucket("test-window");',
+        'not_afk = query_bucket("test-afk");',
+        'not_afk = filter_keyvals(not_afk, "status", ["not-afk"]);',
+        "events = filter_period_intersect(events, not_afk);",
+        'apps = sort_by_duration(merge_events_by_keys(events, ["app"]));',
+        'RETURN = {"apps": apps, "duration": sum_durations(events), "events": events};',
+    ]
+    api.heartbeat(
+        "test-afk", Event(timestamp=today, data={"status": "not-afk"}), pulsetime=60
+    )
+    calls = []
+    run_query = api._run_query
+    monkeypatch.setattr(
+        api, "_run_query", lambda *args: calls.append(args) or run_query(*args)
+    )
+
+    for i in range(20):
+        timestamp = today + timedelta(seconds=10 * i)
+        api.heartbeat(
+            "test-afk",
+            Event(timestamp=timestamp, data={"status": "afk" if i == 5 else "not-afk"}),
+            pulsetime=60,
+        )
+        api.heartbeat(
+            "test-window",
+            Event(timestamp=timestamp, data={"app": f"app{i // 3 % 3}"}),
+            pulsetime=60,
+        )
+        calls.clear()
+        result = api.query2("test", query, timeperiods, True, True)
+        evaluations = len(calls)
+        assert result == api.query2("", query, timeperiods, False)
+    # Only the events after the split were evaluated in the last round
+    assert evaluations == 1
+    assert result[0]["duration"] == timedelta(seconds=120)
+
+
+def test_rollups(flask_client, bucket):
+    hour = datetime(2020, 1, 1, 10, tzinfo=timezone.utc)
+    events = [
+        {
+            "timestamp": hour - timedelta(minutes=30),
+            "duration": 3600,
+            "data": {"app": "a"},
+        },
+        {
+            "timestamp": hour + timedelta(minutes=30),
+            "duration": 60,
+            "data": {"app": "b"},
+        },
+    ]
+    r = flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+    assert r.status_code == 200
+    for i in range(3):
+        r = flask_client.post(
+            f"/api/0/buckets/{bucket}/heartbeat?pulsetime=120",
+            json={
+                "timestamp": hour + timedelta(hours=1, minutes=i),
+                "duration": 0,
+                "data": {"app": "b"},
+            },
+        )
+        assert r.status_code == 200
+    event_id = flask_client.get(f"/api/0/buckets/{bucket}/events?limit=1").json[0]
+    # Replaces the merged event above
+    flask_client.delete(f"/api/0/buckets/{bucket}/events/{event_id['id']}")
+    flask_client.post(
+        f"/api/0/buckets/{bucket}/events",
+        json={
+            "timestamp": hour + timedelta(hours=1),
+            "duration": 180,
+            "data": {"app": "b"},
+        },
+    )
+
+    def rollups(**params):
+        r = flask_client.get(
+            "/api/0/rollups", query_string={"bucket": bucket, "key": "app", **params}
+        )
+        assert r.status_code == 200
+        return [(e["timestamp"], e["data"]["app"], e["duration"]) for e in r.json]
+
+    hourly = rollups(resolution="hour", start=hour.isoformat())
+    assert hourly == [
+        (hour.isoformat(), "a", 1800),
+        (hour.isoformat(), "b", 60),
+        ((hour + timedelta(hours=1)).isoformat(), "b", 180),
+    ]
+    assert rollups() == [
+        (datetime(2020, 1, 1, tzinfo=timezone.utc).isoformat(), "a", 3600),
+        (datetime(2020, 1, 1, tzinfo=timezone.utc).isoformat(), "b", 240),
+    ]
+    flask_client.application.api.rebuild_rollups([bucket])
+    assert rollups(resolution="hour", start=hour.isoformat()) == hourly
+    r = flask_client.get("/api/0/rollups", query_string={"resolution": "week"})
+    assert r.status_code == 400
+
+
+def test_eventcount_cache(monkeypatch):
+    api = ServerAPI(Datastore(MemoryStorage, testing=True), testing=True)
+    bucket_id = "test-eventcount"
+    api.create_bucket(bucket_id, "test", "test", "test")
+    day = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    api.create_events(
+        bucket_id,
+        [Event(timestamp=day + timedelta(hours=i), data={"i": i}) for i in range(48)],
+    )
+    api.heartbeat(bucket_id, Event(timestamp=day + timedelta(days=3), data={}), 0)
+
+    storage = api.db.storage_strategy
+    get_eventcount = storage.get_eventcount
+    monkeypatch.setattr(storage, "get_eventcount", None)
+    assert api.get_eventcount(bucket_id) == 49
+    assert api.get_eventcount(bucket_id, day, day + timedelta(days=1)) == 24
+    assert api.get_eventcount(bucket_id, start=day + timedelta(days=1)) == 25
+    assert api.get_eventcount(bucket_id, end=day - timedelta(days=1)) == 0
+
+    event = api.get_events(bucket_id, limit=1)[0]
+    api.delete_event(bucket_id, event["id"])
+    assert api.get_eventcount(bucket_id) == 48
+    assert api.get_eventcount(bucket_id, start=day + timedelta(days=2)) == 0
+
+    # Counts over unaligned ranges are read from storage
+    monkeypatch.setattr(storage, "get_eventcount", get_eventcount)
+    start = day + timedelta(minutes=30)
+    assert api.get_eventcount(bucket_id, start, start + timedelta(hours=1)) == 1
+
+
+def test_indexed_memory_storage():
+    rng = random.Random(0)
+    storages = [MemoryStorage(testing=True), IndexedMemoryStorage(testing=True)]
+    for storage in storages:
+        storage.create_bucket("test", "test", "test", "test", datetime.now())
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    for i in range(200):
+        event = Event(
+            timestamp=start + timedelta(minutes=rng.randrange(100)),
+            duration=rng.randrange(600),
+            data={"i": i},
+        )
+        for storage in storages:
+            storage.insert_one("test", event)
+        if i % 10 == 9:
+            for storage in storages:
+                storage.delete("test", i // 2)
+                storage.replace_last("test", Event(timestamp=event.timestamp, data={}))
+
+    for _ in range(20):
+        a, b = sorted(start + timedelta(minutes=rng.randrange(110)) for _ in range(2))
+        limit = rng.choice([-1, 5])
+        events, indexed_events = (
+            storage.get_events("test", limit, a, b) for storage in storages
+        )
+        assert events == indexed_events
+        counts = [storage.get_eventcount("test", a, b) for storage in storages]
+        assert counts[0] == counts[1]
+
+
+def test_sqlite_storage(tmp_path):
+    filepath = str(tmp_path / "sqlite.db")
+    storage = SqliteStorage(testing=True, filepath=filepath)
+    storage.create_bucket("test", "test", "test", "test", datetime.now().isoformat())
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+    def insert(i):
+        return storage.insert_one(
+            "test", Event(timestamp=start + timedelta(seconds=i), duration=1)
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        ids = [e.id for e in executor.map(insert, range(100))]
+    assert len(set(ids)) == 100
+    storage.insert_many(
+        "test", [Event(timestamp=start - timedelta(seconds=i)) for i in range(1, 11)]
+    )
+    storage.replace_last(
+        "test", Event(timestamp=start + timedelta(seconds=99), duration=5)
+    )
+    assert storage.delete("test", ids[0])
+    storage.close()
+
+    storage = SqliteStorage(testing=True, filepath=filepath)
+    assert list(storage.buckets()) == ["test"]
+    assert storage.get_eventcount("test") == 109
+    events = storage.get_events("test", 2)
+    assert [e.duration for e in events] == [timedelta(seconds=5), timedelta(seconds=1)]
+    events = storage.get_events(
+        "test", -1, start + timedelta(seconds=0.5), start + timedelta(seconds=2.5)
+    )
+    assert [e.timestamp for e in events] == [
+        start + timedelta(seconds=2),
+        start + timedelta(seconds=1),
+    ]
+    assert events[1].duration == timedelta(seconds=1)
+    storage.close()
+
+
+def test_eventlog_storage(tmp_path, monkeypatch):
+    monkeypatch.setattr(eventlog, "BLOCK_SIZE", 8)
+    rng = random.Random(0)
+    path = str(tmp_path / "eventlog")
+    storages = [
+        SqliteStorage(testing=True, filepath=str(tmp_path / "sqlite.db")),
+        EventLogStorage(testing=True, filepath=path),
+    ]
+    for storage in storages:
+        storage.create_bucket("test", "test", "test", "test", "2020-01-01")
+    start = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    ids = [[], []]
+    for i in range(200):
+        # Mostly in order, like heartbeats
+        timestamp = start + timedelta(seconds=i * 10 + rng.choice([0, 0, -200]))
+        for storage, storage_ids in zip(storages, ids):
+            if i % 3 == 0:
+                storage.replace_last(
+                    "test", Event(timestamp=timestamp, duration=i, data={"i": i})
+                )
+            else:
+                event = Event(timestamp=timestamp, duration=30, data={"i": i})
+                storage_ids.append(storage.insert_one("test", event).id)
+            if i % 7 == 6:
+                assert storage.delete("test", storage_ids.pop(len(storage_ids) // 2))
+
+    def check(storages):
+        for _ in range(20):
+            a, b = sorted(
+                start + timedelta(seconds=rng.randrange(2000)) for _ in range(2)
+            )
+            for limit in [-1, 3]:
+                sqlite_events, log_events = (
+                    [
+                        (e.timestamp, e.duration, e.data)
+                        for e in s.get_events("test", limit, a, b)
+                    ]
+                    for s in storages
+                )
+                assert sqlite_events == log_events
+            counts = [s.get_eventcount("test", a, b) for s in storages]
+            assert counts[0] == counts[1]
+
+    check(storages)
+    storages[1].close()
+    storages[1] = EventLogStorage(testing=True, filepath=path)
+    check(storages)
+    assert storages[1].compact() > 0
+    check(storages)
+    for storage in storages:
+        storage.close()
+
+
+def test_retention():
+    api = ServerAPI(
+        Datastore(IndexedMemoryStorage, testing=True),
+        testing=True,
+        retention={"currentwindow": [[1, 60], [30, 3600]]},
+    )
+    api.create_bucket("test-window", "currentwindow", "test", "test")
+    api.create_bucket("test-afk", "afkstatus", "test", "test")
+    now = datetime(2020, 3, 1, 12, tzinfo=timezone.utc)
+    old = datetime(2020, 1, 1, 10, tzinfo=timezone.utc)
+    recent = now - timedelta(days=10)
+    # Three hours of 20 second events, the minutes of them have two values
+    events = [
+        Event(timestamp=start + timedelta(seconds=20 * i), duration=20, data=data)
+        for start in (old, recent)
+        for i, data in enumerate([{"app": "a"}, {"app": "b"}, {"app": "a"}] * 180)
+    ]
+    # Extends into the next day
+    long_event = Event(timestamp=old + timedelta(hours=13), duration=7200, data={})
+    api.create_events("test-window", events + [long_event])
+    api.create_events("test-afk", events[:10])
+    api.heartbeat("test-window", Event(timestamp=now, data={"app": "a"}), 0)
+
+    def durations(start, end):
+        rollups = api.get_rollups("hour", "app", start, end, ["test-window"])
+        return {(e["timestamp"], e["data"]["app"]): e["duration"] for e in rollups}
+
+    before = durations(old, now)
+    # The old events become hourly, the long one two events (one per day)
+    # and the recent ones per minute
+    assert api.apply_retention(now) == {"test-window": 534 - 1 + 180}
+    assert durations(old, now) == before
+    api.rebuild_rollups(["test-window"])
+    assert durations(old, now) == before
+    hourly = api.get_events(
+        "test-window", start=old, end=old + timedelta(hours=1, minutes=59)
+    )
+    assert [(e["timestamp"], e["duration"], e["data"]["app"]) for e in hourly] == [
+        ((old + timedelta(hours=1, minutes=40)).isoformat(), 1200, "b"),
+        ((old + timedelta(hours=1)).isoformat(), 2400, "a"),
+        ((old + timedelta(minutes=40)).isoformat(), 1200, "b"),
+        (old.isoformat(), 2400, "a"),
+    ]
+    assert api.get_eventcount("test-window", recent, recent + timedelta(hours=1)) == 120
+    assert api.get_eventcount("test-afk") == 10
+
+    assert api.apply_retention(now) == {"test-window": 0}
+    # Old events written later are downsampled on the next run
+    api.create_events(
+        "test-window", [Event(timestamp=old, duration=60, data={"app": "b"})]
+    )
+    assert api.apply_retention(now) == {"test-window": 1}
+    assert durations(old, old + timedelta(hours=1)) == {
+        (old.isoformat(), "a"): 2400,
+        (old.isoformat(), "b"): 1260,
+    }
+
+
+def test_production_server(app):
+    pytest.importorskip("cheroot")
+    server = _production_server(app, "127.0.0.1", 0, 4, 10, 10)
+    server.prepare()
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection(*server.bind_addr)
+        # Requests share a keep-alive connection
+        for _ in range(2):
+            conn.request("GET", "/api/0/info")
+            r = conn.getresponse()
+            assert r.status == 200
+            assert json.loads(r.read())["testing"]
+        conn.request("GET", "/api/0/info", headers={"Host": "example.com"})
+        r = conn.getresponse()
+        r.read()
+        assert r.status == 400
+    finally:
+        server.stop()
+        thread.join()
+
+
+def test_fast_json():
+    values = [
+        datetime(2020, 1, 1, 12, 30, 0, 123456, tzinfo=timezone.utc),
+        timedelta(seconds=1.5),
+        {"b": [1e-05, 1e16, 0.1, -0.0, 2**70], "a": None},
+        {1: "int key"},
+        "Café – \x7f \\U0001f600 \U0001f600",
+    ]
+    for sort_keys in [False, True]:
+        for indent in [None, 2]:
+            expected = json.dumps(
+                values,
+                default=fast_json.default,
+                sort_keys=sort_keys,
+                indent=indent,
+                separators=(",", ":") if indent is None else None,
+            )
+            assert fast_json.dumps(values, sort_keys, indent) == expected
+
+
+def test_stream_events(flask_client, bucket, tmp_path):
+    now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # Overlapping events, so that events are trimmed at page boundaries
+    events = [
+        Event(timestamp=now + timedelta(minutes=i), duration=90, data={"i": i})
+        for i in range(20)
+    ]
+    for kwargs in [{}, {"filepath": str(tmp_path / "sqlite.db")}]:
+        storage = SqliteStorage if kwargs else MemoryStorage
+        api = ServerAPI(Datastore(storage, testing=True, **kwargs), testing=True)
+        api.create_bucket("test-stream", "test", "test", "test")
+        api.create_events("test-stream", events)
+        for start, end, limit in [
+            (None, None, -1),
+            (now + timedelta(minutes=2.5), now + timedelta(minutes=15.5), -1),
+            (now + timedelta(minutes=2.5), None, 7),
+            (None, now + timedelta(minutes=15.5), 0),
+        ]:
+            streamed = api.iter_events("test-stream", start, end, limit, page_size=3)
+            assert [e.to_json_dict() for e in streamed] == api.get_events(
+                "test-stream", limit, start, end
+            )
+
+    flask_client.application.api.create_events(bucket, events)
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events?limit=5")
+    assert r.status_code == 200
+    assert r.json == flask_client.application.api.get_events(bucket, limit=5)
+
+
+def test_conditional_get(flask_client, bucket):
+    url = f"/api/0/buckets/{bucket}/events"
+    r = flask_client.get(url)
+    etag = r.headers["ETag"]
+    buckets_etag = flask_client.get("/api/0/buckets/").headers["ETag"]
+    r = flask_client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 304
+    assert r.data == b""
+    # Other buckets being written to doesn't change the tag
+    flask_client.post(
+        "/api/0/buckets/test-other",
+        json={"client": "test", "type": "test", "hostname": "test"},
+    )
+    assert flask_client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    r = flask_client.get("/api/0/buckets/", headers={"If-None-Match": buckets_etag})
+    assert r.status_code == 200
+    flask_client.delete("/api/0/buckets/test-other")
+
+    now = datetime.now(timezone.utc)
+    events = [{"timestamp": now - timedelta(seconds=i), "data": {}} for i in range(50)]
+    flask_client.post(url, json=events)
+    r = flask_client.get(url, headers={"If-None-Match": etag})
+    assert r.status_code == 200
+    assert r.headers["ETag"] != etag
+    assert len(r.json) == 50
+
+
+def test_compression(flask_client, bucket):
+    now = datetime.now(timezone.utc)
+    events = [{"timestamp": now - timedelta(seconds=i), "data": {}} for i in range(50)]
+    flask_client.post(f"/api/0/buckets/{bucket}/events", json=events)
+    for url in [f"/api/0/buckets/{bucket}/events", "/api/0/export"]:
+        expected = flask_client.get(url).data
+        r = flask_client.get(url, headers={"Accept-Encoding": "gzip"})
+        assert r.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(r.data) == expected
+    # Small responses aren't compressed
+    r = flask_client.get("/api/0/info", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in r.headers
+
+
+def test_events_pagination(flask_client, bucket, tmp_path):
+    now = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    # Overlapping events, several with the same timestamp
+    events = [
+        Event(timestamp=now + timedelta(seconds=i // 3), duration=i % 5, data={"i": i})
+        for i in range(100)
+    ]
+    start, end = now + timedelta(seconds=5.5), now + timedelta(seconds=25.5)
+    # PeeweeStorage doesn't support keyset queries, the timestamp index is used
+    for storage in [SqliteStorage, EventLogStorage, PeeweeStorage]:
+        filepath = str(tmp_path / storage.__name__)
+        api = ServerAPI(Datastore(storage, testing=True, filepath=filepath), testing=True)
+        api.create_bucket("test-pages", "test", "test", "test")
+        api.create_events("test-pages", events)
+        for limit in [1, 7]:
+            pages = []  # type: list
+            cursor = None
+            while cursor is not None or not pages:
+                page, cursor = api.get_events_page(
+                    "test-pages", limit, start, end, cursor
+                )
+                pages += page
+            expected = api.get_events("test-pages", -1, start, end)
+            assert sorted(pages, key=lambda e: e["id"]) == sorted(
+                expected, key=lambda e: e["id"]
+            )
+            assert [(e["timestamp"], e["id"]) for e in pages] == sorted(
+                ((e["timestamp"], e["id"]) for e in pages), reverse=True
+            )
+        api.close()
+
+    flask_client.application.api.create_events(bucket, events)
+    url = f"/api/0/buckets/{bucket}/events?limit=60"
+    r = flask_client.get(url)
+    assert len(r.json) == 60
+    cursor = r.headers["X-Next-Cursor"]
+    assert r.headers["Link"] == f'<http://localhost{url}&cursor={cursor}>; rel="next"'
+    r = flask_client.get(f"{url}&cursor={cursor}")
+    assert len(r.json) == 40
+    assert "Link" not in r.headers
+    r = flask_client.get(f"/api/0/buckets/{bucket}/events?cursor=invalid")
+    assert r.status_code == 400
+
+
+def test_log_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(log_tail, "LOG_BLOCK_SIZE", 64)
+    log = tmp_path / "aw-server_2020-01-01T00-00-00.log"
+    rotated = tmp_path / "aw-server_2020-01-01T00-00-00.log.1"
+    rotated.write_text(
+        "".join(
+            f"2020-01-01 10:00:{i:02} [INFO ]: old {i}  (aw_server.api:1)\n"
+            for i in range(3)
+        )
+    )
+    log.write_text(
+        "2020-01-01 11:00:00 [WARNING]: failed  (aw_server.api:2)\n"
+        "Traceback (most recent call last):\n"
+        "ValueError\n"
+        "2020-01-01 11:00:01 [INFO ]: new  (aw_server.api:3)\n"
+    )
+    # Sorted by name, like by aw_core
+    paths = [str(rotated), str(log)]
+    monkeypatch.setattr(
+        log_tail, "_get_latest_log_files", lambda *args, **kwargs: paths
+    )
+    paths = log_tail.log_files("aw-server", testing=True)
+    assert paths == [str(log), str(rotated)]
+
+    records, cursor = log_tail.tail(paths, limit=3)
+    assert [r["message"] for r in records] == [
+        "new",
+        "failed\nTraceback (most recent call last):\nValueError",
+        "old 2",
+    ]
+    assert records[0] == {
+        "asctime": "2020-01-01 11:00:01",
+        "levelname": "INFO",
+        "message": "new",
+        "name": "aw_server.api",
+        "lineno": 3,
+    }
+    records, cursor = log_tail.tail(paths, limit=3, cursor=cursor)
+    assert [r["message"] for r in records] == ["old 1", "old 0"]
+    assert cursor is None
+
+    records, _ = log_tail.tail(paths, level=logging.WARNING)
+    assert [r["levelname"] for r in records] == ["WARNING"]
+    records, _ = log_tail.tail(paths, since=datetime(2020, 1, 1, 10, 0, 1))
+    assert [r["message"] for r in records][-1] == "old 1"
+
+
+def test_iter_export(monkeypatch):
+    monkeypatch.setattr(json_stream, "CHUNK_SIZE", 7)
+    export = {
+        "other": [1, {"a": 2}],
+        "buckets": {
+            "b1": {
+                "id": "b1",
+                "type": "t",
+                "client": "c",
+                "hostname": "h",
+                "created": "2020-01-01T00:00:00+00:00",
+                "events": [{"duration": 12345, "data": {"s": '\\"}'}}, {"data": {}}],
+            },
+            "b2": {
+                "events": [{"data": {"x": 1}}],
+                "id": "b2",
+                "type": "t",
+                "client": "c",
+                "hostname": "h",
+                "created": "2020-01-01T00:00:00+00:00",
+            },
+            "b3": {"id": "b3", "events": []},
+        },
+    }
+    items = list(json_stream.iter_export(io.StringIO(json.dumps(export, indent=2))))
+    assert [item[0] for item in items] == [
+        "bucket",
+        "event",
+        "event",
+        "bucket",
+        "event",
+        "bucket",
+    ]
+    assert items[0][1] == {
+        k: v for k, v in export["buckets"]["b1"].items() if k != "events"
+    }
+    assert items[1] == ("event", "b1", {"duration": 12345, "data": {"s": '\\"}'}})
+    assert items[4] == ("event", "b2", {"data": {"x": 1}})
+
+
 # TODO: Add benchmark for basic AFK-filtering query